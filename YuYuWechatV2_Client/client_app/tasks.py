@@ -1,6 +1,7 @@
 import json
 import re
 import time
+import uuid
 from datetime import datetime, timedelta
 from functools import wraps
 
@@ -57,6 +58,22 @@ def log_activity(func):
     return wrapper
 
 
+def post_message(server_ip, data, idempotency_key, timeout=60, retries=4):
+    """
+    调用服务端发送消息。请求带上幂等键，超时或连接失败时用同一个键重试，
+    服务端会返回第一次请求的结果，不会把同一条消息发送两次
+    """
+    url = f'http://{server_ip}/wechat/send_message/'
+    headers = {'Content-Type': 'application/json', 'Idempotency-Key': idempotency_key}
+    for attempt in range(retries + 1):
+        try:
+            return requests.post(url, headers=headers, data=json.dumps(data), timeout=timeout)
+        except (requests.Timeout, requests.ConnectionError):
+            if attempt == retries:
+                raise
+            time.sleep(2 ** attempt)
+
+
 @shared_task
 @log_activity
 def check_and_send_messages():
@@ -88,20 +105,21 @@ def check_and_send_messages():
             # 构建请求数据和发送消息
             data = {
                 'name': message.user.username,
-                'text': message.text
+                'text': message.text,
+                # 定时消息走 scheduled 通道，不会阻塞操作员手动发送的消息
+                'lane': 'scheduled',
+                # 同一分钟内发给同一个人的多条定时消息合并成一条发送
+                'coalesce': True,
+                'async': True
             }
 
             try:
-                # 发送消息并检查响应
-                url = f'http://{server_ip}/wechat/send_message/'
-                response = requests.post(
-                    url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(data)
-                )
+                # 异步提交消息，服务端可以把发给同一个人的消息合并发送；幂等键由任务和执行时间确定，
+                # 重试或重复触发都不会重复发送，所以服务端接受之后就记为已执行，发送结果通过返回的 job_id 查询
+                response = post_message(server_ip, data, f"scheduled-{message.id}-{now:%Y%m%d%H%M}")
                 print(response.text)
 
-                if response.status_code == 200:
+                if response.status_code == 202:
                     # 更新消息状态
                     message.execution_count -= 1
                     message.last_executed = now
@@ -144,13 +162,15 @@ def message_check():
         if check.use_time_blocks:
             data = {
                 'name': check.user.username,
-                'n_time_blocks': check.message_count
+                'n_time_blocks': check.message_count,
+                'lane': 'background'
             }
             url = f'http://{server_ip}/wechat/get_dialogs_by_time_blocks/'
         else:
             data = {
                 'name': check.user.username,
-                'n_msg': check.message_count
+                'n_msg': check.message_count,
+                'lane': 'background'
             }
             url = f'http://{server_ip}/wechat/get_dialogs/'
 
@@ -241,12 +261,7 @@ def check_cron(current_time, cron_expression, last_executed):
 @log_activity
 def send_message(data, server_ip):
     """调用视图发送消息"""
-    url = f'http://{server_ip}/wechat/send_message/'
-    response = requests.post(
-        url,
-        headers={'Content-Type': 'application/json'},
-        data=json.dumps(data)
-    )
+    response = post_message(server_ip, data, str(uuid.uuid4()))
     print(response.text)
 
 
@@ -1,6 +1,7 @@
 import json
 import os
 import subprocess
+import uuid
 from datetime import datetime
 from functools import wraps
 
@@ -19,6 +20,7 @@ from django.views.decorators.csrf import csrf_exempt
 
 from .models import EmailSettings
 from .models import Message, WechatUser, ServerConfig, ScheduledMessage, Log, ErrorLog, MessageCheck
+from .tasks import post_message
 
 
 def login_view(request):
@@ -197,12 +199,7 @@ def skip_execution(request):
                 'text': task.text
             }
 
-            url = f'http://{server_ip}/wechat/send_message/'
-            response = requests.post(
-                url,
-                headers={'Content-Type': 'application/json'},
-                data=json.dumps(data)
-            )
+            response = post_message(server_ip, data, str(uuid.uuid4()))
 
             if response.ok:
                 return JsonResponse({'status': f"Message sent to {user.username}"})
@@ -235,14 +232,9 @@ def send_message(request):
             'text': text
         }
 
-        url = f'http://{server_ip}/wechat/send_message/'
         try:
-            response = requests.post(
-                url,
-                headers={'Content-Type': 'application/json'},
-                data=json.dumps(data),
-                timeout=20  # 设置超时时间为20秒
-            )
+            # 设置超时时间为20秒，超时后用同一个幂等键重试一次
+            response = post_message(server_ip, data, str(uuid.uuid4()), timeout=20, retries=1)
 
             if response.status_code == 200:
                 return JsonResponse({'status': f"{text} sent to {username}"}, status=200)
@@ -514,12 +506,8 @@ def handle_error_cron(request):
                     'text': task.text
                 }
 
-                url = f'http://{server_ip}/wechat/send_message/'
-                response = requests.post(
-                    url,
-                    headers={'Content-Type': 'application/json'},
-                    data=json.dumps(data)
-                )
+                # 同一条错误记录的补发只会发送一次
+                response = post_message(server_ip, data, f"resend-{error_log.id}")
 
                 if response.ok:
                     task.last_executed = correct_time
@@ -128,3 +128,48 @@ STATIC_URL = "static/"
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# WeChat accounts
+# 每个账号有自己的任务队列和执行线程，请求中通过 account 字段指定账号，不指定时使用 default。
+# 同时登录多个微信时需要用 window_handle 指定各自主窗口的句柄；
+# backend 为 simulated 的账号使用模拟的微信客户端（需要先调用 wechat_app.simulator.install()）
+
+WECHAT_ACCOUNTS = {
+    "default": {"path": "C:/Program Files/Tencent/WeChat/WeChat.exe", "locale": "zh-CN"},
+}
+
+# 是否统计界面操作每个步骤的耗时（/wechat/metrics/ 和每个任务的 trace），关闭后几乎没有额外开销
+WECHAT_TRACING = True
+
+# 发送限速（见 wechat_app/pacing.py），每个账号单独计算，账号配置中的 pacing 可以覆盖；为 None 时不限速。
+# per_minute: 每分钟最多发送的消息条数；burst: 空闲之后最多可以连续发送的条数；
+# min_gap: 同一联系人两次发送之间的最小间隔（秒）；jitter: 每次发送后额外随机等待的最长时间（秒）
+# 例如 {"per_minute": 20, "burst": 5, "min_gap": 3.0, "jitter": 1.0}（与 Pacer 的默认值相同）。
+# 开启后同步请求要等排在前面的消息发完：按 20 条/分钟，排队超过约 100 条时会超过 SYNC_TIMEOUT（300 秒）返回 504，
+# 客户端的请求超时更短，大量发送时请使用 "async": true 并通过 /wechat/jobs/ 查询结果
+WECHAT_PACING = None
+
+# 请求中带有 "coalesce": true 的文本消息在队列中等待的秒数，这段时间内发给同一联系人的文本会合并成一次粘贴发送
+WECHAT_COALESCE_WINDOW = 2.0
+
+# 新消息监听（见 wechat_app/watcher.py）扫描会话列表的间隔（秒），为 None 时启动后不监听，可以通过 /wechat/watch/ 开启
+WECHAT_WATCH_INTERVAL = None
+
+# Logging
+# 每个任务完成后由 wechat_app.metrics 输出一行 JSON 格式的分步耗时（与 /wechat/jobs/<id>/ 中的 trace 相同），
+# 不需要时把它的级别改为 WARNING
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "simple": {"format": "{asctime} {levelname} {name} {message}", "style": "{"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "simple"},
+    },
+    "loggers": {
+        "wechat_app": {"handlers": ["console"], "level": "WARNING"},
+        "wechat_app.metrics": {"level": "INFO"},
+    },
+}
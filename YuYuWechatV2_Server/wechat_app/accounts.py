@@ -0,0 +1,178 @@
+"""
+多个微信账号。
+
+每个账号有自己的 WeChat 实例（窗口句柄、控件缓存、发送记录）、通讯录缓存、任务队列和执行线程，
+请求通过 account 字段路由到对应账号的执行线程。所有账号共用一个 JobStore，任务 id 在账号之间不会重复。
+
+同一个 Windows 桌面上的键盘、鼠标和剪切板只有一套：backend 为 uia 的账号共用一把桌面锁，
+各自排队、但同一时间只有一个账号在操作界面；backend 为 simulated 的账号各自使用独立的模拟桌面
+（见 simulator.new_desktop），可以同时执行，用于在 Linux 上测试路由和隔离。
+"""
+import threading
+from functools import partial
+
+import comtypes
+
+from .directory import Directory
+from .executor import UIExecutor
+from .pacing import Pacer
+from .scheduler import LaneQueue, INTERACTIVE
+from .ui_auto_wechat import WeChat
+from .watcher import MessageWatcher
+
+DEFAULT_ACCOUNT = 'default'
+
+UIA = 'uia'
+SIMULATED = 'simulated'
+BACKENDS = (UIA, SIMULATED)
+
+DEFAULT_PATH = "C:/Program Files/Tencent/WeChat/WeChat.exe"
+
+
+class Account:
+    def __init__(self, name, wechat, executor, directory, backend=UIA, desktop=None):
+        """
+        Args:
+            name: 账号名称，请求中的 account 字段
+            wechat: 操作该账号微信窗口的 WeChat 实例
+            executor: 该账号的执行线程
+            directory: 该账号的通讯录缓存
+            backend: uia 或 simulated
+            desktop: simulated 账号的模拟桌面
+        """
+        self.name = name
+        self.wechat = wechat
+        self.executor = executor
+        self.directory = directory
+        self.backend = backend
+        self.desktop = desktop
+        # 新消息监听，默认不开启，见 watcher.py
+        self.watcher = MessageWatcher(self)
+
+    @property
+    def queue(self):
+        return self.executor.queue
+
+    def submit(self, kind, task, error_info=None, lane=INTERACTIVE, pace=None, coalesce=None):
+        """把任务提交到该账号的执行线程"""
+        return self.executor.submit(kind, task, error_info, lane, pace, coalesce)
+
+    def stats(self):
+        return {
+            'backend': self.backend,
+            **self.executor.stats(),
+            'waits': self.wechat.waits.stats(),
+            'conversation': self.wechat.conversation.stats(),
+            'controls': self.wechat.controls.stats(),
+            'activator': self.wechat.activator.stats(),
+            'dialog_cache': self.wechat.dialog_cache.stats(),
+            'snapshots': self.wechat.snapshots.stats(),
+            'deliveries': self.wechat.deliveries.stats(),
+            'watcher': self.watcher.stats(),
+        }
+
+
+class AccountPool:
+    def __init__(self, job_store, directory_ttl=24 * 3600, tracing=True, pacing=None, coalesce_window=2.0):
+        """
+        Args:
+            job_store: 所有账号共用的 JobStore
+            directory_ttl: 每个账号通讯录缓存的有效期（秒）
+            tracing: 是否统计每个账号界面操作的分步耗时，见 metrics.py
+            pacing: 每个账号发送限速的参数（见 pacing.Pacer），为 None 时不限速
+            coalesce_window: 允许合并的消息在队列中等待其他消息的秒数，见 scheduler.LaneQueue
+        """
+        self.job_store = job_store
+        self.directory_ttl = directory_ttl
+        self.tracing = tracing
+        self.pacing = pacing
+        self.coalesce_window = coalesce_window
+        self._accounts = {}
+        # backend 为 uia 的账号共用的桌面锁
+        self._desktop_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, accounts, job_store, directory_ttl=24 * 3600, tracing=True, pacing=None,
+                      coalesce_window=2.0):
+        """
+        Args:
+            accounts: {账号名称: {"path", "locale", "window_handle", "backend", "pacing"}}，
+                见 settings.WECHAT_ACCOUNTS，账号中的 pacing 覆盖全局的限速参数
+        """
+        pool = cls(job_store, directory_ttl, tracing, pacing, coalesce_window)
+        for name, options in accounts.items():
+            pool.add(name, **options)
+        return pool
+
+    def add(self, name, path=DEFAULT_PATH, locale="zh-CN", window_handle=None, backend=UIA, app=None,
+            pacing=None) -> Account:
+        """
+        添加一个账号并启动它的执行线程
+        Args:
+            name: 账号名称
+            path: 微信的启动路径
+            locale: 微信的界面语言
+            window_handle: 该账号微信主窗口的句柄，同时登录多个微信时必须指定
+            backend: uia 操作真实的微信窗口；simulated 使用独立的模拟桌面
+            app: simulated 账号的模拟微信客户端（simulator.SimWeChatApp），默认为空的客户端
+            pacing: 该账号发送限速的参数，默认使用全局的参数，为 False 时该账号不限速
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}, must be one of {', '.join(BACKENDS)}")
+        with self._lock:
+            if name in self._accounts:
+                raise ValueError(f"Account already exists: {name}")
+
+            if backend == SIMULATED:
+                from . import simulator
+                desktop = simulator.new_desktop(app)
+                wechat = WeChat(path=path, locale=locale, launcher=desktop.launch, window_handle=window_handle)
+                initialize, run_lock = partial(simulator.bind, desktop), None
+            else:
+                desktop = None
+                wechat = WeChat(path=path, locale=locale, window_handle=window_handle)
+                initialize, run_lock = comtypes.CoInitialize, self._desktop_lock
+            wechat.tracer.enabled = self.tracing
+
+            pacing = pacing if pacing is not None else self.pacing
+            queue = LaneQueue(pacer=Pacer(**pacing) if pacing else None, coalesce_window=self.coalesce_window)
+            executor = UIExecutor(queue, self.job_store, initialize=initialize, name=f'wechat-ui-{name}',
+                                  account=name, run_lock=run_lock).start()
+            account = Account(name, wechat, executor, Directory(self.directory_ttl, name), backend, desktop)
+            self._accounts[name] = account
+            return account
+
+    def get(self, name):
+        """不存在时返回 None"""
+        with self._lock:
+            return self._accounts.get(name)
+
+    def names(self):
+        with self._lock:
+            return list(self._accounts)
+
+    def all(self):
+        with self._lock:
+            return list(self._accounts.values())
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._accounts
+
+    @property
+    def default(self) -> Account:
+        """名为 default 的账号，不存在时为第一个添加的账号"""
+        with self._lock:
+            return self._accounts.get(DEFAULT_ACCOUNT) or next(iter(self._accounts.values()))
+
+    def find_delivery(self, delivery_id):
+        """在所有账号中查找发送记录，返回 (账号, 记录)，不存在时记录为 None"""
+        for account in self.all():
+            record = account.wechat.deliveries.get(delivery_id)
+            if record is not None:
+                return account, record
+        return None, None
+
+    def stats(self):
+        return {account.name: account.stats() for account in self.all()}
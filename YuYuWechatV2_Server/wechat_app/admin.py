@@ -1,3 +1,20 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import DirectoryEntry, DirectoryScanRecord
+
+
+class DirectoryEntryAdmin(admin.ModelAdmin):
+    list_display = ('name', 'account', 'kind', 'first_seen', 'removed_at')  # 在列表页显示字段
+    search_fields = ('name',)  # 支持按名称搜索
+    list_filter = ('account', 'kind')  # 按账号和类型过滤
+    ordering = ('account', 'kind', 'name')
+
+
+class DirectoryScanRecordAdmin(admin.ModelAdmin):
+    list_display = ('account', 'kind', 'finished_at', 'entries', 'added', 'removed', 'rows_read', 'elapsed')
+    list_filter = ('account', 'kind')
+    ordering = ('-finished_at',)
+
+
+admin.site.register(DirectoryEntry, DirectoryEntryAdmin)
+admin.site.register(DirectoryScanRecord, DirectoryScanRecordAdmin)
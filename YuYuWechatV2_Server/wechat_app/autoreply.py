@@ -0,0 +1,226 @@
+"""
+自动回复规则。
+
+每条规则由联系人集合、触发词（关键词或正则表达式）和回复内容组成，按顺序匹配，第一条命中的规则给出回复。
+- 联系人放在哈希索引中：联系人 -> 适用于他的规则（包括不限联系人的规则），查找是 O(1)
+- 同一组规则的全部触发词（关键词和正则表达式）按规则顺序编译成一个分支表达式 (?P<r0>...)|(?P<r1>...)，
+  从左到右搜索一遍：同一位置按分支顺序得到序号最小的规则，之后从下一个字符继续搜索，
+  各条规则之间不会因为匹配位置重叠而互相遮挡。适用规则相同的联系人共用一个编译结果，替换规则时全部编译好
+- 正则表达式开头的全局标志（例如 (?i)）改写成只作用于该表达式的 (?i:...)；按编号引用分组（\\1、(?(1)...)）
+  在合并之后编号会改变，不支持
+- 每条规则的命中次数和每次匹配的耗时都会统计
+"""
+import re
+import threading
+import time
+
+from .metrics import Histogram
+
+# 匹配耗时直方图的分桶上限（秒）
+EVAL_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2)
+
+# 表达式开头的全局标志
+GLOBAL_FLAGS = re.compile(r'\(\?([aiLmsux]+)\)')
+
+
+def scope_flags(pattern):
+    """
+    把开头的全局标志改写成只作用于该表达式的标志，例如 (?i)hello -> (?i:hello)。
+    带 x 标志时表达式可能以 # 注释结尾，在右括号前换行，避免右括号被注释吞掉
+    """
+    match = GLOBAL_FLAGS.match(pattern)
+    if not match:
+        return pattern
+    flags = match.group(1)
+    end = '\n' if 'x' in flags else ''
+    return f'(?{flags}:{pattern[match.end():]}{end})'
+
+
+def references_groups(pattern):
+    """pattern 中是否按编号引用了分组：\\1 到 \\99（不包括三位的八进制转义），或者条件分组 (?(1)...)"""
+    i, in_class = 0, False
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if not in_class and re.match(r'[1-9]', pattern[i + 1:i + 2]) \
+                    and not re.match(r'[0-7]{3}', pattern[i + 1:i + 4]):
+                return True
+            i += 2
+            continue
+        if in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+            # 紧跟在 [ 或 [^ 后面的 ] 是普通字符
+            i += 2 if pattern[i + 1:i + 3] == '^]' else 1 if pattern[i + 1:i + 2] == ']' else 0
+        elif pattern.startswith('(?(', i):
+            return True
+        i += 1
+    return False
+
+
+class Rule:
+    def __init__(self, reply, contacts=None, keywords=(), patterns=(), name=None):
+        """
+        Args:
+            reply: 回复的内容
+            contacts: 适用的联系人或群聊名称，为空时适用于所有人
+            keywords: 触发的关键词，消息中包含任意一个即命中
+            patterns: 触发的正则表达式，消息中能搜索到任意一个即命中；关键词和正则都为空时所有消息都命中
+            name: 规则名称，用于统计，默认为规则的序号
+        """
+        self.reply = reply
+        self.contacts = frozenset(contacts or ())
+        self.keywords = list(keywords)
+        self.patterns = list(patterns)
+        self.name = name
+        self.hits = 0
+        # 合并到一个正则表达式中使用的形式
+        self._patterns = []
+        for pattern in self.patterns:
+            scoped = scope_flags(pattern)
+            try:
+                compiled = re.compile(scoped)
+            except re.error as e:
+                raise ValueError(f"Invalid pattern {pattern!r}: {e}")
+            # 所有规则合并成一个正则表达式，命名分组会与其他规则冲突，分组的编号也会改变
+            if compiled.groupindex:
+                raise ValueError(f"Named groups are not supported in patterns: {pattern!r}")
+            if references_groups(pattern):
+                raise ValueError(f"Group references are not supported in patterns: {pattern!r}")
+            self._patterns.append(scoped)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['reply'], data.get('contacts'), data.get('keywords', ()), data.get('patterns', ()),
+                   data.get('name'))
+
+    def trigger(self):
+        """该规则所有触发词组成的正则表达式，关键词按字面匹配"""
+        return '|'.join([re.escape(keyword) for keyword in self.keywords] + [f'(?:{p})' for p in self._patterns])
+
+    def to_dict(self):
+        return {'name': self.name, 'contacts': sorted(self.contacts), 'keywords': self.keywords,
+                'patterns': self.patterns, 'reply': self.reply, 'hits': self.hits}
+
+
+class _Compiled:
+    """一组规则编译后的结果，替换规则时整体替换，匹配过程不需要加锁"""
+
+    def __init__(self, rules):
+        self.rules = rules
+        # 不限联系人的规则，以及每个联系人适用的规则（保持规则的顺序）
+        self.wildcard = tuple(i for i, rule in enumerate(rules) if not rule.contacts)
+        contacts = {}
+        for i, rule in enumerate(rules):
+            for contact in rule.contacts:
+                contacts.setdefault(contact, []).append(i)
+        self.index = {contact: tuple(sorted(set(ids) | set(self.wildcard))) for contact, ids in contacts.items()}
+        # 规则序号组合 -> (编译后的正则表达式, 没有触发词的规则)
+        self._matchers = {}
+        for rule_ids in set(self.index.values()) | {self.wildcard}:
+            self.matcher(rule_ids)
+
+    def matcher(self, rule_ids):
+        """
+        没有触发词的规则命中所有消息，它之后的规则不会再命中，不放进正则表达式；
+        正则表达式为 None 时只看没有触发词的规则
+        """
+        matcher = self._matchers.get(rule_ids)
+        if matcher is None:
+            branches, fallback = [], None
+            for i in rule_ids:
+                trigger = self.rules[i].trigger()
+                if not trigger:
+                    fallback = i
+                    break
+                branches.append(f'(?P<r{i}>{trigger})')
+            try:
+                regex = re.compile('|'.join(branches)) if branches else None
+            except re.error as e:
+                raise ValueError(f"Rules cannot be combined: {e}")
+            matcher = self._matchers[rule_ids] = (regex, fallback)
+        return matcher
+
+
+def first_hit(regex, text):
+    """
+    text 中命中的序号最小的规则。每次命中后从命中位置的下一个字符继续搜索，直到命中第一个分支的规则或搜索完
+    """
+    best = None
+    found = regex.search(text)
+    while found is not None:
+        i = int(found.lastgroup[1:])
+        if best is None or i < best:
+            best = i
+            if found.lastindex == 1:
+                break
+        found = regex.search(text, found.start() + 1)
+    return best
+
+
+class AutoReplyEngine:
+    def __init__(self, rules=()):
+        self._compiled = _Compiled([])
+        self.evaluations = 0
+        self.matched = 0
+        self.eval_time = Histogram(EVAL_BUCKETS)
+        self._lock = threading.Lock()
+        self.set_rules(rules)
+
+    def set_rules(self, rules):
+        """替换全部规则，统计数据清零；规则无法合并成一个正则表达式时抛出 ValueError，原有规则不变"""
+        rules = list(rules)
+        for i, rule in enumerate(rules):
+            if rule.name is None:
+                rule.name = str(i)
+        compiled = _Compiled(rules)
+        with self._lock:
+            self._compiled = compiled
+            self.evaluations = 0
+            self.matched = 0
+            self.eval_time = Histogram(EVAL_BUCKETS)
+
+    @property
+    def rules(self):
+        return list(self._compiled.rules)
+
+    def match(self, contact, text):
+        """
+        返回对该联系人的这条消息命中的第一条规则，没有命中时返回 None
+        """
+        start = time.perf_counter()
+        compiled = self._compiled
+        rule = None
+        rule_ids = compiled.index.get(contact, compiled.wildcard)
+        if rule_ids:
+            regex, fallback = compiled.matcher(rule_ids)
+            hit = first_hit(regex, text) if regex is not None else None
+            hit = hit if hit is not None else fallback
+            if hit is not None:
+                rule = compiled.rules[hit]
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.evaluations += 1
+            self.eval_time.observe(elapsed)
+            if rule is not None:
+                self.matched += 1
+                rule.hits += 1
+        return rule
+
+    def reply(self, contact, text):
+        """命中规则的回复内容，没有命中时返回 None"""
+        rule = self.match(contact, text)
+        return rule.reply if rule is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'rules': len(self._compiled.rules),
+                'contacts': len(self._compiled.index),
+                'evaluations': self.evaluations,
+                'matched': self.matched,
+                'eval_time': self.eval_time.stats(),
+                'hits': {rule.name: rule.hits for rule in self._compiled.rules},
+            }
@@ -0,0 +1,282 @@
+"""
+在模拟的控件树上压测 ui_auto_wechat，不需要 Windows 和微信即可在 Linux 上运行：
+    python -m wechat_app.benchmark
+    python -m wechat_app.benchmark --output after.json --compare before.json
+
+每次运行的结果都会写入一个 JSON 文件（默认为 benchmark-<时间>.json），--compare 指定之前的结果文件时
+输出每个操作 ops/s 和 UIA 调用次数的变化，用于在没有 Windows 的环境中衡量驱动的优化效果。
+"""
+import argparse
+import json
+import platform
+import time
+from datetime import datetime
+
+from . import simulator
+
+
+def _history(n):
+    """生成 n 条聊天记录，每 5 条插入一条时间信息"""
+    messages = []
+    for i in range(n):
+        if i % 5 == 0:
+            messages.append((simulator.MSG_TIME, "", f"10:{i // 5 % 60:02d}"))
+        messages.append((simulator.MSG_USER, "好友", f"消息{i}"))
+    return messages
+
+
+def bench_control_cache(rounds=200, call_latency=0.0001, history=200):
+    """
+    对比开启与关闭控件缓存时，定位窗口、搜索框、发送按钮和聊天记录列表的耗时与 UIA 调用次数
+    """
+    results = {}
+    for enabled in (False, True):
+        app = simulator.SimWeChatApp([simulator.SimChat("文件传输助手", _history(history))])
+        desktop = simulator.install(app, call_latency=call_latency)
+        from .ui_auto_wechat import WeChat
+
+        wechat = WeChat(path="WeChat.exe")
+        wechat.controls.enabled = enabled
+        app.open_chat("文件传输助手")
+        desktop.stats.reset()
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            wechat.get_wechat()
+            wechat._search_box()
+            wechat._message_list()
+            wechat.press_enter()
+        elapsed = time.perf_counter() - start
+
+        results['cached' if enabled else 'uncached'] = {
+            'rounds': rounds,
+            'seconds': elapsed,
+            'ops_per_second': rounds / elapsed if elapsed else float('inf'),
+            'uia_calls_per_op': desktop.stats.calls / rounds,
+            'cache': wechat.controls.stats(),
+        }
+    results['speedup'] = results['uncached']['seconds'] / results['cached']['seconds']
+    return results
+
+
+def bench_snapshot(messages=500, call_latency=0.0001):
+    """
+    对比逐个控件读取与一次取回子树快照时，读取 messages 条聊天记录的耗时与 UIA 调用次数
+    """
+    results = {}
+    history = _history(messages)
+    for enabled in (False, True):
+        app = simulator.SimWeChatApp([simulator.SimChat("文件传输助手", history)], page_size=len(history))
+        desktop = simulator.install(app, call_latency=call_latency)
+        from .ui_auto_wechat import WeChat
+
+        wechat = WeChat(path="WeChat.exe")
+        wechat.snapshots.enabled = enabled
+        app.open_chat("文件传输助手")
+        wechat._message_list()
+        desktop.stats.reset()
+
+        start = time.perf_counter()
+        dialogs = wechat.get_dialogs("文件传输助手", len(history), search_user=False, use_cache=False)
+        elapsed = time.perf_counter() - start
+
+        results['snapshot' if enabled else 'per_control'] = {
+            'messages': len(dialogs),
+            'seconds': elapsed,
+            'uia_calls': desktop.stats.calls,
+            'uia_calls_per_message': desktop.stats.calls / len(dialogs),
+        }
+    results['speedup'] = results['per_control']['seconds'] / results['snapshot']['seconds']
+    return results
+
+
+def bench_verification(messages=50, call_latency=0.0001, history=200):
+    """
+    对比每条消息发送后马上校验（strict）与发送完一批之后统一校验（deferred）时，每条消息的耗时与 UIA 调用次数
+    """
+    results = {}
+    for mode in ('strict', 'deferred'):
+        app = simulator.SimWeChatApp([simulator.SimChat("好友", _history(history))])
+        desktop = simulator.install(app, call_latency=call_latency)
+        from .ui_auto_wechat import WeChat
+
+        wechat = WeChat(path="WeChat.exe")
+        wechat.verify = mode
+        desktop.stats.reset()
+
+        start = time.perf_counter()
+        for i in range(messages):
+            wechat.send_msg("好友", f"广播{i}")
+        if mode == 'deferred':
+            wechat.verify_deliveries("好友")
+        elapsed = time.perf_counter() - start
+
+        results[mode] = {
+            'messages': messages,
+            'seconds_per_message': elapsed / messages,
+            'uia_calls_per_message': desktop.stats.calls / messages,
+            'deliveries': wechat.deliveries.stats(),
+        }
+    results['speedup'] = results['strict']['seconds_per_message'] / results['deferred']['seconds_per_message']
+    return results
+
+
+def bench_tracing(messages=200, call_latency=0.0):
+    """
+    对比开启与关闭分步耗时统计时，发送 messages 条消息（strict 校验）的耗时，
+    模拟的 UIA 调用不加延迟，统计本身的开销在结果中占比最大
+    """
+    results = {}
+    for enabled in (False, True):
+        app = simulator.SimWeChatApp([simulator.SimChat("好友", _history(20))])
+        simulator.install(app, call_latency=call_latency)
+        from .ui_auto_wechat import WeChat
+
+        wechat = WeChat(path="WeChat.exe")
+        wechat.tracer.enabled = enabled
+        start = time.perf_counter()
+        for i in range(messages):
+            wechat.send_msg("好友", f"消息{i}", search_user=(i == 0))
+        elapsed = time.perf_counter() - start
+
+        results['traced' if enabled else 'untraced'] = {
+            'messages': messages,
+            'seconds_per_message': elapsed / messages,
+            'spans': sum(step['count'] for steps in wechat.tracer.stats().values() for step in steps.values()),
+        }
+    results['overhead'] = results['traced']['seconds_per_message'] / results['untraced']['seconds_per_message'] - 1
+    return results
+
+
+# 操作压测：(名称, 每轮调用的函数, 轮数相对于 rounds 的比例)
+OPERATIONS = (
+    ('send_msg', lambda wechat, i: wechat.send_msg("好友", f"压测{i}"), 1),
+    ('get_dialogs', lambda wechat, i: wechat.get_dialogs("好友", 20), 1),
+    ('get_dialogs_by_time_blocks', lambda wechat, i: wechat.get_dialogs_by_time_blocks("好友", 3), 1),
+    ('find_all_contacts', lambda wechat, i: wechat.find_all_contacts(), 0.05),
+    ('find_all_groups', lambda wechat, i: wechat.find_all_groups(), 0.05),
+)
+
+
+def _directory_app(history, contacts, groups):
+    chats = [simulator.SimChat("好友", _history(history))]
+    chats += [simulator.SimChat(f"群聊{i:04d}", is_group=True) for i in range(groups)]
+    return simulator.SimWeChatApp(chats, contacts=[(f"联系人{i:04d}", "") for i in range(contacts)])
+
+
+def bench_operations(rounds=200, call_latency=0.0001, history=200, contacts=300, groups=100):
+    """
+    分别压测 send_msg、get_dialogs、get_dialogs_by_time_blocks、find_all_contacts、find_all_groups，
+    每个操作使用新的模拟桌面和 WeChat 实例，报告每秒操作数和每次操作的 UIA 调用次数
+    """
+    results = {}
+    for name, operation, share in OPERATIONS:
+        desktop = simulator.install(_directory_app(history, contacts, groups), call_latency=call_latency)
+        from .ui_auto_wechat import WeChat
+
+        wechat = WeChat(path="WeChat.exe")
+        n = max(1, int(rounds * share))
+        desktop.stats.reset()
+
+        start = time.perf_counter()
+        for i in range(n):
+            operation(wechat, i)
+        elapsed = time.perf_counter() - start
+
+        results[name] = {
+            'rounds': n,
+            'seconds': elapsed,
+            'ops_per_second': n / elapsed if elapsed else float('inf'),
+            'uia_calls_per_op': desktop.stats.calls / n,
+            'searches_per_op': desktop.stats.searches / n,
+            'clicks_per_op': desktop.stats.clicks / n,
+        }
+    return results
+
+
+def compare(current, previous):
+    """
+    对比两次 bench_operations 的结果
+    Return:
+        {操作: {'ops_per_second': 倍数, 'uia_calls_per_op': 差值}}，只包含两次都有的操作
+    """
+    result = {}
+    for name, r in current.items():
+        before = previous.get(name)
+        if before is None:
+            continue
+        result[name] = {
+            'ops_per_second': r['ops_per_second'] / before['ops_per_second'] if before['ops_per_second'] else None,
+            'uia_calls_per_op': r['uia_calls_per_op'] - before['uia_calls_per_op'],
+        }
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="在模拟控件树上压测 WeChat 控件定位与聊天记录读取")
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0001, help="每次 UIA 调用的模拟耗时（秒）")
+    parser.add_argument("--history", type=int, default=200, help="聊天记录条数")
+    parser.add_argument("--messages", type=int, default=500, help="快照压测读取的聊天记录条数")
+    parser.add_argument("--broadcast", type=int, default=50, help="校验压测连续发送的消息条数")
+    parser.add_argument("--contacts", type=int, default=300, help="通讯录中的联系人数量")
+    parser.add_argument("--groups", type=int, default=100, help="通讯录中的群聊数量")
+    parser.add_argument("--output", help="结果 JSON 文件，默认为 benchmark-<时间>.json")
+    parser.add_argument("--compare", help="之前运行的结果 JSON 文件，输出与它相比的变化")
+    args = parser.parse_args(argv)
+
+    report = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'benchmarks': {},
+    }
+
+    results = report['benchmarks']['operations'] = bench_operations(
+        args.rounds, args.latency, args.history, args.contacts, args.groups)
+    for name, r in results.items():
+        print(f"{name:>26}: {r['ops_per_second']:10.1f} ops/s  {r['uia_calls_per_op']:10.1f} UIA calls/op")
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)['benchmarks']['operations']
+        print(f"  compared with {args.compare}:")
+        for name, change in compare(results, previous).items():
+            print(f"{name:>26}: {change['ops_per_second']:9.2f}x ops/s  {change['uia_calls_per_op']:+10.1f} UIA calls/op")
+
+    results = report['benchmarks']['control_cache'] = bench_control_cache(args.rounds, args.latency, args.history)
+    for mode in ('uncached', 'cached'):
+        r = results[mode]
+        print(f"{mode:>9}: {r['ops_per_second']:10.1f} ops/s  {r['uia_calls_per_op']:8.1f} UIA calls/op  "
+              f"hits={r['cache']['hits']} misses={r['cache']['misses']}")
+    print(f"  speedup: {results['speedup']:.1f}x")
+
+    results = report['benchmarks']['snapshot'] = bench_snapshot(args.messages, args.latency)
+    for mode in ('per_control', 'snapshot'):
+        r = results[mode]
+        print(f"{mode:>11}: {r['messages']} messages  {r['seconds']:8.3f} s  {r['uia_calls']:6d} UIA calls  "
+              f"{r['uia_calls_per_message']:6.2f} UIA calls/message")
+    print(f"    speedup: {results['speedup']:.1f}x")
+
+    results = report['benchmarks']['verification'] = bench_verification(args.broadcast, args.latency, args.history)
+    for mode in ('strict', 'deferred'):
+        r = results[mode]
+        print(f"{mode:>11}: {r['messages']} messages  {r['seconds_per_message'] * 1000:8.2f} ms/message  "
+              f"{r['uia_calls_per_message']:6.2f} UIA calls/message")
+    print(f"    speedup: {results['speedup']:.1f}x")
+
+    results = report['benchmarks']['tracing'] = bench_tracing(args.broadcast)
+    for mode in ('untraced', 'traced'):
+        r = results[mode]
+        print(f"{mode:>11}: {r['messages']} messages  {r['seconds_per_message'] * 1000:8.3f} ms/message  "
+              f"{r['spans']} spans")
+    print(f"   overhead: {results['overhead'] * 100:.1f}%")
+
+    output = args.output or f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json"
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
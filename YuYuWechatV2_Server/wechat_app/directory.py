@@ -0,0 +1,152 @@
+"""
+通讯录缓存。
+
+扫描通讯录需要操作微信界面几分钟，扫描结果保存在服务端的 SQLite 数据库中。
+查询只读内存中按名称排序的索引，不操作微信界面；缓存超过 ttl 后，查询时提交后台任务重新扫描。
+每个微信账号有自己的 Directory，数据库中的条目按账号区分。
+"""
+import bisect
+import threading
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import DirectoryEntry, DirectoryScanRecord
+
+CONTACT = DirectoryEntry.CONTACT
+GROUP = DirectoryEntry.GROUP
+KINDS = (CONTACT, GROUP)
+
+
+class NameIndex:
+    """按名称（忽略大小写）排序的索引，前缀查找只需要二分查找"""
+
+    def __init__(self, names=()):
+        self._items = sorted((name.lower(), name) for name in names)
+        self._keys = [key for key, _ in self._items]
+
+    def __len__(self):
+        return len(self._items)
+
+    def all(self, limit=None):
+        return [name for _, name in self._items[:limit]]
+
+    def prefix(self, prefix, limit=None):
+        """名称以 prefix 开头的条目"""
+        key = prefix.lower()
+        result = []
+        for i in range(bisect.bisect_left(self._keys, key), len(self._keys)):
+            if not self._keys[i].startswith(key) or (limit is not None and len(result) >= limit):
+                break
+            result.append(self._items[i][1])
+        return result
+
+    def search(self, query, limit=None):
+        """前缀匹配的条目排在前面，之后是名称中包含 query 的条目"""
+        result = self.prefix(query, limit)
+        key = query.lower()
+        matched = set(result)
+        for item_key, name in self._items:
+            if limit is not None and len(result) >= limit:
+                break
+            if key in item_key and name not in matched:
+                result.append(name)
+        return result
+
+
+class Directory:
+    def __init__(self, ttl=24 * 3600, account='default'):
+        """
+        Args:
+            ttl: 扫描结果的有效期（秒），过期后查询时会在后台重新扫描
+            account: 微信账号的名称
+        """
+        self.ttl = ttl
+        self.account = account
+        self._indexes = {}
+        self._scanned_at = {}
+        # 每种类型正在执行的扫描任务
+        self._refreshing = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """丢弃内存中的索引，下次查询时重新从数据库加载"""
+        with self._lock:
+            self._indexes.clear()
+            self._scanned_at.clear()
+            self._refreshing.clear()
+
+    def _load(self, kind):
+        if kind not in self._indexes:
+            names = DirectoryEntry.objects.filter(account=self.account, kind=kind,
+                                                  removed_at__isnull=True).values_list('name', flat=True)
+            record = DirectoryScanRecord.objects.filter(account=self.account, kind=kind).first()
+            self._indexes[kind] = NameIndex(names)
+            self._scanned_at[kind] = record.finished_at if record else None
+        return self._indexes[kind]
+
+    def index(self, kind) -> NameIndex:
+        with self._lock:
+            return self._load(kind)
+
+    def scanned_at(self, kind):
+        with self._lock:
+            self._load(kind)
+            return self._scanned_at[kind]
+
+    def is_stale(self, kind):
+        scanned_at = self.scanned_at(kind)
+        return scanned_at is None or timezone.now() - scanned_at > timedelta(seconds=self.ttl)
+
+    def apply_scan(self, kind, names, scan=None) -> DirectoryScanRecord:
+        """
+        保存一次扫描的结果，只写入与上一次扫描相比有变化的条目
+        Args:
+            kind: 条目类型
+            names: 扫描到的全部名称
+            scan: ui_auto_wechat.DirectoryScan，用于记录读取的行数和耗时
+        """
+        names = set(names)
+        now = timezone.now()
+        with transaction.atomic():
+            entries = DirectoryEntry.objects.filter(account=self.account, kind=kind)
+            existing = dict(entries.values_list('name', 'removed_at'))
+            added = [name for name in names if name not in existing]
+            restored = [name for name in names if name in existing and existing[name] is not None]
+            removed = [name for name, removed_at in existing.items() if removed_at is None and name not in names]
+
+            DirectoryEntry.objects.bulk_create(
+                [DirectoryEntry(account=self.account, kind=kind, name=name, first_seen=now) for name in added])
+            if restored:
+                entries.filter(name__in=restored).update(removed_at=None)
+            if removed:
+                entries.filter(name__in=removed).update(removed_at=now)
+            record = DirectoryScanRecord.objects.create(
+                account=self.account, kind=kind, finished_at=now, entries=len(names), added=len(added) + len(restored),
+                removed=len(removed), rows_read=scan.rows_read if scan else 0, elapsed=scan.elapsed if scan else 0)
+
+        with self._lock:
+            self._indexes[kind] = NameIndex(names)
+            self._scanned_at[kind] = now
+        return record
+
+    def refresh(self, kind, submit):
+        """
+        提交后台扫描任务，同一类型同时只会有一个扫描任务
+        Args:
+            kind: 条目类型
+            submit: 提交扫描任务的函数，参数为 kind，返回 Job
+        """
+        with self._lock:
+            job = self._refreshing.get(kind)
+            if job is None or job.done:
+                job = submit(kind)
+                self._refreshing[kind] = job
+            return job
+
+    def refreshing(self, kind):
+        """正在执行的扫描任务，没有时返回 None"""
+        with self._lock:
+            job = self._refreshing.get(kind)
+            return job if job is not None and not job.done else None
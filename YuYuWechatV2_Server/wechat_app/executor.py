@@ -0,0 +1,117 @@
+"""
+微信界面执行线程。
+
+所有对微信界面的操作都提交到 UIExecutor，由唯一的一个线程按队列通道的优先级依次执行。
+COM 只在这个线程启动时初始化一次，请求线程只负责提交任务并等待结果，不再需要争用锁。
+每个微信账号有自己的 UIExecutor，共用同一个桌面的账号通过 run_lock 保证同一时间只有一个任务在操作界面。
+允许合并的任务取出时会把队列中可以合并的任务一起取出，合并执行一次（见 jobs.run_coalesced）。
+"""
+import threading
+import time
+from collections import defaultdict, deque
+
+import comtypes
+
+from .jobs import Job, JobStore, SUCCEEDED, run_coalesced
+from .metrics import job_trace
+from .scheduler import LaneQueue, INTERACTIVE
+
+
+class UIExecutor:
+    def __init__(self, queue=None, job_store=None, initialize=comtypes.CoInitialize, name='wechat-ui', account=None,
+                 run_lock=None):
+        """
+        Args:
+            queue: 任务队列，默认为带优先级通道的 LaneQueue
+            job_store: 保存任务状态的 JobStore
+            initialize: 执行线程启动时调用一次的初始化函数（COM 初始化）
+            name: 执行线程的名称
+            account: 微信账号的名称，记录在提交的每个 Job 中
+            run_lock: 执行任务时持有的锁，多个执行线程操作同一个桌面（键盘、鼠标、剪切板）时共用
+        """
+        self.queue = queue if queue is not None else LaneQueue()
+        self.job_store = job_store if job_store is not None else JobStore()
+        self.initialize = initialize
+        self.name = name
+        self.account = account
+        self.run_lock = run_lock
+        self.current = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # 每种任务最近的执行时间
+        self._run_times = defaultdict(lambda: deque(maxlen=500))
+        self.executed = 0
+        # 被合并到其他任务中执行的任务数
+        self.coalesced = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+        return self
+
+    def submit(self, kind, task, error_info=None, lane=INTERACTIVE, pace=None, coalesce=None):
+        """
+        提交一个任务
+        Args:
+            kind: 任务类型
+            task: 在执行线程中调用的函数，返回 (是否成功, 结果)
+            error_info: 任务抛出异常时返回的结果
+            lane: 队列通道
+            pace: 需要限速的发送任务为 (联系人, 消息条数)
+            coalesce: 允许合并的任务为 (合并键, 任务内容, 合并执行的函数)
+        """
+        job = self.job_store.add(Job(kind, task, error_info, lane, self.account, pace, coalesce))
+        self.queue.put(job, lane)
+        return job
+
+    def _run(self):
+        self.initialize()
+        while True:
+            job = self.queue.get()
+            self.current = job
+            jobs = [job]
+            if job.coalesce is not None:
+                jobs += self.queue.take_coalesced(job, job.lane)
+                self.coalesced += len(jobs) - 1
+            if self.run_lock is not None:
+                with self.run_lock:
+                    self._execute(jobs)
+            else:
+                self._execute(jobs)
+            if job.pace is not None and self.queue.pacer is not None:
+                # 发送失败时降低发送速率
+                self.queue.pacer.record(all(j.status == SUCCEEDED for j in jobs))
+            self.executed += len(jobs)
+            self.current = None
+            for j in jobs:
+                self.job_store.finished(j)
+
+    def _execute(self, jobs):
+        job = jobs[0]
+        start = time.perf_counter()
+        with job_trace(job):
+            if job.coalesce is not None:
+                run_coalesced(jobs)
+            else:
+                job.run()
+        for other in jobs[1:]:
+            other.trace = job.trace
+        self._run_times[job.kind].append(time.perf_counter() - start)
+
+    def stats(self):
+        run_times = {}
+        for kind, times in self._run_times.items():
+            run_times[kind] = {'count': len(times), 'mean': sum(times) / len(times), 'max': max(times)}
+        current = self.current
+        pacer = self.queue.pacer
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'running': current.kind if current is not None else None,
+            'lanes': self.queue.stats(),
+            'pacing': pacer.stats(self.queue.paces()) if pacer is not None else None,
+            'jobs': self.job_store.stats(),
+            'run_times': run_times,
+        }
@@ -0,0 +1,77 @@
+"""
+发送请求的幂等键。
+
+客户端请求超时后并不知道消息是否已经发出，重试时带上同一个幂等键，服务端直接返回第一次请求的任务
+（排队中、执行中或已经完成），不会再操作一次微信界面。索引只保存在内存中，有数量上限并且会过期。
+第一次请求失败时重试同样返回失败的结果：失败的发送可能已经把消息发出去了（例如只是校验没有通过），
+是否重新发送由调用方决定，需要重新发送时换一个新的键。
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflict(ValueError):
+    """同一个幂等键对应了不同的请求内容"""
+
+
+class IdempotencyIndex:
+    def __init__(self, max_keys=10000, ttl=24 * 3600, clock=time.monotonic):
+        """
+        Args:
+            max_keys: 最多保存的幂等键数量，超出后丢弃最早的键
+            ttl: 幂等键的有效期（秒）
+            clock: 单调时钟，测试时可以替换
+        """
+        self.max_keys = max_keys
+        self.ttl = ttl
+        self.clock = clock
+        # key -> (请求内容的指纹, Job, 创建时间)，按创建顺序排列
+        self._entries = OrderedDict()
+        self.requests = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    def submit(self, key, fingerprint, submit):
+        """
+        返回该幂等键对应的任务（包括失败的任务），键不存在或已过期时调用 submit 提交新任务
+        Args:
+            key: 幂等键，不同账号的键互不影响，例如 (账号, 客户端传入的键)
+            fingerprint: 请求内容，用于发现同一个键被用于不同的请求
+            submit: 提交任务的函数，返回 Job
+
+        Return:
+            (Job, 是否为重复请求)
+        """
+        with self._lock:
+            self.requests += 1
+            self._prune()
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] != fingerprint:
+                    raise IdempotencyConflict(f"Idempotency key {key[-1]!r} was used for a different request")
+                self.hits += 1
+                return entry[1], True
+
+            job = submit()
+            self._entries[key] = (fingerprint, job, self.clock())
+            self._prune()
+            return job, False
+
+    def _prune(self):
+        expire_before = self.clock() - self.ttl
+        while self._entries:
+            _, _, created_at = next(iter(self._entries.values()))
+            if len(self._entries) > self.max_keys or created_at < expire_before:
+                self._entries.popitem(last=False)
+            else:
+                break
+
+    def stats(self):
+        with self._lock:
+            return {
+                'keys': len(self._entries),
+                'requests': self.requests,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.requests if self.requests else 0.0,
+            }
@@ -0,0 +1,194 @@
+"""
+队列任务（Job）及其状态存储。
+
+提交到队列的每个任务都会生成一个 Job，请求线程既可以同步等待 Job 完成，也可以直接返回 job id，
+之后通过 /wechat/jobs/<id>/ 查询状态。已完成的 Job 保存在有上限、会过期的内存存储中。
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+def _isoformat(ts):
+    return datetime.fromtimestamp(ts).isoformat() if ts is not None else None
+
+
+class Job:
+    def __init__(self, kind, task, error_info=None, lane='interactive', account=None, pace=None, coalesce=None):
+        """
+        Args:
+            kind: 任务类型，例如 send_message、send_batch
+            task: 在队列线程中执行的函数，返回 (是否成功, 结果)
+            error_info: 任务抛出异常时返回的结果，异常信息会放在其中的 error 字段
+            lane: 任务所在的队列通道，见 scheduler.py
+            account: 执行任务的微信账号，见 accounts.py
+            pace: 需要限速的发送任务为 (联系人, 消息条数)，见 pacing.py
+            coalesce: 可以与排队中的同类任务合并执行时为 (合并键, 任务内容, 合并执行的函数)，见 run_coalesced
+        """
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.lane = lane
+        self.account = account
+        self.pace = pace
+        self.coalesce = coalesce
+        self.task = task
+        self.error_info = error_info or {'status': 'Error'}
+        self.status = QUEUED
+        self.result = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # 执行期间各个步骤的耗时，见 metrics.job_trace
+        self.trace = None
+        self._done = threading.Event()
+
+    def start(self):
+        self.status = RUNNING
+        self.started_at = time.time()
+
+    def finish(self, success, result):
+        self.result = result
+        self.status = SUCCEEDED if success else FAILED
+        self.finished_at = time.time()
+        self._done.set()
+
+    def run(self):
+        """在队列线程中执行任务，任务抛出的异常会记录为失败结果"""
+        self.start()
+        try:
+            success, result = self.task()
+        except Exception as e:
+            success, result = False, {**self.error_info, 'error': str(e)}
+        self.finish(success, result)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """等待任务完成，超时返回 False"""
+        return self._done.wait(timeout)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'lane': self.lane,
+            'account': self.account,
+            'status': self.status,
+            'created_at': _isoformat(self.created_at),
+            'started_at': _isoformat(self.started_at),
+            'finished_at': _isoformat(self.finished_at),
+            'result': self.result,
+            'trace': self.trace,
+        }
+
+
+def run_coalesced(jobs):
+    """
+    合并执行 coalesce 键相同的多个任务：把每个任务的内容按顺序交给合并执行的函数调用一次，
+    函数返回与 jobs 一一对应的 [(是否成功, 结果), ...]，每个任务得到自己的结果。函数抛出异常时所有任务都失败
+    """
+    for job in jobs:
+        job.start()
+    _, _, task = jobs[0].coalesce
+    try:
+        results = task([job.coalesce[1] for job in jobs])
+    except Exception as e:
+        results = [(False, {**job.error_info, 'error': str(e)}) for job in jobs]
+    for job, (success, result) in zip(jobs, results):
+        job.finish(success, result)
+
+
+class JobGroup:
+    """
+    拆分成多个子任务排队执行的请求，例如按联系人拆分的批量发送。父 Job 不进入队列，只用于等待和查询；
+    每个子任务都通过 run 执行，最后一个子任务完成时用 summarize 汇总所有子任务的结果，结束父 Job
+    """
+
+    def __init__(self, job, parts, store, summarize):
+        """
+        Args:
+            job: 父 Job，需要已经加入 store
+            parts: 子任务的数量
+            store: 父 Job 完成后移入的 JobStore
+            summarize: 参数为 [子任务结果, ...]（按完成顺序），返回父 Job 的 (是否成功, 结果)
+        """
+        self.job = job
+        self.parts = parts
+        self.store = store
+        self.summarize = summarize
+        self._results = []
+        self._lock = threading.Lock()
+
+    def run(self, task):
+        """在执行线程中执行一个子任务，task 抛出的异常会继续抛出，由子任务自己的 Job 记录"""
+        with self._lock:
+            if self.job.status == QUEUED:
+                self.job.start()
+        result = None
+        try:
+            success, result = task()
+            return success, result
+        except Exception as e:
+            result = {**self.job.error_info, 'error': str(e)}
+            raise
+        finally:
+            with self._lock:
+                self._results.append(result)
+                done = len(self._results) == self.parts
+            if done:
+                self.job.finish(*self.summarize(self._results))
+                self.store.finished(self.job)
+
+
+class JobStore:
+    """
+    保存 Job 的内存存储。排队中和执行中的 Job 一直保留；已完成的 Job 最多保留 max_finished 个，
+    并且在完成 ttl 秒之后过期。
+    """
+
+    def __init__(self, max_finished=1000, ttl=3600):
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self._active = {}
+        # 已完成的 Job，按完成顺序排列
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._active[job.id] = job
+        return job
+
+    def finished(self, job):
+        """Job 完成后由队列线程调用，把 Job 移入已完成存储"""
+        with self._lock:
+            self._active.pop(job.id, None)
+            self._finished[job.id] = job
+            self._prune()
+
+    def get(self, job_id):
+        with self._lock:
+            self._prune()
+            return self._active.get(job_id) or self._finished.get(job_id)
+
+    def _prune(self):
+        expire_before = time.time() - self.ttl
+        while self._finished:
+            job = next(iter(self._finished.values()))
+            if len(self._finished) > self.max_finished or job.finished_at < expire_before:
+                self._finished.popitem(last=False)
+            else:
+                break
+
+    def stats(self):
+        with self._lock:
+            return {'active': len(self._active), 'finished': len(self._finished)}
@@ -0,0 +1,210 @@
+"""
+微信界面操作的分步耗时统计。
+
+WeChat 的每个步骤（激活窗口、搜索联系人、粘贴、点击发送、读取聊天记录校验……）都包在 span 中，
+耗时按 (操作, 步骤) 累计到直方图，操作是同一线程中最外层的 span。/wechat/metrics/ 以 Prometheus 文本格式
+输出这些直方图；执行线程为每个任务收集一份 JSON trace，保存在 Job 中并写入日志。
+关闭统计后 span 直接返回一个共用的空上下文管理器，不计时也不分配对象。
+"""
+import bisect
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 直方图的分桶上限（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_NULL_SPAN = contextlib.nullcontext()
+
+# 执行线程中正在收集的任务 trace，见 job_trace
+_local = threading.local()
+
+
+class Histogram:
+    """Prometheus 风格的累计分桶计数，同时保留最近 keep 个样本用于计算滚动分位数"""
+
+    def __init__(self, buckets=BUCKETS, keep=500):
+        self.buckets = buckets
+        # 最后一个桶为 +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=keep)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def cumulative(self):
+        """[(上限, 小于等于上限的样本数), ...]，最后一项的上限为 +Inf"""
+        result, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def stats(self) -> dict:
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {'count': self.count, 'sum': self.sum}
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': sum(ordered) / len(ordered),
+            'p50': ordered[len(ordered) // 2],
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'max': ordered[-1],
+        }
+
+
+class _Span:
+    __slots__ = ('tracer', 'step', 'operation', 'depth', 'start')
+
+    def __init__(self, tracer, step):
+        self.tracer = tracer
+        self.step = step
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.operation = stack[0] if stack else self.step
+        self.depth = len(stack)
+        stack.append(self.step)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        self.tracer._stack().pop()
+        self.tracer.record(self.operation, self.step, end - self.start)
+
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append({'operation': self.operation, 'step': self.step, 'depth': self.depth,
+                          'start': self.start - _local.started, 'elapsed': end - self.start,
+                          'error': exc_type.__name__ if exc_type is not None else None})
+        return False
+
+
+class Tracer:
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        """
+        Args:
+            enabled: 是否统计耗时，关闭时 span 不做任何事
+            buckets: 直方图的分桶上限（秒）
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        # (操作, 步骤) -> Histogram
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._thread = threading.local()
+
+    def _stack(self):
+        stack = getattr(self._thread, 'stack', None)
+        if stack is None:
+            stack = self._thread.stack = []
+        return stack
+
+    def span(self, step):
+        """统计 with 块中一个步骤的耗时"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, step)
+
+    def record(self, operation, step, elapsed):
+        with self._lock:
+            histogram = self._histograms.get((operation, step))
+            if histogram is None:
+                histogram = self._histograms[(operation, step)] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+
+    def histograms(self):
+        """[((操作, 步骤), Histogram), ...]，按操作和步骤排序"""
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def stats(self) -> dict:
+        result = {}
+        for (operation, step), histogram in self.histograms():
+            result.setdefault(operation, {})[step] = histogram.stats()
+        return result
+
+
+def traced(step):
+    """把 WeChat 的方法整体作为一个步骤统计耗时，方法所在的对象需要有 tracer 属性"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(step):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextlib.contextmanager
+def job_trace(job):
+    """
+    收集任务执行期间当前线程中所有 span 的记录，任务结束后保存到 job.trace 并以 JSON 写入日志
+    """
+    _local.spans = spans = []
+    _local.started = start = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        _local.spans = None
+        if spans:
+            job.trace = {'job': job.id, 'kind': job.kind, 'account': job.account,
+                         'elapsed': time.perf_counter() - start, 'spans': spans}
+            logger.info(json.dumps(job.trace, ensure_ascii=False))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render_prometheus(tracers, queues=()):
+    """
+    Prometheus 文本格式（version 0.0.4）的指标
+    Args:
+        tracers: [(标签, Tracer), ...]，例如 [({'account': 'default'}, wechat.tracer)]
+        queues: [(标签, LaneQueue), ...]，输出每个通道的排队数量
+    """
+    lines = ['# HELP wechat_step_seconds Time spent in each step of a WeChat UI operation.',
+             '# TYPE wechat_step_seconds histogram']
+    for labels, tracer in tracers:
+        for (operation, step), histogram in tracer.histograms():
+            series = {**labels, 'operation': operation, 'step': step}
+            for bound, count in histogram.cumulative():
+                lines.append(f'wechat_step_seconds_bucket{{{_labels({**series, "le": _bound(bound)})}}} {count}')
+            lines.append(f'wechat_step_seconds_sum{{{_labels(series)}}} {histogram.sum!r}')
+            lines.append(f'wechat_step_seconds_count{{{_labels(series)}}} {histogram.count}')
+
+    lines += ['# HELP wechat_queue_depth Jobs waiting in each lane.',
+              '# TYPE wechat_queue_depth gauge']
+    for labels, queue in queues:
+        for lane, stats in queue.stats().items():
+            lines.append(f'wechat_queue_depth{{{_labels({**labels, "lane": lane})}}} {stats["depth"]}')
+    return '\n'.join(lines) + '\n'
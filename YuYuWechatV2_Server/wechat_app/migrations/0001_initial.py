@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DirectoryScanRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('contact', '联系人'), ('group', '群聊')], help_text='扫描的条目类型', max_length=16)),
+                ('finished_at', models.DateTimeField(help_text='扫描完成的时间')),
+                ('entries', models.IntegerField(help_text='扫描到的条目数量')),
+                ('added', models.IntegerField(default=0, help_text='新增的条目数量')),
+                ('removed', models.IntegerField(default=0, help_text='不再出现的条目数量')),
+                ('rows_read', models.IntegerField(default=0, help_text='读取的行数')),
+                ('elapsed', models.FloatField(default=0, help_text='扫描耗时（秒）')),
+            ],
+            options={
+                'ordering': ['-finished_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='DirectoryEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('contact', '联系人'), ('group', '群聊')], help_text='条目类型：联系人或群聊', max_length=16)),
+                ('name', models.CharField(help_text='联系人的备注（没有备注时为昵称）或群聊名称', max_length=255)),
+                ('first_seen', models.DateTimeField(help_text='第一次扫描到的时间')),
+                ('removed_at', models.DateTimeField(blank=True, help_text='扫描时不再出现的时间', null=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'name'), name='unique_directory_entry')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wechat_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='directoryentry',
+            name='unique_directory_entry',
+        ),
+        migrations.AddField(
+            model_name='directoryentry',
+            name='account',
+            field=models.CharField(default='default', help_text='扫描的微信账号', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='directoryscanrecord',
+            name='account',
+            field=models.CharField(default='default', help_text='扫描的微信账号', max_length=64),
+        ),
+        migrations.AddConstraint(
+            model_name='directoryentry',
+            constraint=models.UniqueConstraint(fields=('account', 'kind', 'name'), name='unique_directory_entry'),
+        ),
+    ]
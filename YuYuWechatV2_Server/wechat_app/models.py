@@ -1,3 +1,43 @@
 from django.db import models
 
-# Create your models here.
+
+class DirectoryEntry(models.Model):
+    """
+    通讯录扫描得到的联系人或群聊。重新扫描时只写入有变化的条目：
+    新出现的条目插入，不再出现的条目不删除，只记录 removed_at
+    """
+    CONTACT = 'contact'
+    GROUP = 'group'
+    KIND_CHOICES = ((CONTACT, '联系人'), (GROUP, '群聊'))
+
+    account = models.CharField(max_length=64, default='default', help_text="扫描的微信账号")
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, help_text="条目类型：联系人或群聊")
+    name = models.CharField(max_length=255, help_text="联系人的备注（没有备注时为昵称）或群聊名称")
+    first_seen = models.DateTimeField(help_text="第一次扫描到的时间")
+    removed_at = models.DateTimeField(blank=True, null=True, help_text="扫描时不再出现的时间")
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['account', 'kind', 'name'], name='unique_directory_entry')]
+
+    def __str__(self):
+        return f"{self.account} - {self.get_kind_display()} - {self.name}"
+
+
+class DirectoryScanRecord(models.Model):
+    """
+    每一次通讯录扫描的结果，用于判断缓存是否过期以及查看扫描耗时
+    """
+    account = models.CharField(max_length=64, default='default', help_text="扫描的微信账号")
+    kind = models.CharField(max_length=16, choices=DirectoryEntry.KIND_CHOICES, help_text="扫描的条目类型")
+    finished_at = models.DateTimeField(help_text="扫描完成的时间")
+    entries = models.IntegerField(help_text="扫描到的条目数量")
+    added = models.IntegerField(default=0, help_text="新增的条目数量")
+    removed = models.IntegerField(default=0, help_text="不再出现的条目数量")
+    rows_read = models.IntegerField(default=0, help_text="读取的行数")
+    elapsed = models.FloatField(default=0, help_text="扫描耗时（秒）")
+
+    class Meta:
+        ordering = ['-finished_at']
+
+    def __str__(self):
+        return f"{self.account} - {self.kind} - {self.finished_at}"
@@ -0,0 +1,132 @@
+"""
+发送限速。
+
+连续快速粘贴发送会被微信限流，消息发送失败之后还要重试。Pacer 放在执行线程的队列前面：
+需要限速的任务（发送消息、批量发送、发送文件）只有在预算允许时才会被取出执行，
+其他任务（读取聊天记录、扫描通讯录等）不受影响，也不会因为等待限速而被阻塞。
+
+- 全局令牌桶：每分钟最多发送 per_minute 条，最多积攒 burst 条的预算
+- 同一联系人两次发送之间至少间隔 min_gap 秒
+- 每次发送后再随机等待 0 到 jitter 秒，避免固定间隔
+- 发送失败时把速率减半，之后每成功一次增加 1 条/分钟，直到配置的 per_minute
+- 超过 burst 条的任务在桶满时执行，但最多只欠下 burst 条的预算，之后的任务最多等待两个桶的补充时间；
+  批量发送会在提交时按联系人、按 burst 条拆成多个任务（见 views.send_batch），不会出现这种情况
+"""
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+
+class Pacer:
+    def __init__(self, per_minute=20, burst=5, min_gap=3.0, jitter=1.0, min_per_minute=2,
+                 clock=time.monotonic, rng=random.random):
+        """
+        Args:
+            per_minute: 全局每分钟最多发送的消息条数
+            burst: 令牌桶的容量，空闲之后最多可以连续发送的条数
+            min_gap: 同一联系人两次发送之间的最小间隔（秒）
+            jitter: 每次发送后额外随机等待的最长时间（秒）
+            min_per_minute: 发送失败降速时的最低速率
+            clock: 单调时钟，测试时可以替换
+            rng: 返回 [0, 1) 随机数的函数，测试时可以替换
+        """
+        self.per_minute = per_minute
+        self.burst = burst
+        self.min_gap = min_gap
+        self.jitter = jitter
+        self.min_per_minute = min_per_minute
+        self.clock = clock
+        self.rng = rng
+        # 当前速率，发送失败时降低，成功后逐渐恢复到 per_minute
+        self.rate = per_minute
+        self.tokens = float(burst)
+        self._updated = clock()
+        # 全局和每个联系人下一次允许发送的时间
+        self._not_before = 0.0
+        self._recipients = {}
+        self.sent = 0
+        self.throttled = 0
+        self._lock = threading.RLock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def delay(self, pace) -> float:
+        """
+        距离允许执行还要等待的秒数，0 表示现在就可以执行
+        Args:
+            pace: (联系人, 消息条数)，联系人为 None 时只受全局预算限制
+        """
+        key, cost = pace
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            # 超过桶容量的任务只要桶满就可以执行，多出来的部分（最多 burst 条）由之后的任务偿还
+            missing = min(cost, self.burst) - self.tokens
+            wait = missing * 60 / self.rate if missing > 0 else 0.0
+            wait = max(wait, self._not_before - now)
+            if key is not None:
+                wait = max(wait, self._recipients.get(key, 0.0) - now)
+            return max(wait, 0.0)
+
+    def consume(self, pace):
+        """任务被取出执行时调用，扣除预算并记录联系人的下一次允许发送时间"""
+        key, cost = pace
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            self.tokens = max(self.tokens - cost, -self.burst)
+            self._not_before = now + self.rng() * self.jitter
+            if key is not None:
+                self._recipients[key] = now + self.min_gap
+                self._prune(now)
+            self.sent += cost
+
+    def _prune(self, now):
+        # 间隔已经过去的联系人不再需要记录
+        if len(self._recipients) > 1000:
+            self._recipients = {k: t for k, t in self._recipients.items() if t > now}
+
+    def record(self, success):
+        """任务执行完成后调用：失败时速率减半，成功时增加 1 条/分钟"""
+        with self._lock:
+            self._refill(self.clock())
+            if success:
+                self.rate = min(self.per_minute, self.rate + 1)
+            else:
+                self.throttled += 1
+                self.rate = max(self.min_per_minute, self.rate / 2)
+
+    def projected_drain(self, paces) -> float:
+        """
+        按当前的预算和速率，排队中的 paces 全部发送完大约还需要的秒数（不包括执行本身的耗时）
+        """
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            total = sum(cost for _, cost in paces)
+            drain = max(0.0, (total - self.tokens) * 60 / self.rate, self._not_before - now)
+            # 同一联系人的多条消息之间至少间隔 min_gap
+            for key, count in Counter(key for key, _ in paces if key is not None).items():
+                start = max(0.0, self._recipients.get(key, 0.0) - now)
+                drain = max(drain, start + (count - 1) * self.min_gap)
+            return drain
+
+    def stats(self, paces=()) -> dict:
+        with self._lock:
+            self._refill(self.clock())
+            return {
+                'per_minute': self.per_minute,
+                'rate': self.rate,
+                'burst': self.burst,
+                'budget': math.floor(max(self.tokens, 0)),
+                'min_gap': self.min_gap,
+                'jitter': self.jitter,
+                'sent': self.sent,
+                'throttled': self.throttled,
+                'queued_messages': sum(cost for _, cost in paces),
+                'drain_seconds': self.projected_drain(paces),
+            }
@@ -0,0 +1,119 @@
+"""
+聊天图片导出。
+
+图片在进程内一边复制一边计算 sha256，内容相同的图片只导出一次（包括之前几次导出的图片）。
+导出目录中的 manifest.json 记录已经导出的图片和已经处理过的源文件，下次导出时跳过，
+中断后重新导出会从上次停下的地方继续。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+MANIFEST_NAME = 'manifest.json'
+CHUNK_SIZE = 1024 * 1024
+
+
+class PictureManifest:
+    def __init__(self, save_dir):
+        self.save_dir = save_dir
+        self.path = os.path.join(save_dir, MANIFEST_NAME)
+        # sha256 -> {'file', 'source', 'exported_at'}，按导出顺序排列
+        self.pictures = {}
+        # 已经处理过的源文件路径 -> sha256
+        self.sources = {}
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.pictures = data.get('pictures', {})
+            self.sources = data.get('sources', {})
+
+    def save(self):
+        """先写临时文件再替换，导出中断时 manifest 不会损坏"""
+        fd, tmp = tempfile.mkstemp(dir=self.save_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'pictures': self.pictures, 'sources': self.sources}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    def file_of(self, digest):
+        return os.path.join(self.save_dir, self.pictures[digest]['file'])
+
+
+def export_picture(source, manifest):
+    """
+    把源文件复制到导出目录，复制的同时计算 sha256，内容已经导出过时丢弃这次的复制
+    Return:
+        (sha256, 是否为新导出的图片)
+    """
+    if source in manifest.sources and manifest.sources[source] in manifest.pictures:
+        return manifest.sources[source], False
+
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=manifest.save_dir, suffix='.part')
+    try:
+        with open(source, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                dst.write(chunk)
+        sha256 = digest.hexdigest()
+        new = sha256 not in manifest.pictures
+        if new:
+            suffix = os.path.splitext(source)[1]
+            name = f"{sha256[:16]}{suffix}"
+            os.replace(tmp, os.path.join(manifest.save_dir, name))
+            manifest.pictures[sha256] = {'file': name, 'source': source, 'exported_at': time.time()}
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    manifest.sources[source] = sha256
+    return sha256, new
+
+
+class _StreamBuffer:
+    """zipfile 的输出对象：只追加不支持 seek，写入的内容由 zip_stream 取走"""
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """取走已经写入的内容"""
+        if self.chunks:
+            data = b''.join(self.chunks)
+            self.chunks = []
+            yield data
+
+
+def zip_stream(paths):
+    """
+    逐个文件生成 zip 内容，不需要在内存或磁盘中先生成完整的 zip。
+    响应头已经发出，无法打开的文件（例如导出之后被删除）直接跳过，不中断整个 zip
+    Args:
+        paths: [(压缩包中的文件名, 文件路径), ...]
+    """
+    buffer = _StreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for arcname, path in paths:
+            try:
+                src = open(path, 'rb')
+            except OSError:
+                continue
+            with src, archive.open(arcname, 'w', force_zip64=True) as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    yield from buffer.drain()
+            yield from buffer.drain()
+    yield from buffer.drain()
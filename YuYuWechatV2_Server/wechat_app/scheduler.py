@@ -0,0 +1,223 @@
+"""
+带优先级通道的任务队列。
+
+interactive：操作员手动发送的消息，优先级最高
+scheduled：  定时任务发送的消息
+background： 聊天记录检测、防掉线等后台任务
+
+队列总是先处理优先级高的通道；为了防止低优先级的任务一直得不到处理，
+某个通道队首任务的等待时间超过该通道的 max_wait 后会被提前处理。
+
+设置了 pacer（见 pacing.py）时，带有 pace 属性的任务只有在发送预算允许时才会被取出，
+预算不足时先取出后面不需要限速（或者发给其他联系人）的任务。
+
+带有 coalesce 属性的任务（允许合并的文本消息）加入队列后至少等待 coalesce_window 秒才会被取出，
+取出时执行线程通过 take_coalesced 把同一通道中合并键相同、在这段时间内加入的任务一起取出，合并成一次粘贴发送。
+"""
+import threading
+import time
+from collections import deque
+from queue import Empty
+
+INTERACTIVE = 'interactive'
+SCHEDULED = 'scheduled'
+BACKGROUND = 'background'
+
+# (通道名称, 最长等待秒数)，按优先级从高到低排列，None 表示不需要饥饿保护
+DEFAULT_LANES = (
+    (INTERACTIVE, None),
+    (SCHEDULED, 120),
+    (BACKGROUND, 300),
+)
+
+
+class LaneStats:
+    def __init__(self, keep=500):
+        self.enqueued = 0
+        self.dequeued = 0
+        # 因为等待超时而被提前处理的次数
+        self.promoted = 0
+        # 被合并到其他任务中执行的任务数
+        self.coalesced = 0
+        # 最近 keep 个任务的排队时间
+        self.waits = deque(maxlen=keep)
+
+
+class LaneQueue:
+    def __init__(self, lanes=DEFAULT_LANES, pacer=None, coalesce_window=2.0, coalesce_limit=20):
+        """
+        Args:
+            lanes: (通道名称, 最长等待秒数)，按优先级从高到低排列
+            pacer: 发送限速，为 None 时不限速
+            coalesce_window: 允许合并的任务加入队列后等待其他可合并任务的秒数
+            coalesce_limit: 一次最多合并的任务数
+        """
+        self.pacer = pacer
+        self.coalesce_window = coalesce_window
+        self.coalesce_limit = coalesce_limit
+        self._queues = {name: deque() for name, _ in lanes}
+        self._max_wait = dict(lanes)
+        self._stats = {name: LaneStats() for name, _ in lanes}
+        self._cond = threading.Condition()
+
+    @property
+    def lanes(self):
+        return list(self._queues)
+
+    def put(self, item, lane=INTERACTIVE):
+        if lane not in self._queues:
+            raise ValueError(f"Unknown lane: {lane}, must be one of {', '.join(self._queues)}")
+        with self._cond:
+            self._queues[lane].append((time.monotonic(), item))
+            self._stats[lane].enqueued += 1
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """取出下一个任务，队列为空或者所有任务都在等待发送预算时阻塞，超时抛出 queue.Empty"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            while True:
+                if not self._cond.wait_for(self.qsize, self._remaining(deadline)):
+                    raise Empty
+                now = time.monotonic()
+                lane, promoted = self._pick(now)
+                index, wait = self._paced(lane, now)
+                if index is None:
+                    # 选中的通道中的任务都在等待发送预算或合并窗口，先处理其他通道中可以执行的任务
+                    for other in self._queues:
+                        if other != lane and self._queues[other]:
+                            index, other_wait = self._paced(other, now)
+                            if index is not None:
+                                lane, promoted = other, False
+                                break
+                            wait = min(wait, other_wait)
+                if index is not None:
+                    break
+                # 所有任务都在等待，等到最早可以发送的时间或者有新任务加入
+                remaining = self._remaining(deadline)
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._cond.wait(wait if remaining is None else min(wait, remaining))
+
+            queue = self._queues[lane]
+            enqueued_at, item = queue[index]
+            del queue[index]
+            pace = getattr(item, 'pace', None)
+            if self.pacer is not None and pace is not None:
+                self.pacer.consume(pace)
+
+            stats = self._stats[lane]
+            stats.dequeued += 1
+            stats.promoted += promoted
+            stats.waits.append(now - enqueued_at)
+            return item
+
+    @staticmethod
+    def _remaining(deadline):
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    def _paced(self, lane, now):
+        """
+        该通道中第一个可以执行的任务
+        Return:
+            (下标, None)；都需要等待发送预算或合并窗口时为 (None, 最短的等待秒数)
+        """
+        queue = self._queues[lane]
+        if self.pacer is None and self.coalesce_window <= 0:
+            return 0, None
+        wait = float('inf')
+        blocked = set()
+        for index, (enqueued_at, item) in enumerate(queue):
+            pace = getattr(item, 'pace', None)
+            # 同一联系人的任务保持顺序：前面的任务在等待时，后面的任务也不能执行
+            if pace is not None and pace[0] in blocked:
+                continue
+            delay = 0.0
+            if getattr(item, 'coalesce', None) is not None:
+                delay = enqueued_at + self.coalesce_window - now
+            if self.pacer is not None and pace is not None:
+                delay = max(delay, self.pacer.delay(pace))
+            if delay <= 0:
+                return index, None
+            wait = min(wait, delay)
+            if pace is not None:
+                blocked.add(pace[0])
+        return None, wait
+
+    def take_coalesced(self, item, lane):
+        """
+        取出该通道中可以与 item 合并执行的任务：合并键相同、在 item 之后 coalesce_window 秒内加入队列，
+        最多 coalesce_limit - 1 个。遇到发给同一联系人、但不能合并的任务时停止，保证同一联系人的发送顺序。
+        合并的任务与 item 一起发送，不再单独扣除发送预算
+        """
+        key = item.coalesce[0]
+        recipient = item.pace[0] if getattr(item, 'pace', None) is not None else None
+        with self._cond:
+            queue = self._queues[lane]
+            taken, kept = [], deque()
+            while queue:
+                enqueued_at, other = queue.popleft()
+                coalesce = getattr(other, 'coalesce', None)
+                if (len(taken) < self.coalesce_limit - 1 and coalesce is not None and coalesce[0] == key
+                        and other.created_at - item.created_at <= self.coalesce_window):
+                    taken.append(other)
+                    continue
+                kept.append((enqueued_at, other))
+                pace = getattr(other, 'pace', None)
+                if recipient is not None and pace is not None and pace[0] == recipient:
+                    break
+            kept.extend(queue)
+            self._queues[lane] = kept
+
+            stats = self._stats[lane]
+            stats.dequeued += len(taken)
+            stats.coalesced += len(taken)
+            return taken
+
+    def paces(self):
+        """排队中需要限速的任务的 pace，用于估计发送完所有任务需要的时间"""
+        with self._cond:
+            return [item.pace for queue in self._queues.values() for _, item in queue
+                    if getattr(item, 'pace', None) is not None]
+
+    def _pick(self, now):
+        """返回 (通道, 是否因为饥饿保护被提前处理)"""
+        first = next(name for name, queue in self._queues.items() if queue)
+
+        # 饥饿保护：队首任务超过最长等待时间的通道中，超出最多的优先处理
+        overdue = []
+        for name, queue in self._queues.items():
+            max_wait = self._max_wait[name]
+            if queue and max_wait is not None:
+                over = now - queue[0][0] - max_wait
+                if over >= 0:
+                    overdue.append((over, name))
+        if overdue:
+            lane = max(overdue)[1]
+            return lane, lane != first
+        return first, False
+
+    def qsize(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            result = {}
+            for name, queue in self._queues.items():
+                stats = self._stats[name]
+                waits = stats.waits
+                result[name] = {
+                    'depth': len(queue),
+                    'enqueued': stats.enqueued,
+                    'dequeued': stats.dequeued,
+                    'promoted': stats.promoted,
+                    'coalesced': stats.coalesced,
+                    'oldest_wait': now - queue[0][0] if queue else 0.0,
+                    'wait_mean': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_max': max(waits) if waits else 0.0,
+                }
+            return result
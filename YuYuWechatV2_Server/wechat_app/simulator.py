@@ -0,0 +1,1102 @@
+"""
+模拟的微信客户端与 uiautomation 控件树，用于在没有 Windows 与微信的环境（例如 Linux CI）中
+运行、测试和压测 ui_auto_wechat。
+
+使用方法：
+    from wechat_app import simulator
+    desktop = simulator.install()          # 必须在导入 ui_auto_wechat 之前调用
+    from wechat_app.ui_auto_wechat import WeChat
+
+install() 会把 uiautomation、pyperclip、pyautogui、win32clipboard 等只能在 Windows 桌面上使用的
+模块替换为这里的假实现。每一次跨进程的 UIA 调用都会计入 desktop.stats，并可以通过
+call_latency 模拟真实环境下的调用耗时。
+
+模拟多个微信账号时，new_desktop() 为每个账号创建一个独立的模拟桌面，账号的执行线程调用
+bind(desktop) 之后，该线程中的 UIA 调用、剪切板和按键都只作用于这个桌面。
+"""
+import itertools
+import os
+import sys
+import threading
+import time
+import types
+import weakref
+
+# 模拟器自身使用的 sleep，避免被测试代码替换 time.sleep 后影响模拟的耗时
+_sleep = time.sleep
+_perf_counter = time.perf_counter
+
+# 消息类型，与 WeChat._detect_type 的返回值一致
+MSG_USER = 0
+MSG_TIME = 1
+MSG_RED_PACKET = 2
+MSG_RECALL = 4
+MSG_NEW_NOTICE = 6
+
+LOAD_MORE = "查看更多消息"
+
+
+class SimStats:
+    """
+    记录模拟控件树上发生的 UIA 调用次数
+    calls:         跨进程调用次数（属性读取、遍历、模式调用等）
+    searches:      控件搜索次数
+    nodes_visited: 控件搜索过程中访问过的节点数量
+    """
+    FIELDS = ("calls", "searches", "nodes_visited", "clicks", "pastes", "launches")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def snapshot(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class SimNode:
+    """模拟的 UIA 元素"""
+    _ids = itertools.count(1)
+    # runtime id -> 控件，用于根据屏幕坐标反查控件
+    registry = weakref.WeakValueDictionary()
+
+    def __init__(self, control_type, name="", children=None, on_click=None, on_double_click=None,
+                 on_right_click=None, on_keys=None, value=None, scroll=None, class_name=""):
+        self.runtime_id = next(SimNode._ids)
+        SimNode.registry[self.runtime_id] = self
+        self.control_type = control_type
+        self.name = name
+        self.class_name = class_name
+        self.parent = None
+        self.alive = True
+        self.on_click = on_click
+        self.on_double_click = on_double_click
+        self.on_right_click = on_right_click
+        self.on_keys = on_keys
+        self.value = value
+        self.scroll = scroll
+        # 动态子控件：返回子控件列表的函数（例如聊天记录列表）
+        self.provider = None
+        self._children = []
+        for child in children or []:
+            self.add(child)
+
+    @property
+    def children(self):
+        if self.provider is not None:
+            children = self.provider()
+            for child in children:
+                child.parent = self
+            return children
+        return self._children
+
+    def add(self, child):
+        child.parent = self
+        self._children.append(child)
+        return child
+
+    def position(self):
+        # 用 runtime id 作为屏幕坐标，方便根据坐标反查控件
+        return self.runtime_id, 1
+
+    def kill(self):
+        """控件被销毁（例如窗口关闭或重建），之后的访问都会失败"""
+        self.alive = False
+        for child in self._children:
+            child.kill()
+
+    def BuildUpdatedCache(self, cache_request):
+        """一次跨进程调用取回 cache_request 指定范围内所有控件的属性"""
+        if not self.alive:
+            raise LookupError("Element not available")
+        desktop.charge()
+        return SimCachedElement(self, cache_request.TreeScope)
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+class SimScroll:
+    """模拟 ScrollPattern，通过回调把滚动位置通知给所属的模拟界面"""
+
+    def __init__(self, on_scroll=None, view_size=100.0):
+        self.on_scroll = on_scroll
+        self.VerticalScrollPercent = 0.0
+        self.VerticalViewSize = view_size
+
+    def SetScrollPercent(self, horizontalPercent, verticalPercent):
+        desktop.charge()
+        if verticalPercent >= 0:
+            self.VerticalScrollPercent = min(max(verticalPercent, 0), 1) * 100
+        if self.on_scroll:
+            self.on_scroll(self.VerticalScrollPercent / 100)
+        return True
+
+
+class SimDesktop:
+    """模拟的桌面：控件树的根节点、剪切板、焦点以及调用统计"""
+
+    def __init__(self):
+        self.stats = SimStats()
+        # 每一次 UIA 跨进程调用的模拟耗时（秒）
+        self.call_latency = 0.0
+        self._debt = 0.0
+        self.clipboard = {"text": ""}
+        self.focus = None
+        self.foreground = None
+        self.cursor = (0, 0)
+        self.root = SimNode("PaneControl", "桌面 1")
+        self.app = None
+
+    def reset(self, app=None, call_latency=0.0):
+        self.root.kill()
+        self.root = SimNode("PaneControl", "桌面 1")
+        self.stats.reset()
+        self.call_latency = call_latency
+        self._debt = 0.0
+        self.clipboard = {"text": ""}
+        self.focus = None
+        self.foreground = None
+        self.app = app if app is not None else SimWeChatApp()
+        self.app.attach(self)
+        self.app.open()
+        return self
+
+    def charge(self, calls=1):
+        """计入 calls 次跨进程调用，并按 call_latency 模拟耗时"""
+        self.stats.calls += calls
+        if self.call_latency:
+            # 累积到 1ms 再 sleep，避免过短的 sleep 精度不够
+            self._debt += self.call_latency * calls
+            if self._debt >= 0.001:
+                _sleep(self._debt)
+                self._debt = 0.0
+
+    def node_at(self, x, y):
+        node = SimNode.registry.get(x)
+        return node if node is not None and node.alive else None
+
+    def find(self, start, control_type, props, max_depth, found_index):
+        """深度优先搜索控件，与 uiautomation 的搜索顺序一致"""
+        exact_depth = props.get("Depth")
+        if exact_depth is not None:
+            max_depth = exact_depth
+        visited = 0
+        count = 0
+        found = None
+        stack = [(child, 1) for child in reversed(start.children)]
+        while stack:
+            node, depth = stack.pop()
+            visited += 1
+            if (exact_depth is None or depth == exact_depth) and _matches(node, control_type, props):
+                count += 1
+                if count == found_index:
+                    found = node
+                    break
+            if depth < max_depth:
+                stack.extend((child, depth + 1) for child in reversed(node.children))
+        self.stats.searches += 1
+        self.stats.nodes_visited += visited
+        self.charge(visited)
+        return found
+
+    def launch(self, path):
+        """模拟启动 WeChat.exe：窗口不存在时打开，存在时切换到前台"""
+        self.stats.launches += 1
+        window = self.app.open()
+        self.foreground = window
+        return window
+
+    def paste(self):
+        self.stats.pastes += 1
+        if self.focus is not None and self.focus.alive and self.focus.on_keys:
+            self.focus.on_keys("{Ctrl}v")
+
+    def send_keys(self, keys):
+        if keys.lower() == "{ctrl}v":
+            self.paste()
+        elif self.focus is not None and self.focus.alive and self.focus.on_keys:
+            self.focus.on_keys(keys)
+
+
+def _matches(node, control_type, props):
+    if not node.alive:
+        return False
+    if control_type and node.control_type != control_type:
+        return False
+    if "Name" in props and node.name != props["Name"]:
+        return False
+    if "SubName" in props and props["SubName"] not in node.name:
+        return False
+    if "ClassName" in props and node.class_name != props["ClassName"]:
+        return False
+    return True
+
+
+class _CurrentDesktop:
+    """
+    模块中使用的 desktop：默认为 install() 重置的主桌面，调用过 bind 的线程使用自己绑定的桌面
+    """
+
+    def __getattr__(self, item):
+        return getattr(current_desktop(), item)
+
+    def __setattr__(self, key, value):
+        setattr(current_desktop(), key, value)
+
+
+_main_desktop = SimDesktop()
+_local = threading.local()
+desktop = _CurrentDesktop()
+
+
+def current_desktop():
+    return getattr(_local, "desktop", None) or _main_desktop
+
+
+def bind(sim_desktop):
+    """让当前线程使用指定的模拟桌面，传入 None 时恢复为主桌面"""
+    _local.desktop = sim_desktop
+
+
+def new_desktop(app=None, call_latency=0.0):
+    """创建一个独立的模拟桌面并打开微信窗口，与主桌面和其他桌面互不影响"""
+    return SimDesktop().reset(app, call_latency=call_latency)
+
+
+# ---------------------------------------------------------------------------
+# 假的 uiautomation 模块
+# ---------------------------------------------------------------------------
+
+class Control:
+    ControlTypeName = ""
+
+    def __init__(self, searchFromControl=None, searchDepth=0xFFFFFFFF, searchInterval=0.5, foundIndex=1,
+                 element=None, **searchProperties):
+        self._element = element
+        self.searchFromControl = searchFromControl
+        self.searchDepth = searchDepth
+        self.foundIndex = foundIndex
+        self.searchProperties = searchProperties
+
+    @staticmethod
+    def CreateControlFromElement(element):
+        if element is None:
+            return None
+        return _CONTROL_CLASSES.get(element.control_type, Control)(element=element)
+
+    @property
+    def Element(self):
+        if self._element is None:
+            self.Refind()
+        elif not self._element.alive:
+            raise LookupError(f"Element not available: {self.searchProperties}")
+        return self._element
+
+    def Refind(self, maxSearchSeconds=0, searchIntervalSeconds=0, raiseException=True):
+        start = self.searchFromControl.Element if self.searchFromControl else desktop.root
+        node = desktop.find(start, self.ControlTypeName, self.searchProperties, self.searchDepth, self.foundIndex)
+        if node is None:
+            if raiseException:
+                raise LookupError(f"Find Control Timeout: {self.ControlTypeName} {self.searchProperties}")
+            return False
+        self._element = node
+        return True
+
+    def Exists(self, maxSearchSeconds=5, searchIntervalSeconds=0.5, printIfNotExist=False):
+        if self._element is not None and self._element.alive:
+            desktop.charge()
+            return True
+        self._element = None
+        deadline = _perf_counter() + maxSearchSeconds
+        while True:
+            if self.Refind(raiseException=False):
+                return True
+            if _perf_counter() >= deadline:
+                return False
+            _sleep(searchIntervalSeconds)
+
+    def GetRuntimeId(self):
+        element = self.Element
+        desktop.charge()
+        return [42, element.runtime_id]
+
+    @property
+    def Name(self):
+        element = self.Element
+        desktop.charge()
+        return element.name
+
+    @property
+    def ControlType(self):
+        element = self.Element
+        desktop.charge()
+        return element.control_type
+
+    @property
+    def NativeWindowHandle(self):
+        element = self.Element
+        desktop.charge()
+        return element.runtime_id if element.control_type == "WindowControl" else 0
+
+    def GetPosition(self, ratioX=0.5, ratioY=0.5):
+        element = self.Element
+        desktop.charge()
+        return element.position()
+
+    def GetParentControl(self):
+        element = self.Element
+        desktop.charge()
+        return Control.CreateControlFromElement(element.parent)
+
+    def GetChildren(self):
+        element = self.Element
+        children = element.children
+        # 一次 GetFirstChild，加上每个子控件一次 GetNextSibling
+        desktop.charge(len(children) + 1)
+        return [Control.CreateControlFromElement(child) for child in children]
+
+    def GetFirstChildControl(self):
+        element = self.Element
+        desktop.charge()
+        children = element.children
+        return Control.CreateControlFromElement(children[0]) if children else None
+
+    def GetLastChildControl(self):
+        element = self.Element
+        desktop.charge()
+        children = element.children
+        return Control.CreateControlFromElement(children[-1]) if children else None
+
+    def GetNextSiblingControl(self):
+        element = self.Element
+        desktop.charge()
+        siblings = element.parent.children if element.parent else []
+        for i, sibling in enumerate(siblings[:-1]):
+            if sibling is element:
+                return Control.CreateControlFromElement(siblings[i + 1])
+        return None
+
+    def GetPreviousSiblingControl(self):
+        element = self.Element
+        desktop.charge()
+        siblings = element.parent.children if element.parent else []
+        for i, sibling in enumerate(siblings[1:], 1):
+            if sibling is element:
+                return Control.CreateControlFromElement(siblings[i - 1])
+        return None
+
+    def GetScrollPattern(self):
+        element = self.Element
+        desktop.charge()
+        return element.scroll
+
+    def GetValuePattern(self):
+        element = self.Element
+        desktop.charge()
+        return types.SimpleNamespace(Value=element.value or "")
+
+    def SetFocus(self):
+        desktop.focus = self.Element
+        desktop.charge()
+        return True
+
+    def SendKeys(self, text, interval=0.01, waitTime=0.01, charMode=True):
+        self.SetFocus()
+        desktop.send_keys(text)
+
+    def Click(self, x=None, y=None, ratioX=0.5, ratioY=0.5, simulateMove=True, waitTime=0.5):
+        Click(*self.GetPosition())
+
+    def DoubleClick(self, x=None, y=None, ratioX=0.5, ratioY=0.5, simulateMove=True, waitTime=0.5):
+        element = self.Element
+        desktop.charge()
+        desktop.stats.clicks += 2
+        if element.on_double_click:
+            element.on_double_click(element)
+        elif element.on_click:
+            element.on_click(element)
+
+    def RightClick(self, x=None, y=None, ratioX=0.5, ratioY=0.5, simulateMove=True, waitTime=0.5):
+        RightClick(*self.GetPosition())
+
+    def __getattr__(self, item):
+        # 支持 control.ButtonControl(Name=...) 这样的子控件搜索
+        cls = _CONTROL_CLASSES.get(item)
+        if cls is None:
+            raise AttributeError(item)
+        return lambda **kwargs: cls(searchFromControl=self, **kwargs)
+
+
+class WindowControl(Control):
+    ControlTypeName = "WindowControl"
+
+    def SetActive(self, waitTime=0.5):
+        desktop.foreground = self.Element
+        desktop.charge()
+        return True
+
+    SwitchToThisWindow = SetActive
+
+
+_CONTROL_CLASSES = {"WindowControl": WindowControl}
+for _type in ("PaneControl", "EditControl", "ButtonControl", "ListControl",
+              "ListItemControl", "TextControl", "TabItemControl", "MenuItemControl", "MenuControl",
+              "DocumentControl", "ImageControl"):
+    _CONTROL_CLASSES[_type] = type(_type, (Control,), {"ControlTypeName": _type})
+    globals()[_type] = _CONTROL_CLASSES[_type]
+# Control 基类本身不限定控件类型
+_CONTROL_CLASSES["Control"] = Control
+
+# uiautomation.ControlType 中的控件类型 id
+ControlTypeIds = {
+    "ButtonControl": 50000, "EditControl": 50004, "ImageControl": 50006, "ListItemControl": 50007,
+    "ListControl": 50008, "MenuControl": 50009, "MenuItemControl": 50011, "TabItemControl": 50019,
+    "TextControl": 50020, "DocumentControl": 50030, "WindowControl": 50032, "PaneControl": 50033,
+}
+ControlType = types.SimpleNamespace(**ControlTypeIds)
+ControlTypeNames = {v: k for k, v in ControlTypeIds.items()}
+PropertyId = types.SimpleNamespace(ControlTypePropertyId=30003, NamePropertyId=30005)
+TreeScope = types.SimpleNamespace(Element=1, Children=2, Descendants=4, Subtree=7)
+
+
+class SimCacheRequest:
+    """IUIAutomationCacheRequest：BuildUpdatedCache 时一次性取回的属性和范围"""
+
+    def __init__(self):
+        self.properties = []
+        self.TreeScope = TreeScope.Element
+
+    def AddProperty(self, property_id):
+        self.properties.append(property_id)
+
+
+class SimCachedElement:
+    """BuildUpdatedCache 返回的元素，只能读取缓存中的属性"""
+
+    def __init__(self, node, scope):
+        self._node = node
+        self._scope = scope
+        self.CachedName = node.name
+        self.CachedControlType = ControlTypeIds.get(node.control_type, 0)
+
+    def GetCachedChildren(self):
+        if not self._scope & TreeScope.Children:
+            raise ValueError("Children are not cached")
+        # Subtree 包含所有后代，Children 只包含直接子控件
+        scope = self._scope if self._scope & TreeScope.Descendants else TreeScope.Element
+        children = [SimCachedElement(child, scope) for child in self._node.children]
+        return SimElementArray(children) if children else None
+
+
+class SimElementArray:
+    def __init__(self, elements):
+        self._elements = elements
+        self.Length = len(elements)
+
+    def GetElement(self, index):
+        return self._elements[index]
+
+
+class SimAutomation:
+    def CreateCacheRequest(self):
+        return SimCacheRequest()
+
+
+class _AutomationClient:
+    _instance = None
+
+    def __init__(self):
+        self.IUIAutomation = SimAutomation()
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+
+def SetCursorPos(x, y):
+    desktop.cursor = (x, y)
+
+
+def Click(x, y, waitTime=0.5):
+    desktop.cursor = (x, y)
+    desktop.stats.clicks += 1
+    node = desktop.node_at(x, y)
+    if node is None:
+        return
+    if node.on_keys:
+        desktop.focus = node
+    if node.on_click:
+        node.on_click(node)
+
+
+def RightClick(x, y, waitTime=0.5):
+    desktop.cursor = (x, y)
+    desktop.stats.clicks += 1
+    node = desktop.node_at(x, y)
+    if node is not None and node.on_right_click:
+        node.on_right_click(node)
+
+
+def SendKeys(text, interval=0.01, waitTime=0.01, charMode=True, debug=False):
+    desktop.send_keys(text)
+
+
+def GetRootControl():
+    return PaneControl(element=desktop.root)
+
+
+def ControlFromHandle(handle):
+    node = SimNode.registry.get(handle)
+    if node is None or not node.alive or node.control_type != "WindowControl":
+        return None
+    desktop.charge()
+    return Control.CreateControlFromElement(node)
+
+
+def GetForegroundControl():
+    desktop.charge()
+    return Control.CreateControlFromElement(desktop.foreground)
+
+
+def GetFocusedControl():
+    desktop.charge()
+    return Control.CreateControlFromElement(desktop.focus)
+
+
+# ---------------------------------------------------------------------------
+# 模拟的微信客户端
+# ---------------------------------------------------------------------------
+
+class SimChat:
+    """一个聊天窗口：完整的历史记录以及当前已加载到消息列表中的数量"""
+
+    def __init__(self, name, messages=None, is_group=False, pictures=None):
+        self.name = name
+        self.is_group = is_group
+        # 聊天记录中的图片和视频（从旧到新），元素为本地文件路径，.mp4 为视频，文件不存在表示已被清理
+        self.pictures = list(pictures or [])
+        # 元素为三元组（消息类型，发送人，内容），类型取值见 MSG_*
+        self.messages = list(messages or [])
+        self.loaded = 0
+        # 点击“查看更多消息”之后还没有加载出来的一页：（加载完成的时间，加载后的数量）
+        self.pending = None
+        # 每条消息对应的控件，保证同一条消息的 runtime id 不变
+        self.nodes = {}
+        # 会话列表中显示的未读消息数
+        self.unread = 0
+
+
+class SimWeChatApp:
+    """
+    模拟的微信客户端界面，控件的深度与名称和 ui_auto_wechat 中的注释保持一致：
+    搜索框 EditControl depth 8、聊天记录 ListControl depth 12、
+    聊天标题 ButtonControl depth 14、发送按钮 ButtonControl depth 15。
+    """
+
+    def __init__(self, chats=None, me="我", page_size=20, locale=None, search_delay=0.0,
+                 contacts=None, visible_rows=12, history_delay=0.0):
+        from .wechat_locale import WeChatLocale
+
+        self.lc = locale or WeChatLocale("zh-CN")
+        self.me = me
+        self.page_size = page_size
+        self.chats = {}
+        for chat in chats or [SimChat("文件传输助手")]:
+            self.chats[chat.name] = chat
+        # 会话列表中的顺序，最近有消息的聊天排在最前面
+        self.sessions = list(self.chats)
+        self.current = None
+        self.search_text = ""
+        # 粘贴搜索内容之后，经过 search_delay 秒搜索结果才会出现
+        self.search_delay = search_delay
+        self.search_started = 0.0
+        # 点击“查看更多消息”之后，经过 history_delay 秒更早的消息才会出现
+        self.history_delay = history_delay
+        self.draft = ""
+        # 通讯录中的联系人，元素为二元组（昵称，备注）
+        self.contacts = list(contacts or [])
+        # 通讯录管理界面一屏显示的行数，只有可见的行才有控件
+        self.visible_rows = visible_rows
+        self.manager = None
+        self.manager_mode = "contacts"
+        # 聊天记录窗口：图片列表一屏显示的数量，以及最新的图片下面隐藏的数量
+        self.history_window = None
+        self.menu = None
+        self.picture_offset = 0
+        self._picture_nodes = {}
+        self._manager_nodes = {}
+        self.window = None
+        self.desktop = None
+
+    def attach(self, desktop):
+        self.desktop = desktop
+
+    def add_chat(self, name, messages=None, is_group=False):
+        self.chats[name] = SimChat(name, messages, is_group)
+        self._touch(name)
+        return self.chats[name]
+
+    def _touch(self, name):
+        if name in self.sessions:
+            self.sessions.remove(name)
+        self.sessions.insert(0, name)
+
+    def receive(self, name, text, sender=None):
+        """
+        收到一条新消息：聊天移到会话列表的最前面；该聊天没有打开时会话列表中显示未读消息数
+        """
+        chat = self.chats[name]
+        chat.messages.append((MSG_USER, sender or name, text))
+        if chat is self.current:
+            chat.loaded += 1
+        else:
+            chat.unread += 1
+        self._touch(name)
+
+    # -- 窗口生命周期 -------------------------------------------------------
+
+    def open(self):
+        """创建微信主窗口（相当于启动 WeChat.exe）"""
+        if self.window is not None and self.window.alive:
+            return self.window
+        self.window = self._build_window()
+        self.desktop.root.add(self.window)
+        self.desktop.foreground = self.window
+        return self.window
+
+    def close(self):
+        self.close_manager()
+        self.close_history()
+        if self.window is not None:
+            self.window.kill()
+            self.desktop.root._children.remove(self.window)
+            self.window = None
+        self.current = None
+
+    def restart(self):
+        """重建所有控件，之前缓存的控件全部失效"""
+        self.close()
+        for chat in self.chats.values():
+            chat.nodes = {}
+        return self.open()
+
+    # -- 控件树 ------------------------------------------------------------
+
+    @staticmethod
+    def _chain(parent, n):
+        """在 parent 下面嵌套 n 层无名的 PaneControl，返回最内层的 PaneControl"""
+        for _ in range(n):
+            parent = parent.add(SimNode("PaneControl"))
+        return parent
+
+    def _build_window(self):
+        lc = self.lc
+        window = SimNode("WindowControl", lc.weixin, class_name="WeChatMainWndForPC")
+
+        # 左侧导航栏 depth 2-4
+        nav = self._chain(window, 2)
+        self.chats_button = nav.add(SimNode("ButtonControl", lc.chats))
+        self.contacts_button = nav.add(SimNode("ButtonControl", lc.contacts))
+
+        # 搜索框 depth 8
+        search_parent = self._chain(window, 6)
+        self.search_box = search_parent.add(SimNode("EditControl", lc.search, value="",
+                                                    on_keys=self._on_search_keys))
+        self.search_result_list = search_parent.add(SimNode("ListControl", lc.search_result))
+        self.search_result_list.provider = self._search_result_items
+        self._search_result_nodes = {}
+
+        # 聊天记录、标题与发送按钮
+        chat_panel = self._chain(window, 10)
+        self.message_list = chat_panel.add(SimNode("ListControl", lc.message,
+                                                   scroll=SimScroll(view_size=100.0)))
+        self.message_list.provider = self._message_items
+        header = self._chain(chat_panel, 2)
+        self.title_button = header.add(SimNode("ButtonControl", ""))
+        self.history_button = header.add(SimNode("ButtonControl", lc.chat_history,
+                                                 on_click=lambda _: self.open_history()))
+        editor = self._chain(chat_panel, 3)
+        self.input_box = editor.add(SimNode("EditControl", "", value="", on_keys=self._on_input_keys))
+        self.send_button = editor.add(SimNode("ButtonControl", lc.send, on_click=self._on_send))
+
+        # 通讯录列表及其顶部的“通讯录管理”按钮
+        contact_panel = self._chain(window, 4)
+        self.contact_list = contact_panel.add(SimNode("ListControl", lc.contact, scroll=SimScroll()))
+        self.contact_list.add(SimNode("ButtonControl", lc.manage_contacts, on_click=lambda _: self.open_manager()))
+
+        # 左侧会话列表 ListControl depth 9，会话 ListItemControl depth 10
+        session_panel = self._chain(window, 8)
+        self.session_list = session_panel.add(SimNode("ListControl", lc.session))
+        self.session_list.provider = self._session_items
+        return window
+
+    # -- 聊天记录窗口 ------------------------------------------------------
+
+    def _add_window(self, window):
+        self.desktop.root.add(window)
+        self.desktop.foreground = window
+        return window
+
+    def _remove_window(self, window):
+        if window is not None:
+            window.kill()
+            if window in self.desktop.root._children:
+                self.desktop.root._children.remove(window)
+
+    def open_history(self):
+        """打开当前聊天的聊天记录窗口：图片与视频标签 depth 6，图片列表 depth 6"""
+        self.close_history()
+        lc = self.lc
+        window = SimNode("WindowControl", lc.chat_history)
+        panel = self._chain(window, 4)
+        panel.add(SimNode("TabItemControl", lc.photos_n_videos))
+        self.picture_list = panel.add(SimNode("ListControl", lc.photos_n_videos))
+        self.picture_list.provider = self._picture_items
+        self.picture_offset = 0
+        self._picture_nodes = {}
+        self.history_window = self._add_window(window)
+        return window
+
+    def close_history(self):
+        self.close_menu()
+        self._remove_window(self.history_window)
+        self.history_window = None
+
+    def _picture_items(self):
+        pictures = self.current.pictures if self.current else []
+        end = len(pictures) - self.picture_offset
+        items = []
+        for index in range(max(0, end - self.visible_rows), end):
+            node = self._picture_nodes.get(index)
+            if node is None:
+                path = pictures[index]
+                # 视频的缩略图下面还有时长等两个控件
+                content = [SimNode("ImageControl")]
+                if path.endswith(".mp4"):
+                    content += [SimNode("TextControl", "00:10"), SimNode("TextControl", "")]
+                node = SimNode("ListItemControl", children=[SimNode("PaneControl", children=content)],
+                               on_right_click=lambda _, p=path: self.open_menu(p))
+                self._picture_nodes[index] = node
+            items.append(node)
+        return items
+
+    def scroll_pictures(self, clicks):
+        """鼠标滚轮向上滚动 clicks 时，图片列表往前翻 clicks // 30 张"""
+        if self.history_window is None or self.current is None:
+            return
+        hidden = max(0, len(self.current.pictures) - self.visible_rows)
+        self.picture_offset = min(hidden, max(0, self.picture_offset + clicks // 30))
+
+    def open_menu(self, path):
+        """右键菜单，菜单列表 depth 4；图片已被清理时第一项不是“复制”"""
+        self.close_menu()
+        menu = SimNode("WindowControl", class_name="CMenuWnd")
+        items = self._chain(menu, 2).add(SimNode("ListControl"))
+        if os.path.exists(path):
+            items.add(SimNode("MenuItemControl", self.lc.copy, on_click=lambda _: self._copy_file(path)))
+        else:
+            items.add(SimNode("MenuItemControl", "定位到聊天位置"))
+        self.menu = self._add_window(menu)
+
+    def close_menu(self):
+        self._remove_window(self.menu)
+        self.menu = None
+
+    def _copy_file(self, path):
+        self.desktop.clipboard = {"files": [path]}
+        self.close_menu()
+
+    # -- 通讯录管理 --------------------------------------------------------
+
+    def open_manager(self):
+        """打开通讯录管理窗口，列表只为当前可见的行创建控件"""
+        self.close_manager()
+        self.manager_mode = "contacts"
+        self._manager_nodes = {}
+        manager = SimNode("WindowControl", self.lc.manage_contacts)
+        sidebar = self._chain(manager, 2)
+        sidebar.add(SimNode("ButtonControl", "最近群聊", on_click=lambda _: self._switch_manager("groups")))
+        rows = self._chain(manager, 2).add(SimNode("ListControl", scroll=SimScroll(view_size=100.0)))
+        rows.provider = self._manager_items
+        self.manager_list = rows
+        self._update_view_size()
+        self.manager = manager
+        self.desktop.root.add(manager)
+        self.desktop.foreground = manager
+        return manager
+
+    def close_manager(self):
+        if self.manager is not None:
+            self.manager.kill()
+            self.desktop.root._children.remove(self.manager)
+            self.manager = None
+
+    def _switch_manager(self, mode):
+        self.manager_mode = mode
+        self.manager_list.scroll.VerticalScrollPercent = 0.0
+        self._update_view_size()
+
+    def _manager_entries(self):
+        if self.manager_mode == "groups":
+            return [chat.name for chat in self.chats.values() if chat.is_group]
+        return self.contacts
+
+    def _update_view_size(self):
+        total = len(self._manager_entries())
+        self.manager_list.scroll.VerticalViewSize = min(100.0, 100.0 * self.visible_rows / total) if total else 100.0
+
+    def _manager_items(self):
+        entries = self._manager_entries()
+        hidden = max(0, len(entries) - self.visible_rows)
+        top = round(self.manager_list.scroll.VerticalScrollPercent / 100 * hidden)
+        items = []
+        for index in range(top, min(len(entries), top + self.visible_rows)):
+            key = (self.manager_mode, index)
+            node = self._manager_nodes.get(key)
+            if node is None:
+                if self.manager_mode == "groups":
+                    # 群聊名称中的空格显示为顿号
+                    node = SimNode("ListItemControl", children=[SimNode("TextControl", entries[index].replace(" ", "、"))])
+                else:
+                    nickname, note = entries[index]
+                    node = SimNode("ListItemControl", children=[
+                        SimNode("ButtonControl"), SimNode("TextControl", nickname), SimNode("ButtonControl", note),
+                    ])
+                self._manager_nodes[key] = node
+            items.append(node)
+        return items
+
+    def _message_node(self, chat, index):
+        node = chat.nodes.get(index)
+        if node is not None:
+            return node
+        kind, sender, text = chat.messages[index]
+        if kind == MSG_TIME:
+            node = SimNode("ListItemControl", text, [SimNode("TextControl", text)])
+        elif kind == MSG_USER:
+            content = SimNode("PaneControl", children=[SimNode("TextControl", text)])
+            node = SimNode("ListItemControl", text, [
+                SimNode("PaneControl", children=[SimNode("ButtonControl", sender), content]),
+            ])
+        else:
+            node = SimNode("ListItemControl", text, [SimNode("PaneControl", children=[SimNode("PaneControl")])])
+        chat.nodes[index] = node
+        return node
+
+    def _load_more_node(self, chat):
+        node = chat.nodes.get(LOAD_MORE)
+        if node is None:
+            node = SimNode("ListItemControl", LOAD_MORE,
+                           [SimNode("PaneControl", children=[SimNode("PaneControl")])],
+                           on_click=lambda _: self.load_more(chat))
+            chat.nodes[LOAD_MORE] = node
+        return node
+
+    def _session_items(self):
+        """
+        会话列表中可见的行。有未读消息时行内第一个 PaneControl 有 3 个子控件（头像、未读数、内容），
+        与 WeChat.check_new_msg 的判断一致；内容中最后一个 TextControl 为最后一条消息的预览
+        """
+        items = []
+        for name in self.sessions[:self.visible_rows]:
+            chat = self.chats[name]
+            preview = chat.messages[-1][2] if chat.messages else ""
+            row = [SimNode("ButtonControl", name)]
+            if chat.unread:
+                row.append(SimNode("TextControl", str(chat.unread)))
+            row.append(SimNode("PaneControl", children=[
+                SimNode("PaneControl", children=[SimNode("TextControl", name), SimNode("TextControl", "12:00")]),
+                SimNode("PaneControl", children=[SimNode("TextControl", preview)]),
+            ]))
+            items.append(SimNode("ListItemControl", name, [SimNode("PaneControl", children=row)],
+                                 on_click=lambda _, n=name: self.open_chat(n)))
+        return items
+
+    def _message_items(self):
+        chat = self.current
+        if chat is None:
+            return []
+        if chat.pending is not None and _perf_counter() >= chat.pending[0]:
+            chat.loaded, chat.pending = chat.pending[1], None
+        total = len(chat.messages)
+        items = [self._message_node(chat, i) for i in range(total - chat.loaded, total)]
+        if chat.loaded < total:
+            items.insert(0, self._load_more_node(chat))
+        return items
+
+    # -- 交互 --------------------------------------------------------------
+
+    def load_more(self, chat):
+        loaded = min(len(chat.messages), chat.loaded + self.page_size)
+        if self.history_delay > 0:
+            if chat.pending is None:
+                chat.pending = (_perf_counter() + self.history_delay, loaded)
+        else:
+            chat.loaded = loaded
+
+    def search_results(self):
+        if not self.search_text or _perf_counter() < self.search_started + self.search_delay:
+            return []
+        return [name for name in self.chats if self.search_text in name]
+
+    def _search_result_items(self):
+        items = []
+        for name in self.search_results():
+            if name not in self._search_result_nodes:
+                self._search_result_nodes[name] = SimNode("ListItemControl", name)
+            items.append(self._search_result_nodes[name])
+        return items
+
+    def open_chat(self, name):
+        chat = self.chats[name]
+        self.current = chat
+        chat.unread = 0
+        chat.loaded = min(len(chat.messages), self.page_size)
+        chat.pending = None
+        self.title_button.name = name
+        self.input_box.name = name
+        self.draft = ""
+        self.input_box.value = ""
+        self.desktop.focus = self.input_box
+
+    def _on_search_keys(self, keys):
+        if keys == "{Ctrl}v":
+            self.search_text = self.desktop.clipboard.get("text", "")
+            self.search_started = _perf_counter()
+            self.search_box.value = self.search_text
+        elif keys.lower() == "{enter}":
+            results = self.search_results()
+            if results:
+                self.open_chat(results[0])
+            self.search_text = ""
+            self.search_box.value = ""
+
+    def _on_input_keys(self, keys):
+        if keys == "{Ctrl}v":
+            clipboard = self.desktop.clipboard
+            if "files" in clipboard:
+                self.draft += "".join(f"[文件]{path}\n" for path in clipboard["files"])
+            else:
+                self.draft += clipboard.get("text", "")
+        else:
+            # 其余按键只保留文本部分，{enter} 等控制键忽略
+            text = keys
+            while "{" in text and "}" in text:
+                start = text.index("{")
+                text = text[:start] + text[text.index("}", start) + 1:]
+            self.draft += text
+        self.input_box.value = self.draft
+
+    def _on_send(self, _node):
+        if self.current is None or not self.draft:
+            return
+        chat = self.current
+        if self.draft.startswith("[文件]"):
+            sent = [line for line in self.draft.split("\n") if line]
+        else:
+            sent = [self.draft]
+        for text in sent:
+            chat.messages.append((MSG_USER, self.me, text))
+        chat.loaded += len(sent)
+        self._touch(chat.name)
+        self.draft = ""
+        self.input_box.value = ""
+
+
+# ---------------------------------------------------------------------------
+# 其他只能在 Windows 桌面使用的依赖
+# ---------------------------------------------------------------------------
+
+class _QApplication:
+    """与 PyQt5 一样，进程内只保留一个 QApplication，通过 instance() 取得"""
+    _instance = None
+
+    def __init__(self, *args):
+        _QApplication._instance = self
+
+    @staticmethod
+    def instance():
+        return _QApplication._instance
+
+
+def _fake_modules():
+    uia = types.ModuleType("uiautomation")
+    for name in ("Control", "SetCursorPos", "Click", "RightClick", "SendKeys", "GetRootControl",
+                 "ControlFromHandle", "GetForegroundControl", "GetFocusedControl"):
+        setattr(uia, name, globals()[name])
+    for name, cls in _CONTROL_CLASSES.items():
+        setattr(uia, name, cls)
+    for name in ("ControlType", "ControlTypeNames", "PropertyId", "TreeScope", "_AutomationClient"):
+        setattr(uia, name, globals()[name])
+
+    pyperclip = types.ModuleType("pyperclip")
+
+    def copy(text):
+        desktop.clipboard = {"text": str(text)}
+
+    pyperclip.copy = copy
+    pyperclip.paste = lambda: desktop.clipboard.get("text", "")
+
+    win32clipboard = types.ModuleType("win32clipboard")
+    win32clipboard.CF_HDROP = 15
+    win32clipboard.OpenClipboard = lambda *args: None
+    win32clipboard.CloseClipboard = lambda: None
+    win32clipboard.EmptyClipboard = lambda: desktop.clipboard.clear()
+
+    def set_clipboard_data(fmt, data):
+        # DROPFILES 结构体之后是以 \0 分隔、UTF-16 编码的文件列表
+        offset = int.from_bytes(data[:4], "little")
+        files = data[offset:].decode("utf-16-le").split("\0")
+        desktop.clipboard = {"files": [f for f in files if f]}
+
+    win32clipboard.SetClipboardData = set_clipboard_data
+    win32clipboard.GetClipboardData = lambda fmt=None: tuple(desktop.clipboard.get("files", ()))
+
+    pyautogui = types.ModuleType("pyautogui")
+    pyautogui.scroll = lambda clicks, x=None, y=None: desktop.app.scroll_pictures(clicks)
+
+    image_grab = types.ModuleType("PIL.ImageGrab")
+    image_grab.grabclipboard = lambda: list(desktop.clipboard["files"]) if "files" in desktop.clipboard else None
+    pil = types.ModuleType("PIL")
+    pil.ImageGrab = image_grab
+    pil.__path__ = []
+
+    comtypes = types.ModuleType("comtypes")
+    comtypes.CoInitialize = lambda: None
+    comtypes.CoUninitialize = lambda: None
+
+    qt = types.ModuleType("PyQt5")
+    qt.__path__ = []
+    qt_widgets = types.ModuleType("PyQt5.QtWidgets")
+    qt_widgets.QApplication = _QApplication
+    qt.QtWidgets = qt_widgets
+
+    return {
+        "uiautomation": uia,
+        "pyperclip": pyperclip,
+        "win32clipboard": win32clipboard,
+        "pyautogui": pyautogui,
+        "PIL": pil,
+        "PIL.ImageGrab": image_grab,
+        "comtypes": comtypes,
+        "PyQt5": qt,
+        "PyQt5.QtWidgets": qt_widgets,
+    }
+
+
+def install(app=None, call_latency=0.0):
+    """
+    用模拟实现替换 Windows 专用的依赖模块，并在模拟桌面上打开一个微信窗口。
+    可以重复调用，每次调用都会重置模拟桌面。
+    """
+    if not isinstance(sys.modules.get("uiautomation"), types.ModuleType) or \
+            getattr(sys.modules["uiautomation"], "GetRootControl", None) is not GetRootControl:
+        sys.modules.update(_fake_modules())
+    return _main_desktop.reset(app, call_latency=call_latency)
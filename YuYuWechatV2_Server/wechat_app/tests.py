@@ -1,3 +1,1289 @@
+import contextlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import types
+import zipfile
+from functools import partial
+from queue import Empty
+from unittest import mock
+
 from django.test import TestCase
+from django.urls import reverse
+
+from . import benchmark, simulator
+
+# 使用模拟的微信客户端，测试可以在没有微信的 Linux 上运行
+desktop = simulator.install()
+
+from . import ui_auto_wechat, views  # noqa: E402
+from .autoreply import AutoReplyEngine, Rule  # noqa: E402
+from .directory import Directory, NameIndex  # noqa: E402
+from .idempotency import IdempotencyIndex  # noqa: E402
+from .executor import UIExecutor  # noqa: E402
+from .jobs import Job, JobStore  # noqa: E402
+from .metrics import Tracer, job_trace  # noqa: E402
+from .models import DirectoryEntry  # noqa: E402
+from .pacing import Pacer  # noqa: E402
+from .pictures import zip_stream  # noqa: E402
+from .scheduler import LaneQueue  # noqa: E402
+from .ui_auto_wechat import ConversationTracker, WeChat, wait_until  # noqa: E402
+from .watcher import MessageWatcher  # noqa: E402
+
+# 发送限速在 PacingTests 中单独测试，其他测试中不限速
+views.accounts.pacing = None
+views.accounts.default.queue.pacer = None
+
+# 每个任务的 trace 日志（见 settings.LOGGING）在测试中不输出
+logging.getLogger('wechat_app.metrics').setLevel(logging.WARNING)
+
+
+class ControlCacheTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def test_cached_control_is_reused(self):
+        self.wechat.press_enter()
+        searches = self.desktop.stats.searches
+        self.wechat.press_enter()
+
+        self.assertEqual(self.desktop.stats.searches, searches)
+        self.assertEqual(self.wechat.controls.stats()['hits'], 1)
+        # 发送按钮和它所在的主窗口各搜索一次
+        self.assertEqual(self.wechat.controls.stats()['misses'], 2)
+
+    def test_stale_control_is_searched_again(self):
+        first = self.wechat._search_box()
+        self.desktop.app.restart()
+        second = self.wechat._search_box()
+
+        self.assertIsNot(first, second)
+        self.assertTrue(second.Exists(0, 0))
+        self.assertEqual(self.wechat.controls.misses, 4)
+
+    def test_disabled_cache_always_searches(self):
+        self.wechat.controls.enabled = False
+        self.wechat._search_box()
+        self.wechat._search_box()
+
+        self.assertEqual(self.wechat.controls.misses, 4)
+        self.assertEqual(self.desktop.stats.searches, 4)
+
+    def test_controls_are_searched_within_the_account_window(self):
+        # 另一个账号的窗口排在前面，其中有同名、同深度的搜索框
+        other = simulator.SimNode("WindowControl", "微信")
+        simulator.SimWeChatApp._chain(other, 6).add(simulator.SimNode("EditControl", self.wechat.lc.search))
+        self.desktop.root._children.insert(0, other)
+        self.wechat.window_handle = self.desktop.app.window.runtime_id
+
+        self.assertIs(self.wechat._search_box().Element, self.desktop.app.search_box)
+
+
+class WindowActivatorTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.wechat = WeChat(path="WeChat.exe", launcher=self.desktop.launch)
+
+    def test_existing_window_is_never_relaunched(self):
+        for i in range(1000):
+            self.assertTrue(self.wechat.send_msg("文件传输助手", f"消息{i}"))
+
+        self.assertEqual(self.desktop.stats.launches, 0)
+        self.assertEqual(self.wechat.activator.stats(), {'activations': 1000, 'launches': 0})
+
+    def test_missing_window_is_launched_once(self):
+        self.desktop.app.close()
+        self.wechat.prevent_offline()
+        self.wechat.prevent_offline()
+
+        self.assertEqual(self.desktop.stats.launches, 1)
+        self.assertEqual(self.wechat.activator.stats(), {'activations': 1, 'launches': 1})
+
+
+class ConversationTrackerTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        self.wechat = WeChat(path="WeChat.exe", launcher=self.desktop.launch)
+
+    def test_repeat_sends_skip_search(self):
+        self.wechat.send_msg("好友", "第一条")
+        self.wechat.send_msg("好友", "第二条")
+        dialogs = self.wechat.get_dialogs("好友", 2)
+
+        self.assertEqual([d[2] for d in dialogs], ["第一条", "第二条"])
+        self.assertEqual(self.wechat.conversation.stats(), {
+            'get_dialogs': {'searched': 0, 'skipped': 1},
+            'send_msg': {'searched': 1, 'skipped': 1},
+        })
+
+    def test_other_operation_invalidates_tracker(self):
+        self.wechat.send_msg("好友", "第一条")
+        self.wechat.prevent_offline()
+        self.wechat.send_msg("好友", "第二条")
+
+        self.assertEqual(self.wechat.conversation.stats()['send_msg'], {'searched': 2, 'skipped': 0})
+
+    def test_title_mismatch_searches_again(self):
+        self.wechat.send_msg("好友", "第一条")
+        # 用户手动切换到了其他聊天
+        self.desktop.app.open_chat("文件传输助手")
+        self.wechat.send_msg("好友", "第二条")
+
+        self.assertEqual(self.wechat.conversation.stats()['send_msg'], {'searched': 2, 'skipped': 0})
+        self.assertEqual(self.desktop.app.chats["好友"].messages[-1][2], "第二条")
+
+
+class ConditionWaitTests(TestCase):
+    def test_wait_until_returns_as_soon_as_condition_holds(self):
+        calls = []
+        ok, elapsed = wait_until(lambda: calls.append(1) or len(calls) >= 3, timeout=1.0)
+
+        self.assertTrue(ok)
+        self.assertEqual(len(calls), 3)
+        self.assertLess(elapsed, 0.5)
+
+    def test_wait_until_times_out(self):
+        ok, elapsed = wait_until(lambda: False, timeout=0.05)
+
+        self.assertFalse(ok)
+        self.assertGreaterEqual(elapsed, 0.05)
+
+    def test_search_waits_for_results_and_records_wait_time(self):
+        desktop = simulator.install(simulator.SimWeChatApp(search_delay=0.05))
+        desktop.app.add_chat("好友")
+        wechat = WeChat(path="WeChat.exe")
+
+        self.assertTrue(wechat.send_msg("好友", "你好"))
+        stats = wechat.waits.stats()
+        self.assertEqual(stats['search']['timeouts'], 0)
+        self.assertGreaterEqual(stats['search']['max'], 0.05)
+        # 粘贴之前输入框已经获得焦点
+        self.assertEqual(stats['chat']['count'], 1)
+        self.assertEqual(stats['chat']['timeouts'], 0)
+        self.assertEqual(stats['paste']['count'], 1)
+
+
+class SendBatchViewTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友A")
+        self.desktop.app.add_chat("好友B")
+        views.wechat.conversation = ConversationTracker()
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_items_are_grouped_by_recipient(self):
+        items = [
+            {'name': '好友A', 'text': 'A1'},
+            {'name': '好友B', 'text': 'B1'},
+            {'name': '好友A', 'text': 'A2'},
+            {'name': '好友B', 'text': 'B2'},
+        ]
+        response = self.post(reverse('send_batch'), {'items': items})
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['recipients'], 2)
+        self.assertEqual([(r['index'], r['name'], r['status']) for r in body['results']], [
+            (0, '好友A', 'Message sent'), (1, '好友B', 'Message sent'),
+            (2, '好友A', 'Message sent'), (3, '好友B', 'Message sent'),
+        ])
+        # 每个联系人只搜索一次
+        self.assertEqual(views.wechat.conversation.stats()['send_batch'], {'searched': 2, 'skipped': 0})
+        self.assertEqual([m[2] for m in self.desktop.app.chats['好友A'].messages], ['A1', 'A2'])
+
+    def test_batch_is_split_into_paced_jobs(self):
+        pacer = Pacer(per_minute=6000, burst=2, min_gap=0, jitter=0)
+        views.accounts.default.queue.pacer = pacer
+        self.addCleanup(setattr, views.accounts.default.queue, 'pacer', None)
+        executed = views.ui_executor.executed
+        items = [{'name': '好友A', 'text': f'A{i}'} for i in range(5)] + [{'name': '好友B', 'text': 'B0'}]
+
+        body = self.post(reverse('send_batch'), {'items': items}).json()
+
+        self.assertEqual((body['recipients'], body['sent'], body['failed']), (2, 6, 0))
+        self.assertEqual([r['index'] for r in body['results']], list(range(6)))
+        # 好友A 的 5 条按 burst 拆成 3 个任务，好友B 1 个任务，每个任务都不会透支预算
+        self.assertEqual(views.ui_executor.executed - executed, 4)
+        self.assertEqual(pacer.sent, 6)
+        self.assertGreaterEqual(pacer.tokens, -pacer.burst)
+        self.assertEqual([m[2] for m in self.desktop.app.chats['好友A'].messages], [f'A{i}' for i in range(5)])
+
+    def test_invalid_item_is_rejected(self):
+        response = self.post(reverse('send_batch'), {'items': [{'name': '好友A', 'text': 'x', 'file': 'y'}]})
+        self.assertEqual(response.status_code, 400)
+
+
+def wait_for_executor(timeout=5):
+    """等待执行线程处理完队列中的全部任务（包括发送后提交的校验任务）"""
+    return wait_until(lambda: views.message_queue.empty() and views.ui_executor.current is None, timeout)[0]
+
+
+class JobApiTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        views.wechat.conversation.invalidate()
+
+    def tearDown(self):
+        wait_for_executor()
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_async_send_returns_job_id(self):
+        response = self.post(reverse('send_message'), {'name': '文件传输助手', 'text': 'hi', 'async': True})
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json()['job_id']
+
+        views.job_store.get(job_id).wait(5)
+        response = self.client.get(reverse('job_status', args=[job_id]))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['status'], 'succeeded')
+        self.assertEqual(body['result']['status'], 'Message sent')
+        self.assertEqual(body['result']['name'], '文件传输助手')
+        self.assertIsNotNone(body['finished_at'])
+
+    def test_bulk_status_reports_missing_ids(self):
+        response = self.post(reverse('send_message'), {'name': '文件传输助手', 'text': 'hi', 'async': True})
+        job_id = response.json()['job_id']
+
+        response = self.post(reverse('jobs_status'), {'ids': [job_id, 'unknown']})
+        self.assertEqual([job['id'] for job in response.json()['jobs']], [job_id])
+        self.assertEqual(response.json()['missing'], ['unknown'])
+
+    def test_finished_jobs_are_bounded(self):
+        store = JobStore(max_finished=2, ttl=3600)
+        jobs = [store.add(Job('send_message', lambda: (True, {}))) for _ in range(3)]
+        for job in jobs:
+            job.run()
+            store.finished(job)
+
+        self.assertIsNone(store.get(jobs[0].id))
+        self.assertEqual(store.stats(), {'active': 0, 'finished': 2})
+
+
+class LaneQueueTests(TestCase):
+    def test_higher_lane_is_served_first(self):
+        queue = LaneQueue()
+        queue.put('broadcast-1', 'scheduled')
+        queue.put('keep-alive', 'background')
+        queue.put('manual', 'interactive')
+
+        self.assertEqual([queue.get(0), queue.get(0), queue.get(0)], ['manual', 'broadcast-1', 'keep-alive'])
+
+    def test_starving_lane_is_promoted(self):
+        queue = LaneQueue(lanes=(('interactive', None), ('background', 0.01)))
+        queue.put('keep-alive', 'background')
+        time.sleep(0.02)
+        queue.put('manual', 'interactive')
+
+        self.assertEqual(queue.get(0), 'keep-alive')
+        self.assertEqual(queue.stats()['background']['promoted'], 1)
+        self.assertEqual(queue.stats()['interactive']['depth'], 1)
+
+    def test_unknown_lane_is_rejected(self):
+        response = self.client.post(reverse('send_message'), json.dumps({'name': 'a', 'text': 'b', 'lane': 'vip'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class UIExecutorTests(TestCase):
+    def test_com_initialized_once_and_jobs_run_on_executor_thread(self):
+        initialized = []
+        executor = UIExecutor(initialize=lambda: initialized.append(threading.current_thread().name)).start()
+        jobs = [executor.submit('probe', lambda: (True, threading.current_thread().name)) for _ in range(3)]
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual(initialized, ['wechat-ui'])
+        self.assertEqual({job.result for job in jobs}, {'wechat-ui'})
+        self.assertEqual(executor.stats()['run_times']['probe']['count'], 3)
+
+    def test_get_dialogs_view_runs_on_background_lane(self):
+        desktop = simulator.install()
+        desktop.app.add_chat("好友", [(simulator.MSG_USER, "好友", "你好")])
+        background = views.message_queue.stats()['background']['dequeued']
+
+        response = self.client.post(reverse('get_dialogs'), json.dumps({'name': '好友', 'n_msg': 1}),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['dialogs'], [['用户发送', '好友', '你好']])
+        self.assertEqual(views.message_queue.stats()['background']['dequeued'], background + 1)
+
+
+class IncrementalDialogTests(TestCase):
+    def setUp(self):
+        history = [(simulator.MSG_USER, "好友", f"消息{i}") for i in range(20)]
+        self.desktop = simulator.install(simulator.SimWeChatApp([simulator.SimChat("好友", history)]))
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def test_second_read_only_walks_new_messages(self):
+        # 逐个控件读取时比较读取的控件数量
+        self.wechat.snapshots.enabled = False
+        full = self.wechat.get_dialogs("好友", 10)
+        self.desktop.app.chats["好友"].messages.append((simulator.MSG_USER, "好友", "新消息"))
+        self.desktop.app.chats["好友"].loaded += 1
+
+        calls = self.desktop.stats.calls
+        dialogs = self.wechat.get_dialogs("好友", 10, search_user=False)
+        incremental_calls = self.desktop.stats.calls - calls
+
+        self.assertEqual(dialogs, full[1:] + [('用户发送', '好友', '新消息')])
+        self.assertEqual(self.wechat.dialog_cache.stats()['incremental_reads'], 1)
+        # 只读取了 1 条新消息和锚点所在的一行
+        self.wechat.dialog_cache.invalidate()
+        calls = self.desktop.stats.calls
+        self.wechat.get_dialogs("好友", 10, search_user=False)
+        self.assertLess(incremental_calls, (self.desktop.stats.calls - calls) / 2)
+
+    def test_since_cursor_returns_only_new_messages(self):
+        cursor, dialogs, reset = self.wechat.get_dialogs_since("好友", 0)
+        self.assertEqual(len(dialogs), 20)
+        self.assertFalse(reset)
+
+        self.wechat.send_msg("好友", "回复")
+        cursor, dialogs, reset = self.wechat.get_dialogs_since("好友", cursor)
+        self.assertEqual(dialogs, [('用户发送', '我', '回复')])
+        self.assertFalse(reset)
+
+        self.assertEqual(self.wechat.get_dialogs_since("好友", cursor)[1], [])
+
+    def test_repeated_identical_messages_are_not_mistaken_for_read(self):
+        self.desktop.app.add_chat("A", [(simulator.MSG_USER, "A", "1")] * 3)
+        cursor, dialogs, _ = self.wechat.get_dialogs_since("A", 0)
+        self.assertEqual(len(dialogs), 3)
+
+        self.desktop.app.receive("A", "1")
+        cursor, dialogs, reset = self.wechat.get_dialogs_since("A", cursor)
+        self.assertEqual(dialogs, [('用户发送', 'A', '1')])
+        self.assertFalse(reset)
+        self.assertEqual(self.wechat.dialog_cache.stats()['incremental_reads'], 1)
+
+    def test_walk_is_capped_before_falling_back_to_a_full_read(self):
+        self.wechat.dialog_cache.max_walk = 3
+        cursor, _, _ = self.wechat.get_dialogs_since("好友", 0)
+        for i in range(5):
+            self.desktop.app.receive("好友", f"新消息{i}")
+
+        # 往上读 3 行仍然找不到锚点，重新完整读取
+        cursor, dialogs, reset = self.wechat.get_dialogs_since("好友", cursor)
+        self.assertTrue(reset)
+        self.assertEqual([d[2] for d in dialogs[-5:]], [f"新消息{i}" for i in range(5)])
+        self.assertEqual(self.wechat.dialog_cache.stats()['full_reads'], 2)
+        self.assertEqual(self.wechat.dialog_cache.stats()['incremental_reads'], 0)
+
+
+class TimeBlockDialogTests(TestCase):
+    def setUp(self):
+        history = []
+        for i in range(100):
+            history.append((simulator.MSG_TIME, "", f"时间{i}"))
+            history += [(simulator.MSG_USER, "好友", f"消息{i}-{j}") for j in range(4)]
+        self.desktop = simulator.install(simulator.SimWeChatApp([simulator.SimChat("好友", history)]))
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def test_blocks_are_read_in_a_single_pass(self):
+        self.desktop.app.open_chat("好友")
+        groups = self.wechat.get_dialogs_by_time_blocks("好友", 30, search_user=False)
+
+        self.assertEqual(len(groups), 30)
+        self.assertEqual(groups[0][0], ('时间信息', '', '时间70'))
+        self.assertEqual(groups[-1], [('时间信息', '', '时间99')] + [('用户发送', '好友', f'消息99-{j}') for j in range(4)])
+        # 150 条消息，每页 20 条：只需要点击 7 次“查看更多消息”
+        self.assertEqual(self.desktop.stats.clicks, 7)
+
+    def test_short_history_returns_complete_blocks_only(self):
+        self.desktop.app.chats["好友"].messages[:2] = []
+        groups = self.wechat.get_dialogs_by_time_blocks("好友", 1000)
+
+        self.assertEqual(len(groups), 99)
+        self.assertEqual(groups[0][0], ('时间信息', '', '时间1'))
+
+    def test_blocks_wait_for_delayed_pages(self):
+        self.desktop.app.history_delay = 0.02
+        self.desktop.app.open_chat("好友")
+        groups = self.wechat.get_dialogs_by_time_blocks("好友", 30, search_user=False)
+
+        self.assertEqual(len(groups), 30)
+        self.assertEqual(groups[0][0], ('时间信息', '', '时间70'))
+        self.assertEqual(self.desktop.stats.clicks, 7)
+
+
+class MessageSnapshotTests(TestCase):
+    def setUp(self):
+        history = []
+        for i in range(100):
+            history += [
+                (simulator.MSG_TIME, "", f"时间{i}"),
+                (simulator.MSG_USER, f"好友{i % 3}", f"消息{i}"),
+                (simulator.MSG_RED_PACKET, "", "收到红包"),
+                (simulator.MSG_RECALL, "", "好友撤回了一条消息"),
+                (simulator.MSG_USER, "我", f"回复{i}"),
+            ]
+        app = simulator.SimWeChatApp([simulator.SimChat("好友", history)], page_size=len(history))
+        self.desktop = simulator.install(app)
+        app.open_chat("好友")
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def read(self, enabled):
+        self.wechat.snapshots.enabled = enabled
+        calls = self.desktop.stats.calls
+        dialogs = self.wechat.get_dialogs("好友", 500, search_user=False, use_cache=False)
+        return dialogs, self.desktop.stats.calls - calls
+
+    def test_snapshot_matches_per_control_reads(self):
+        expected, per_control_calls = self.read(False)
+        dialogs, snapshot_calls = self.read(True)
+
+        self.assertEqual(dialogs, expected)
+        self.assertEqual(dialogs[:3], [('时间信息', '', '时间0'), ('用户发送', '好友0', '消息0'), ('红包信息', '', '收到红包')])
+        self.assertLess(snapshot_calls * 100, per_control_calls)
+        self.assertEqual(self.wechat.snapshots.stats(), {'bulk_fetches': 1, 'fallbacks': 0})
+
+    def test_falls_back_when_cache_request_fails(self):
+        self.wechat.snapshots._request = object()
+        dialogs, _ = self.read(True)
+
+        self.assertEqual(len(dialogs), 500)
+        self.assertEqual(self.wechat.snapshots.stats()['fallbacks'], 1)
+
+
+class HistoryLoaderTests(TestCase):
+    def setUp(self):
+        history = [(simulator.MSG_USER, "好友", f"消息{i}") for i in range(200)]
+        self.desktop = simulator.install(simulator.SimWeChatApp([simulator.SimChat("好友", history)]))
+        self.desktop.app.open_chat("好友")
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def read(self, n_msg):
+        calls = self.desktop.stats.calls
+        dialogs = self.wechat.get_dialogs("好友", n_msg, search_user=False, use_cache=False)
+        return dialogs, self.desktop.stats.calls - calls
+
+    def test_loader_counts_only_new_rows(self):
+        dialogs, calls = self.read(95)
+
+        self.assertEqual(dialogs[0], ('用户发送', '好友', '消息105'))
+        load = self.wechat.last_history_load
+        self.assertEqual((load.pages, load.rows, load.exhausted, load.timed_out), (4, 101, False, False))
+        # 每页只数新增的 20 行并等待新的一页出现，而不是每页重新枚举整个列表
+        self.assertLess(calls, 65 * load.pages)
+
+    def test_loader_stops_when_history_is_exhausted(self):
+        dialogs, _ = self.read(1000)
+
+        self.assertEqual(len(dialogs), 200)
+        load = self.wechat.last_history_load
+        self.assertEqual((load.pages, load.rows, load.exhausted), (9, 200, True))
+        self.assertEqual(self.wechat.waits.stats()['load_history']['count'], 1)
+
+    def test_loader_waits_for_delayed_pages(self):
+        self.desktop.app.history_delay = 0.02
+        dialogs, _ = self.read(1000)
+
+        # 点击之后新的一页没有马上出现，不能当成已经没有更早的消息
+        self.assertEqual(len(dialogs), 200)
+        load = self.wechat.last_history_load
+        self.assertEqual((load.pages, load.rows, load.exhausted), (9, 200, True))
+        self.assertEqual(self.wechat.waits.stats()['load_page']['count'], 9)
+
+
+class DirectoryScanTests(TestCase):
+    def setUp(self):
+        contacts = [(f"昵称{i}", f"备注{i}" if i % 2 else "") for i in range(300)]
+        groups = [simulator.SimChat(f"群 {i}", is_group=True) for i in range(40)]
+        self.desktop = simulator.install(simulator.SimWeChatApp(groups, contacts=contacts))
+        self.wechat = WeChat(path="WeChat.exe")
+
+    def test_contacts_are_scanned_in_view_sized_steps(self):
+        contacts = self.wechat.find_all_contacts()
+
+        self.assertEqual(len(contacts), 300)
+        self.assertEqual(set(contacts), {f"备注{i}" if i % 2 else f"昵称{i}" for i in range(300)})
+        scan = self.wechat.last_directory_scan
+        # 每一步翻过 10 行，大约 30 步，而不是固定的 1000 步
+        self.assertLess(scan.steps, 40)
+        self.assertLess(scan.rows_read, 300 * 2)
+
+    def test_scan_without_view_size_adapts_step(self):
+        self.desktop.app.open_manager()
+        list_control = simulator.ListControl(searchFromControl=simulator.GetForegroundControl())
+        list_control.GetScrollPattern().VerticalViewSize = None
+
+        scan = self.wechat._scan_list(list_control, lambda row: row.TextControl().Name)
+        self.assertEqual(len(scan.entries), 300)
+        self.assertLess(scan.rows_read, 300 * 3)
+
+    def test_groups_use_the_same_scanner(self):
+        groups = self.wechat.find_all_groups()
+
+        self.assertEqual(sorted(groups), sorted(f"群 {i}" for i in range(40)))
+        self.assertLess(self.wechat.last_directory_scan.steps, 10)
+
+
+class DirectoryTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install(simulator.SimWeChatApp(
+            [simulator.SimChat("家人群", is_group=True), simulator.SimChat("同事 群", is_group=True)],
+            contacts=[("张三", ""), ("张三丰", "师父"), ("李四", ""), ("Alice", "")]))
+        views.directory.reset()
+
+    def test_rescan_only_writes_changes(self):
+        directory = Directory()
+        directory.apply_scan('contact', ["张三", "李四", "王五"])
+        record = directory.apply_scan('contact', ["张三", "李四", "赵六"])
+
+        self.assertEqual((record.entries, record.added, record.removed), (3, 1, 1))
+        self.assertIsNotNone(DirectoryEntry.objects.get(kind='contact', name="王五").removed_at)
+        self.assertEqual(directory.index('contact').all(), sorted(["张三", "李四", "赵六"]))
+        # 重新加载时只包含仍然存在的条目
+        self.assertEqual(len(Directory().index('contact')), 3)
+
+    def test_prefix_and_substring_search(self):
+        index = NameIndex(["张三", "张三丰", "李四", "老张", "Alice"])
+
+        self.assertEqual(index.prefix("张三"), ["张三", "张三丰"])
+        self.assertEqual(index.search("张"), ["张三", "张三丰", "老张"])
+        self.assertEqual(index.prefix("al"), ["Alice"])
+        self.assertEqual(index.search("张", limit=1), ["张三"])
+
+    def test_scan_task_fills_directory_and_list_does_not_touch_ui(self):
+        self.assertTrue(views.directory_scan_task(views.accounts.default, 'contact')[0])
+        self.assertTrue(views.directory_scan_task(views.accounts.default, 'group')[0])
+
+        calls = self.desktop.stats.calls
+        response = self.client.get(reverse('contacts'), {'q': '张'})
+        body = response.json()
+        # 有备注的联系人按备注保存
+        self.assertEqual(body['results'], ["张三"])
+        self.assertEqual(body['total'], 4)
+        self.assertFalse(body['stale'])
+        self.assertIsNone(body['refresh_job'])
+
+        response = self.client.get(reverse('groups'), {'q': '同事'})
+        self.assertEqual(response.json()['results'], ["同事 群"])
+        self.assertEqual(self.desktop.stats.calls, calls)
+
+    def test_stale_directory_is_refreshed_once_in_background(self):
+        job = Job('scan_directory', lambda: (True, {}))
+        with mock.patch.object(views, 'submit_directory_scan', return_value=job) as submit:
+            first = self.client.get(reverse('contacts')).json()
+            second = self.client.get(reverse('contacts')).json()
+
+        self.assertTrue(first['stale'])
+        self.assertEqual(first['results'], [])
+        self.assertEqual(second['refresh_job'], job.id)
+        submit.assert_called_once_with(views.accounts.default, 'contact')
+
+
+class DeferredVerificationTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+
+    def tearDown(self):
+        wait_for_executor()
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_burst_is_verified_with_one_read(self):
+        wechat = WeChat(path="WeChat.exe")
+        wechat.verify = 'deferred'
+        for i in range(5):
+            self.assertTrue(wechat.send_msg("好友", f"广播{i}"))
+        self.assertEqual(wechat.deliveries.stats(), {'submitted': 5, 'verified': 0, 'failed': 0})
+        # 模拟最后一条消息没有发出去
+        self.desktop.app.chats["好友"].messages.pop()
+
+        full_reads = wechat.dialog_cache.full_reads + wechat.dialog_cache.incremental_reads
+        records = wechat.verify_deliveries("好友")
+
+        self.assertEqual([r['status'] for r in records], ['verified'] * 4 + ['failed'])
+        self.assertEqual(wechat.dialog_cache.full_reads + wechat.dialog_cache.incremental_reads, full_reads + 1)
+        self.assertEqual(wechat.verify_deliveries("好友"), [])
+
+    def test_deferred_send_is_verified_in_background(self):
+        response = self.post(reverse('send_message'), {'name': '好友', 'text': '你好', 'verify': 'deferred'})
+        self.assertEqual(response.status_code, 200)
+        delivery_id = response.json()['delivery_id']
+        self.assertTrue(wait_for_executor())
+        # 完成的校验任务不再保留
+        self.assertNotIn((views.accounts.default.name, '好友'), views.verification_jobs)
+
+        response = self.client.get(reverse('delivery_status', args=[delivery_id]))
+        self.assertEqual(response.json()['status'], 'verified')
+        response = self.post(reverse('deliveries_status'), {'ids': [delivery_id, 'unknown']})
+        self.assertEqual(response.json()['missing'], ['unknown'])
+
+    def test_failed_read_is_retried_then_gives_up(self):
+        wechat = WeChat(path="WeChat.exe")
+        wechat.verify = 'deferred'
+        wechat.deliveries.max_attempts = 2
+        wechat.send_msg("好友", "你好")
+        record_id = wechat.deliveries._pending["好友"][0]
+
+        with mock.patch.object(wechat, 'get_dialogs', side_effect=RuntimeError("读取失败")):
+            with self.assertRaises(RuntimeError):
+                wechat.verify_deliveries("好友")
+            self.assertEqual(wechat.deliveries.attempts("好友"), 1)
+            self.assertEqual(wechat.deliveries.get(record_id)['status'], 'submitted')
+            with self.assertRaises(RuntimeError):
+                wechat.verify_deliveries("好友")
+
+        self.assertEqual(wechat.deliveries.get(record_id)['status'], 'failed')
+        self.assertEqual(wechat.deliveries.pending(), [])
+
+    def test_background_verification_is_retried_after_an_error(self):
+        account = views.accounts.default
+        get_dialogs = account.wechat.get_dialogs
+        calls = []
+
+        def flaky_get_dialogs(*args, **kwargs):
+            # 第一次读取聊天记录出错
+            calls.append(args)
+            if len(calls) == 1:
+                raise RuntimeError("读取失败")
+            return get_dialogs(*args, **kwargs)
+
+        with mock.patch.object(views, 'VERIFY_RETRY_DELAY', 0.01), \
+                mock.patch.object(account.wechat, 'get_dialogs', side_effect=flaky_get_dialogs):
+            response = self.post(reverse('send_message'), {'name': '好友', 'text': '你好', 'verify': 'deferred'})
+            delivery_id = response.json()['delivery_id']
+
+            self.assertTrue(wait_until(lambda: account.wechat.deliveries.get(delivery_id)['status'] != 'submitted', 5)[0])
+        self.assertEqual(account.wechat.deliveries.get(delivery_id)['status'], 'verified')
+        self.assertEqual(account.wechat.deliveries.get(delivery_id)['attempts'], 1)
+
+    def test_strict_mode_is_the_default(self):
+        response = self.post(reverse('send_message'), {'name': '好友', 'text': '你好'})
+
+        self.assertEqual(response.json(), {'status': 'Message sent', 'name': '好友'})
+        self.assertEqual(self.post(reverse('send_message'), {'name': '好友', 'text': 'x', 'verify': 'maybe'})
+                         .status_code, 400)
+
+
+class PictureExportTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        source_dir = os.path.join(self.tmp.name, 'wechat')
+        os.makedirs(source_dir)
+        pictures = []
+        for i in range(30):
+            path = os.path.join(source_dir, f"{i}.jpg")
+            with open(path, 'wb') as f:
+                # 每 10 张图片内容重复一次
+                f.write(f"picture {i % 10}".encode() * 100)
+            pictures.append(path)
+        # 一个视频和一张已经被清理的图片
+        pictures.insert(25, os.path.join(source_dir, "video.mp4"))
+        pictures.insert(27, os.path.join(source_dir, "cleaned.jpg"))
+
+        self.desktop = simulator.install(simulator.SimWeChatApp([simulator.SimChat("好友", pictures=pictures)]))
+        self.save_dir = os.path.join(self.tmp.name, 'export')
+        views.wechat.conversation.invalidate()
+
+    def test_pictures_are_deduplicated_and_resumed(self):
+        wechat = WeChat(path="WeChat.exe")
+        pictures = wechat.save_dialog_pictures("好友", 100, self.save_dir)
+
+        self.assertEqual(len(pictures), 10)
+        self.assertTrue(all(p['new'] for p in pictures))
+        self.assertEqual(len([f for f in os.listdir(self.save_dir) if f.endswith('.jpg')]), 10)
+        with open(pictures[0]['file'], 'rb') as f:
+            self.assertEqual(f.read(), b"picture 9" * 100)
+
+        # 第二次导出不会再复制任何图片
+        pictures = wechat.save_dialog_pictures("好友", 3, self.save_dir)
+        self.assertEqual([p['new'] for p in pictures], [False] * 3)
+        self.assertEqual(len(os.listdir(self.save_dir)), 11)
+
+    def test_export_endpoint_streams_zip(self):
+        with mock.patch.object(views, 'PICTURE_DIR', self.save_dir):
+            response = self.client.post(reverse('export_pictures'), json.dumps({'name': '好友', 'num': 4}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Pictures-New'], '4')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        names = archive.namelist()
+        self.assertEqual(len(names), 4)
+        self.assertTrue(names[0].startswith('0001_'))
+        self.assertEqual(archive.read(names[0]), b"picture 9" * 100)
+
+    def test_names_outside_the_picture_dir_are_rejected(self):
+        account = views.accounts.default
+        with mock.patch.object(views, 'PICTURE_DIR', self.save_dir):
+            self.assertEqual(views.picture_dir(account, "a/b"), os.path.join(self.save_dir, account.name, "a_b"))
+            for name in ("..", "."):
+                self.assertIsNone(views.picture_dir(account, name), name)
+            response = self.client.post(reverse('export_pictures'), json.dumps({'name': '..'}),
+                                        content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(os.path.exists(self.save_dir))
+
+    def test_unreadable_source_is_skipped(self):
+        export_picture = ui_auto_wechat.export_picture
+
+        def flaky_export(source, manifest):
+            # 复制之前源文件已经被清理
+            if source.endswith("28.jpg"):
+                raise FileNotFoundError(source)
+            return export_picture(source, manifest)
+
+        wechat = WeChat(path="WeChat.exe")
+        with mock.patch.object(ui_auto_wechat, 'export_picture', side_effect=flaky_export):
+            pictures = wechat.save_dialog_pictures("好友", 4, self.save_dir)
+
+        self.assertEqual(len(pictures), 4)
+        self.assertEqual(len(wechat.last_picture_failures), 1)
+        self.assertTrue(wechat.last_picture_failures[0]['source'].endswith("28.jpg"))
+
+        # 导出之后被删除的文件不会中断 zip
+        os.remove(pictures[1]['file'])
+        files = [(os.path.basename(p['file']), p['file']) for p in pictures]
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(zip_stream(files))))
+        self.assertEqual(len(archive.namelist()), 3)
+
+
+class SendFilesTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.paths = []
+        for i in range(20):
+            path = os.path.join(self.tmp.name, f"附件{i}.txt")
+            with open(path, 'w') as f:
+                f.write(str(i))
+            self.paths.append(path)
+
+    def test_files_are_pasted_in_chunks(self):
+        wechat = WeChat(path="WeChat.exe")
+        missing = os.path.join(self.tmp.name, "不存在.txt")
+        self.desktop.app.open_chat("好友")
+        pastes = self.desktop.stats.pastes
+        results = wechat.send_files("好友", self.paths[:5] + [missing] + self.paths[5:], search_user=False)
+
+        self.assertEqual([r['chunk'] for r in results], [0] * 5 + [None] + [0] * 4 + [1] * 9 + [2] * 2)
+        self.assertEqual(results[5]['status'], 'not found')
+        self.assertEqual(self.desktop.stats.pastes - pastes, 3)
+        self.assertEqual(len(self.desktop.app.chats["好友"].messages), 20)
+
+    def test_send_files_endpoint(self):
+        response = self.client.post(reverse('send_files'), json.dumps({'name': '好友', 'paths': self.paths[:3]}),
+                                    content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body['sent'], body['failed']), (3, 0))
+        self.assertEqual([r['status'] for r in body['results']], ['sent'] * 3)
+
+
+class AccountPoolTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 模拟的账号使用各自独立的模拟桌面，整个测试类只创建一次
+        cls.sales = views.accounts.get('销售') or views.accounts.add('销售', backend='simulated')
+        cls.support = views.accounts.get('客服') or views.accounts.add('客服', backend='simulated')
+
+    def setUp(self):
+        self.desktop = simulator.install()
+        for account in (self.sales, self.support):
+            if "好友" not in account.desktop.app.chats:
+                account.desktop.app.add_chat("好友")
+
+    def post(self, url, data):
+        return self.client.post(url, json.dumps(data), content_type='application/json')
+
+    def test_messages_are_routed_to_the_account_window(self):
+        response = self.post(reverse('send_message'), {'name': '好友', 'text': '你好', 'account': '销售',
+                                                       'verify': 'strict'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.sales.desktop.app.chats["好友"].messages[-1][2], '你好')
+        self.assertNotIn('你好', [m[2] for m in self.support.desktop.app.chats["好友"].messages])
+        self.assertEqual(self.desktop.stats.calls, 0)
+
+    def test_unknown_account_is_rejected(self):
+        response = self.post(reverse('send_message'), {'name': '好友', 'text': '你好', 'account': '不存在'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('销售', response.json()['error'])
+
+    def test_slow_account_does_not_block_other_accounts(self):
+        release = threading.Event()
+        blocked = self.sales.submit('block', lambda: (release.wait(5), {}))
+        job = self.support.submit('send_message', partial(views.send_message_task, self.support, "好友", "不用等"))
+        try:
+            self.assertTrue(job.wait(5))
+            self.assertFalse(blocked.done)
+        finally:
+            release.set()
+        self.assertTrue(blocked.wait(5))
+        self.assertEqual((job.account, blocked.account), ('客服', '销售'))
+
+    def test_directory_is_kept_per_account(self):
+        self.sales.directory.apply_scan('contact', ["张三"])
+        self.support.directory.apply_scan('contact', ["李四"])
+
+        response = self.client.get(reverse('contacts'), {'account': '客服'})
+        self.assertEqual(response.json()['results'], ["李四"])
+        self.assertEqual(Directory(account='销售').index('contact').all(), ["张三"])
+
+    def test_accounts_endpoint_reports_each_account(self):
+        response = self.client.get(reverse('accounts_status'))
+
+        accounts = response.json()['accounts']
+        self.assertEqual(accounts['销售']['backend'], 'simulated')
+        self.assertIn('lanes', accounts['客服'])
+        for key in ('waits', 'conversation', 'controls', 'activator', 'dialog_cache', 'snapshots', 'deliveries'):
+            self.assertIn(key, accounts['销售'], key)
+        self.assertEqual(self.client.get(reverse('queue_stats'), {'account': '不存在'}).status_code, 400)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+
+    def test_send_records_each_step_under_the_operation(self):
+        wechat = WeChat(path="WeChat.exe")
+        wechat.send_msg("好友", "你好")
+
+        steps = wechat.tracer.stats()['send_msg']
+        for step in ('send_msg', 'enter_chat', 'search', 'wait_search', 'paste', 'wait_paste', 'press_enter',
+                     'get_dialogs'):
+            self.assertEqual(steps[step]['count'], 1, step)
+        self.assertGreaterEqual(steps['send_msg']['sum'], steps['get_dialogs']['sum'])
+
+    def test_disabled_tracer_records_nothing(self):
+        tracer = Tracer(enabled=False)
+        self.assertIs(tracer.span('a'), tracer.span('b'))
+
+        wechat = WeChat(path="WeChat.exe")
+        wechat.tracer.enabled = False
+        job = Job('send_message', lambda: (wechat.send_msg("好友", "你好"), {}))
+        with job_trace(job):
+            job.run()
+        self.assertEqual(wechat.tracer.stats(), {})
+        self.assertIsNone(job.trace)
+
+    def test_job_trace_is_logged_as_json(self):
+        wechat = WeChat(path="WeChat.exe")
+        job = Job('send_message', lambda: (wechat.send_msg("好友", "你好"), {}))
+        with self.assertLogs('wechat_app.metrics', 'INFO') as logs, job_trace(job):
+            job.run()
+
+        trace = json.loads(logs.records[0].getMessage())
+        self.assertEqual(trace['job'], job.id)
+        self.assertEqual(trace['spans'][-1]['step'], 'send_msg')
+        self.assertEqual(trace['spans'][-1]['depth'], 0)
+
+    def test_metrics_endpoint_uses_prometheus_text_format(self):
+        response = self.client.post(reverse('send_message'), json.dumps({'name': '好友', 'text': '你好',
+                                                                         'verify': 'strict'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(reverse('metrics'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE wechat_step_seconds histogram', text)
+        self.assertIn('wechat_step_seconds_bucket{account="default",operation="send_msg",step="paste",le="+Inf"}',
+                      text)
+        self.assertIn('wechat_queue_depth{account="default",lane="interactive"} 0', text)
+
+
+class BenchmarkTests(TestCase):
+    def test_run_writes_json_that_can_be_compared(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        first, second = os.path.join(tmp.name, "first.json"), os.path.join(tmp.name, "second.json")
+        args = ['--rounds', '4', '--latency', '0', '--history', '20', '--messages', '20', '--broadcast', '2',
+                '--contacts', '30', '--groups', '5']
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            benchmark.main(args + ['--output', first])
+            benchmark.main(args + ['--output', second, '--compare', first])
+
+        with open(second, encoding='utf-8') as f:
+            operations = json.load(f)['benchmarks']['operations']
+        self.assertEqual(list(operations), [name for name, _, _ in benchmark.OPERATIONS])
+        self.assertTrue(all(r['uia_calls_per_op'] > 0 for r in operations.values()))
+        with open(first, encoding='utf-8') as f:
+            changes = benchmark.compare(operations, json.load(f)['benchmarks']['operations'])
+        # 模拟桌面是确定的，两次运行的 UIA 调用次数相同
+        self.assertEqual({c['uia_calls_per_op'] for c in changes.values()}, {0})
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class PacingTests(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def message(self, name):
+        return types.SimpleNamespace(name=name, pace=(name, 1))
+
+    def test_global_budget_refills_at_the_configured_rate(self):
+        pacer = Pacer(per_minute=60, burst=2, min_gap=0, jitter=0, clock=self.clock)
+        for name in ("甲", "乙"):
+            self.assertEqual(pacer.delay((name, 1)), 0)
+            pacer.consume((name, 1))
+
+        self.assertAlmostEqual(pacer.delay(("丙", 1)), 1.0)
+        self.clock.now += 1
+        self.assertEqual(pacer.delay(("丙", 1)), 0)
+        self.assertEqual(pacer.stats()['budget'], 1)
+
+    def test_jitter_delays_the_next_send(self):
+        pacer = Pacer(per_minute=600, burst=10, min_gap=0, jitter=2.0, clock=self.clock, rng=lambda: 0.5)
+        pacer.consume(("甲", 1))
+        self.assertAlmostEqual(pacer.delay(("乙", 1)), 1.0)
+
+    def test_queue_skips_recipients_inside_their_gap(self):
+        queue = LaneQueue(pacer=Pacer(per_minute=600, burst=10, min_gap=5, jitter=0, clock=self.clock))
+        first, second, other = self.message("甲"), self.message("甲"), self.message("乙")
+        unpaced = types.SimpleNamespace(name="读取聊天记录")
+        for item in (first, second, other, unpaced):
+            queue.put(item)
+
+        self.assertEqual([queue.get(0) for _ in range(3)], [first, other, unpaced])
+        with self.assertRaises(Empty):
+            queue.get(0)
+        self.assertAlmostEqual(queue.pacer.projected_drain(queue.paces()), 5.0)
+        self.clock.now += 5
+        self.assertIs(queue.get(0), second)
+
+    def test_failures_halve_the_rate_and_successes_restore_it(self):
+        pacer = Pacer(per_minute=20, clock=self.clock)
+        pacer.record(False)
+        pacer.record(False)
+        self.assertEqual(pacer.rate, 5)
+        for _ in range(20):
+            pacer.record(True)
+        self.assertEqual(pacer.rate, 20)
+        self.assertEqual(pacer.stats()['throttled'], 2)
+
+    def test_oversized_job_takes_on_at_most_one_bucket_of_debt(self):
+        pacer = Pacer(per_minute=60, burst=5, min_gap=0, jitter=0, clock=self.clock)
+        self.assertEqual(pacer.delay((None, 300)), 0)
+        pacer.consume((None, 300))
+
+        # 欠下的预算最多 5 条，下一条消息等待 6 秒而不是 296 秒
+        self.assertAlmostEqual(pacer.delay(("甲", 1)), 6.0)
+
+    def test_drain_time_accounts_for_budget_and_gaps(self):
+        pacer = Pacer(per_minute=30, burst=2, min_gap=10, jitter=0, clock=self.clock)
+        # 2 条可以马上发送，其余 4 条每条 2 秒；发给甲的 3 条之间至少间隔 10 秒
+        paces = [("甲", 1)] * 3 + [("乙", 1), ("丙", 1), ("丁", 1)]
+        self.assertAlmostEqual(pacer.projected_drain(paces), 20.0)
+        self.assertEqual(pacer.stats(paces)['queued_messages'], 6)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+        self.addCleanup(wait_for_executor)
+
+    def send(self, text, key, **headers):
+        data = {'name': '好友', 'text': text}
+        if key is not None:
+            data['idempotency_key'] = key
+        return self.client.post(reverse('send_message'), json.dumps(data), content_type='application/json',
+                                **headers)
+
+    def test_duplicate_is_answered_without_touching_the_ui(self):
+        requests_before = views.idempotency.stats()['requests']
+        first = self.send("只发一次", "order-1")
+        self.assertTrue(wait_for_executor())
+        calls = self.desktop.stats.calls
+
+        second = self.send("只发一次", None, HTTP_IDEMPOTENCY_KEY="order-1")
+
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.desktop.stats.calls, calls)
+        self.assertEqual([m[2] for m in self.desktop.app.chats["好友"].messages].count("只发一次"), 1)
+        stats = self.client.get(reverse('queue_stats')).json()['idempotency']
+        self.assertEqual(stats['requests'] - requests_before, 2)
+
+    def test_key_reused_for_another_message_is_rejected(self):
+        self.send("第一条", "order-2")
+        self.assertEqual(self.send("第二条", "order-2").status_code, 409)
+
+    def test_failed_request_is_replayed_and_a_new_key_resends(self):
+        index = IdempotencyIndex()
+        failed = Job('send_message', lambda: (False, {}))
+        failed.run()
+        retry = Job('send_message', lambda: (True, {}))
+
+        self.assertEqual(index.submit(('default', 'k'), ('好友', '你好'), lambda: failed), (failed, False))
+        # 失败的消息可能已经发出去了，同一个键不会重新发送
+        self.assertEqual(index.submit(('default', 'k'), ('好友', '你好'), lambda: retry), (failed, True))
+        self.assertEqual(index.submit(('default', 'k2'), ('好友', '你好'), lambda: retry), (retry, False))
+        self.assertEqual(index.stats()['hit_rate'], 1 / 3)
+
+    def test_keys_expire_and_are_bounded(self):
+        clock = FakeClock()
+        index = IdempotencyIndex(max_keys=2, ttl=60, clock=clock)
+        for key in ('a', 'b', 'c'):
+            index.submit(key, key, lambda: Job('send_message', lambda: (True, {})))
+        self.assertEqual(index.stats()['keys'], 2)
+        clock.now += 61
+        job, replayed = index.submit('b', 'b', lambda: Job('send_message', lambda: (True, {})))
+        self.assertFalse(replayed)
+        self.assertEqual(index.stats()['keys'], 1)
+
+
+class CoalesceTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        self.desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+        window = views.message_queue.coalesce_window
+        views.message_queue.coalesce_window = 0.3
+        self.addCleanup(setattr, views.message_queue, 'coalesce_window', window)
+        self.addCleanup(wait_for_executor)
+
+    def send(self, text, **data):
+        response = self.client.post(reverse('send_message'),
+                                    json.dumps({'name': '好友', 'text': text, 'async': True, 'coalesce': True,
+                                                **data}),
+                                    content_type='application/json')
+        return views.job_store.get(response.json()['job_id'])
+
+    def test_texts_to_one_recipient_are_sent_in_one_paste(self):
+        pastes = self.desktop.stats.pastes
+        jobs = [self.send("提醒：明天开会"), self.send("会议链接")]
+        for job in jobs:
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual([m[2] for m in self.desktop.app.chats["好友"].messages], ["提醒：明天开会\n会议链接"])
+        self.assertEqual(self.desktop.stats.pastes - pastes, 2)  # 搜索联系人一次，发送一次
+        self.assertEqual([job.result['coalesced'] for job in jobs], [2, 2])
+        self.assertEqual(jobs[0].result['delivery_id'], jobs[1].result['delivery_id'])
+        self.assertTrue(wait_for_executor())
+        self.assertEqual(views.wechat.deliveries.get(jobs[0].result['delivery_id'])['status'], 'verified')
+
+    def test_long_text_is_split_at_the_length_limit(self):
+        with mock.patch.object(WeChat, 'MAX_TEXT_LENGTH', 10):
+            job = self.send("第一行\n" + "很长" * 6 + "\n结尾", verify='strict')
+            self.assertTrue(job.wait(5))
+
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(len(job.result['delivery_ids']), 3)
+        self.assertEqual([m[2] for m in self.desktop.app.chats["好友"].messages],
+                         ["第一行", "很长很长很长很长很长", "很长\n结尾"])
+
+    def test_coalescing_keeps_order_per_recipient(self):
+        queue = LaneQueue(coalesce_window=0.05)
+
+        def message(name, text):
+            return Job('send_message', None, pace=(name, 1), coalesce=(('send_message', name), text, None))
+
+        jobs = [message('好友', 'a'), message('同事', 'b'), message('好友', 'c'),
+                Job('send_files', None, pace=('好友', 1)), message('好友', 'd')]
+        for job in jobs:
+            queue.put(job)
+        time.sleep(0.06)
+
+        head = queue.get(0)
+        self.assertIs(head, jobs[0])
+        # 发给同事的消息不能合并，发送文件之后的消息不能提前
+        self.assertEqual(queue.take_coalesced(head, 'interactive'), [jobs[2]])
+        self.assertEqual([queue.get(0), queue.get(0), queue.get(0)], [jobs[1], jobs[3], jobs[4]])
+        self.assertEqual(queue.stats()['interactive']['coalesced'], 1)
+
+
+class WatcherTests(TestCase):
+    def setUp(self):
+        self.desktop = simulator.install()
+        for name in ("同事", "好友", "家人"):
+            self.desktop.app.add_chat(name, [(simulator.MSG_USER, name, "早")])
+        views.wechat.conversation.invalidate()
+        views.wechat.dialog_cache.invalidate()
+        self.posted = []
+        self.watcher = MessageWatcher(views.accounts.default,
+                                      post=lambda url, payload, timeout: self.posted.append((url, payload)) or 200)
+        self.addCleanup(wait_for_executor)
+
+    def scan(self):
+        job = self.watcher.submit()
+        self.assertTrue(job.wait(5))
+        return job.result
+
+    def test_only_changed_sessions_are_read(self):
+        self.scan()
+        self.desktop.app.receive("好友", "在吗")
+        self.desktop.app.receive("好友", "回个电话")
+
+        self.assertEqual(self.scan()['changed'], 1)
+        self.assertEqual(self.watcher.reads, 1)
+        self.assertEqual([(e['name'], e['text']) for e in self.watcher.events_since(0)],
+                         [("好友", "在吗"), ("好友", "回个电话")])
+
+        # 没有变化时只读取会话列表
+        self.assertEqual(self.scan()['changed'], 0)
+        self.assertEqual(self.watcher.reads, 1)
+
+    def test_own_messages_are_not_pushed(self):
+        self.scan()
+        self.assertTrue(views.wechat.send_msg("家人", "晚上回家吃饭"))
+        self.assertEqual(self.scan()['events'], 0)
+        self.assertEqual(self.watcher.reads, 0)
+
+        # 聊天窗口打开时收到的回复没有未读数，按预览的变化发现
+        self.desktop.app.receive("家人", "好的")
+        self.scan()
+        self.assertEqual([e['text'] for e in self.watcher.events_since(0)], ["好的"])
+
+    def test_own_message_is_skipped_when_the_chat_has_a_cursor(self):
+        self.scan()
+        self.desktop.app.receive("家人", "几点回来")
+        self.scan()
+        self.assertTrue(views.wechat.send_msg("家人", "晚上回家吃饭"))
+        self.assertEqual(self.scan()['changed'], 0)
+
+        # 从上一次的游标增量读取时，自己发送的消息仍然能被识别出来
+        self.desktop.app.receive("家人", "好的")
+        self.scan()
+        self.assertEqual([(e['sender'], e['text']) for e in self.watcher.events_since(0)],
+                         [("家人", "几点回来"), ("家人", "好的")])
+
+    def test_events_are_pushed_to_webhooks_and_sse(self):
+        self.watcher.webhooks = ['http://127.0.0.1:9/hook']
+        self.scan()
+        self.desktop.app.receive("同事", "开会了")
+        self.scan()
+
+        self.assertTrue(wait_until(lambda: self.posted, 5)[0])
+        url, payload = self.posted[0]
+        self.assertEqual(url, 'http://127.0.0.1:9/hook')
+        self.assertEqual([e['text'] for e in payload['events']], ["开会了"])
+
+        with mock.patch.object(views.accounts.default, 'watcher', self.watcher):
+            response = self.client.get(reverse('watch_events'), HTTP_LAST_EVENT_ID='0')
+            stream = iter(response.streaming_content)
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            self.assertEqual(next(stream), b'retry: 3000\n\n')
+            self.assertIn('开会了', next(stream).decode('utf-8'))
+
+    def test_watch_view_validates_webhooks(self):
+        response = self.client.post(reverse('watch'), json.dumps({'webhooks': ['ftp://x'], 'enabled': False}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('watch'), json.dumps({'interval': 3, 'enabled': False}),
+                                    content_type='application/json')
+        self.assertEqual(response.json()['interval'], 3)
+        self.assertFalse(response.json()['running'])
+
+
+class AutoReplyTests(TestCase):
+    def test_rules_are_matched_in_order_per_contact(self):
+        engine = AutoReplyEngine([
+            Rule("会议室在 3 楼", contacts=["同事"], keywords=["会议室"], name="room"),
+            Rule("稍后回复", keywords=["会议", "开会"], name="meeting"),
+            Rule("已收到订单", patterns=[r"订单\s*\d{6}"], name="order"),
+        ])
+
+        self.assertEqual(engine.reply("同事", "明天的会议室呢"), "会议室在 3 楼")
+        # 其他联系人不适用第一条规则，重叠的关键词仍然命中第二条
+        self.assertEqual(engine.reply("好友", "明天的会议室呢"), "稍后回复")
+        self.assertEqual(engine.reply("好友", "订单 123456 发货了吗"), "已收到订单")
+        self.assertIsNone(engine.reply("好友", "你好"))
+
+        stats = engine.stats()
+        self.assertEqual(stats['hits'], {'room': 1, 'meeting': 1, 'order': 1})
+        self.assertEqual((stats['evaluations'], stats['matched']), (4, 3))
+        self.assertEqual(stats['eval_time']['count'], 4)
+
+    def test_overlapping_triggers_and_catch_all_rules(self):
+        engine = AutoReplyEngine([
+            Rule("问候", patterns=[r"(?i)hello"], name="hello"),
+            Rule("重复", patterns=[r"(ab)c"], keywords=["哈哈"], name="repeat"),
+            Rule("价格", keywords=["价格表", "多少钱"], name="price"),
+            Rule("兜底", name="default"),
+            Rule("不会命中", keywords=["价格"], name="never"),
+        ])
+
+        # 后面位置命中的规则排在前面时仍然取序号最小的规则，全局标志只作用于自己的表达式
+        self.assertEqual(engine.reply("好友", "价格表 HELLO"), "问候")
+        self.assertEqual(engine.reply("好友", "Hello abc"), "问候")
+        self.assertEqual(engine.reply("好友", "价格表里有 abc"), "重复")
+        self.assertEqual(engine.reply("好友", "多少钱"), "价格")
+        self.assertEqual(engine.reply("好友", "价格"), "兜底")
+
+    def test_verbose_pattern_may_end_with_a_comment(self):
+        engine = AutoReplyEngine([
+            Rule("订单", patterns=[r"(?x) 订单 \d+  # 订单号"], name="order"),
+            Rule("兜底", name="default"),
+        ])
+
+        self.assertEqual(engine.reply("好友", "订单123"), "订单")
+        self.assertEqual(engine.reply("好友", "订单 号"), "兜底")
+
+    def test_invalid_rules_are_rejected(self):
+        for rules in ([{'reply': 'x', 'patterns': ['(']}], [{'keywords': ['x']}],
+                      [{'reply': 'x', 'patterns': ['(?P<a>x)']}], [{'reply': 'x', 'patterns': [r'(ab)\1']}],
+                      [{'reply': 'x', 'patterns': ['a(?i)b']}], [{'reply': 'x', 'patterns': ['(a)?(?(1)b|c)']}]):
+            response = self.client.post(reverse('auto_reply'), json.dumps({'rules': rules}),
+                                        content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+    def test_set_auto_reply_keeps_contact_list_behaviour(self):
+        wechat = WeChat(path="C:/WeChat.exe")
+        wechat.set_auto_reply(["好友"])
+        self.assertEqual(wechat.auto_reply.reply("好友", "任何消息"), wechat.auto_reply_msg)
+        self.assertIsNone(wechat.auto_reply.reply("同事", "任何消息"))
+
+    def test_watcher_replies_to_matching_messages(self):
+        desktop = simulator.install()
+        desktop.app.add_chat("好友")
+        views.wechat.conversation.invalidate()
+        views.wechat.dialog_cache.invalidate()
+        self.addCleanup(wait_for_executor)
+        self.addCleanup(views.wechat.auto_reply.set_rules, [])
+        response = self.client.post(reverse('auto_reply'), json.dumps({'rules': [
+            {'name': 'price', 'keywords': ['多少钱', '价格'], 'reply': '价格表见附件'}]}),
+                                    content_type='application/json')
+        self.assertEqual(response.json(), {'rules': 1})
+
+        watcher = MessageWatcher(views.accounts.default)
+        watcher.submit().wait(5)
+        desktop.app.receive("好友", "这个多少钱")
+        self.assertTrue(watcher.submit().wait(5))
+        self.assertTrue(wait_for_executor())
 
-# Create your tests here.
+        self.assertEqual(watcher.events_since(0)[0]['auto_reply'], '价格表见附件')
+        self.assertEqual(desktop.app.chats["好友"].messages[-1][2], '价格表见附件')
+        # 自己发出的回复不会再作为新消息推送
+        job = watcher.submit()
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.result['events'], 0)
+        self.assertEqual(self.client.get(reverse('auto_reply')).json()['stats']['hits'], {'price': 1})
@@ -1,15 +1,21 @@
+import threading
 import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+
 import uiautomation as auto
 import subprocess
-import numpy as np
 import pyperclip
 import os
 import pyautogui
 
 from PIL import ImageGrab
+from .autoreply import AutoReplyEngine, Rule
 from .clipboard import setClipboardFiles
+from .metrics import Tracer, traced
+from .pictures import PictureManifest, export_picture
 from PyQt5.QtWidgets import QApplication
-from typing import List
+from typing import List, Tuple
 
 from .wechat_locale import WeChatLocale
 
@@ -50,59 +56,737 @@ def double_click(element):
 # 聊天记录复制图片按钮               Name: '复制'   ControlType: MenuItemControl      depth: 5
 
 
+def wait_until(predicate, timeout: float, interval: float = 0.01, max_interval: float = 0.1):
+    """
+    轮询 predicate 直到其返回真值或超时，轮询间隔从 interval 开始逐渐增大到 max_interval，
+    条件很快满足时几乎不用等待，条件迟迟不满足时也不会频繁访问控件。
+    predicate 抛出的异常视为条件尚未满足（控件可能正在刷新）。
+
+    Return:
+        (是否满足条件, 实际等待的秒数)
+    """
+    start = time.perf_counter()
+    deadline = start + timeout
+    while True:
+        try:
+            if predicate():
+                return True, time.perf_counter() - start
+        except Exception:
+            pass
+        now = time.perf_counter()
+        if now >= deadline:
+            return False, now - start
+        time.sleep(min(interval, deadline - now))
+        interval = min(interval * 1.5, max_interval)
+
+
+class WaitStats:
+    """记录每种条件等待实际花费的时间和超时次数，用于根据线上数据调整等待的超时时间"""
+
+    def __init__(self, keep: int = 500):
+        # 每种等待只保留最近 keep 次的耗时
+        self._samples = defaultdict(lambda: deque(maxlen=keep))
+        self.counts = defaultdict(int)
+        self.timeouts = defaultdict(int)
+
+    def record(self, name, elapsed, ok):
+        self._samples[name].append(elapsed)
+        self.counts[name] += 1
+        if not ok:
+            self.timeouts[name] += 1
+
+    def stats(self) -> dict:
+        result = {}
+        for name, samples in self._samples.items():
+            ordered = sorted(samples)
+            result[name] = {
+                'count': self.counts[name],
+                'timeouts': self.timeouts[name],
+                'mean': sum(ordered) / len(ordered),
+                'p50': ordered[len(ordered) // 2],
+                'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                'max': ordered[-1],
+            }
+        return result
+
+
+# 聊天内容类型对应的说明，见 WeChat._classify
+VALUE_TO_INFO = {0: '用户发送', 1: '时间信息', 2: '红包信息', 3: '"查看更多消息"标志', 4: '撤回消息',
+                 5: "System Notification", 6: '"以下是新消息"标志'}
+# 不是真正的聊天内容，会随着界面操作出现或消失，不放入聊天记录缓存
+TRANSIENT_TYPES = (3, 6)
+
+
+# 一条聊天记录控件的快照，识别类型和提取发送人只需要这些信息
+# first_child_type: 第一个子控件的类型；content_count: PaneControl 的子控件的子控件数量之和；
+# sender: 子树中第一个 ButtonControl 的名称（仅用户发送的消息）
+MessageRecord = namedtuple('MessageRecord', ['name', 'first_child_type', 'content_count', 'sender'])
+
+
+# 会话列表中的一行：name: 聊天名称；unread: 未读消息数；preview: 最后一条消息的预览
+SessionRecord = namedtuple('SessionRecord', ['name', 'unread', 'preview'])
+
+
+# 一次扫描通讯录列表的结果
+# entries: 去重后的条目（按第一次读到的顺序）；rows_read: 读取的行数；steps: 滚动次数；elapsed: 耗时（秒）
+DirectoryScan = namedtuple('DirectoryScan', ['entries', 'rows_read', 'steps', 'elapsed'])
+
+
+# 一次加载更早聊天记录的结果
+# rows: 加载后列表中的行数；pages: 点击“查看更多消息”的次数；elapsed: 耗时（秒）；
+# exhausted: 已经没有更早的聊天记录；timed_out: 达到时间上限后提前停止
+HistoryLoad = namedtuple('HistoryLoad', ['rows', 'pages', 'elapsed', 'exhausted', 'timed_out'])
+
+
+class MessageSnapshot:
+    """
+    通过 UIA 缓存请求（CacheRequest）一次取回整棵子树的 Name 和 ControlType，
+    之后识别类型、提取发送人都在内存中完成，不再对每个控件单独跨进程调用。
+    缓存请求不可用时退化为逐个控件读取。
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._request = None
+        self.bulk_fetches = 0
+        self.fallbacks = 0
+
+    def _cache_request(self):
+        if self._request is None:
+            request = auto._AutomationClient.instance().IUIAutomation.CreateCacheRequest()
+            request.AddProperty(auto.PropertyId.NamePropertyId)
+            request.AddProperty(auto.PropertyId.ControlTypePropertyId)
+            request.TreeScope = auto.TreeScope.Subtree
+            self._request = request
+        return self._request
+
+    def _fetch(self, control):
+        """返回控件子树 (Name, 控件类型, [子控件...])，不支持缓存请求时返回 None"""
+        if not self.enabled:
+            return None
+        try:
+            element = control.Element.BuildUpdatedCache(self._cache_request())
+        except Exception:
+            self.fallbacks += 1
+            return None
+        self.bulk_fetches += 1
+        return self._cached_tree(element)
+
+    @classmethod
+    def _cached_tree(cls, element):
+        children = element.GetCachedChildren()
+        kids = [cls._cached_tree(children.GetElement(i)) for i in range(children.Length)] if children else []
+        return element.CachedName, auto.ControlTypeNames.get(element.CachedControlType, ''), kids
+
+    @staticmethod
+    def _record(tree) -> MessageRecord:
+        name, _, kids = tree
+        if not kids:
+            return MessageRecord(name, '', 0, '')
+        first = kids[0]
+        if first[1] != 'PaneControl':
+            return MessageRecord(name, first[1], 0, '')
+        content_count = sum(len(child[2]) for child in first[2])
+        sender = ''
+        if content_count > 0:
+            # 与 ButtonControl() 的搜索顺序一致：深度优先找到的第一个按钮
+            stack = list(reversed(kids))
+            while stack:
+                node = stack.pop()
+                if node[1] == 'ButtonControl':
+                    sender = node[0]
+                    break
+                stack.extend(reversed(node[2]))
+        return MessageRecord(name, first[1], content_count, sender)
+
+    @staticmethod
+    def _read(control) -> MessageRecord:
+        """逐个控件读取一条聊天记录"""
+        first = control.GetFirstChildControl()
+        if first is None:
+            return MessageRecord(control.Name, '', 0, '')
+        if not isinstance(first, auto.PaneControl):
+            return MessageRecord(control.Name, first.ControlTypeName, 0, '')
+        content_count = 0
+        for child in control.PaneControl().GetChildren():
+            content_count += len(child.GetChildren())
+        sender = control.ButtonControl().Name if content_count > 0 else ''
+        return MessageRecord(control.Name, 'PaneControl', content_count, sender)
+
+    def item(self, list_item_control) -> MessageRecord:
+        """一条聊天记录的快照"""
+        tree = self._fetch(list_item_control)
+        return self._record(tree) if tree is not None else self._read(list_item_control)
+
+    def items(self, list_control) -> List[MessageRecord]:
+        """聊天记录列表中所有消息的快照（从旧到新）"""
+        tree = self._fetch(list_control)
+        if tree is not None:
+            return [self._record(child) for child in tree[2]]
+        return [self._read(item) for item in list_control.GetChildren()]
+
+    @staticmethod
+    def _session(tree) -> SessionRecord:
+        name, _, kids = tree
+        unread, preview = 0, ''
+        if kids:
+            # 有未读消息时，行内第一个 PaneControl 中头像后面是显示未读数的 TextControl
+            for child_name, child_type, _ in kids[0][2]:
+                if child_type == 'TextControl' and child_name.rstrip('+').isdigit():
+                    unread = int(child_name.rstrip('+'))
+            # 最后一个 TextControl 是最后一条消息的预览
+            stack = list(kids)
+            while stack:
+                node = stack.pop(0)
+                if node[1] == 'TextControl':
+                    preview = node[0]
+                stack[:0] = node[2]
+        return SessionRecord(name, unread, preview)
+
+    @classmethod
+    def _walk(cls, control):
+        """逐个控件读取子树 (Name, 控件类型, [子控件...])"""
+        return control.Name, control.ControlTypeName, [cls._walk(child) for child in control.GetChildren()]
+
+    def session(self, list_item_control) -> SessionRecord:
+        """会话列表中的一行"""
+        tree = self._fetch(list_item_control)
+        return self._session(tree if tree is not None else self._walk(list_item_control))
+
+    def sessions(self, list_control) -> List[SessionRecord]:
+        """会话列表中当前显示的全部会话（从上到下）"""
+        tree = self._fetch(list_control)
+        if tree is not None:
+            return [self._session(child) for child in tree[2]]
+        return [self._session(self._walk(item)) for item in list_control.GetChildren()]
+
+    def stats(self) -> dict:
+        return {'bulk_fetches': self.bulk_fetches, 'fallbacks': self.fallbacks}
+
+
+class DialogHistory:
+    """一个聊天窗口缓存的聊天记录，每条消息有一个递增的序号，最新消息的序号即为游标"""
+
+    def __init__(self, keep):
+        # 元素为 (序号, (信息类型, 发送人, 发送内容))
+        self.messages = deque(maxlen=keep)
+        self.next_seq = 1
+        self.updated_at = 0.0
+        # 最新一条消息所在行的 RuntimeId，增量读取时往上读到这一行为止
+        self.anchor_id = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    @property
+    def cursor(self) -> int:
+        return self.next_seq - 1
+
+    def extend(self, dialogs, anchor_id=None):
+        for dialog in dialogs:
+            self.messages.append((self.next_seq, tuple(dialog)))
+            self.next_seq += 1
+        if anchor_id is not None:
+            self.anchor_id = anchor_id
+        self.updated_at = time.monotonic()
+
+    def reset(self, dialogs, anchor_id=None):
+        # 序号继续递增，之前发出的游标不会与新的消息混淆
+        self.messages.clear()
+        self.anchor_id = None
+        self.extend(dialogs, anchor_id)
+
+    def last(self, n) -> List:
+        return [dialog for _, dialog in list(self.messages)[-n:]]
+
+    def since(self, cursor) -> List:
+        return [dialog for seq, dialog in self.messages if seq > cursor]
+
+    def first_seq(self) -> int:
+        return self.messages[0][0] if self.messages else self.next_seq
+
+
+class DialogCache:
+    """
+    每个聊天窗口最近解析过的聊天记录。再次读取时只需从最新的一条消息往上读，直到遇到缓存中最新的那一行
+    （按控件的 RuntimeId 识别，内容相同的消息不会被误认为已读），再把新消息合并到缓存中，不需要重新遍历整个聊天记录列表。
+    """
+
+    def __init__(self, keep: int = 200, max_walk: int = 50, max_age: float = 600):
+        """
+        Args:
+            keep: 每个聊天窗口最多缓存的消息数量
+            max_walk: 增量读取最多往上读的行数，超过后（新消息太多或列表已被重建）改为完整读取
+            max_age: 缓存超过 max_age 秒没有更新则重新完整读取（防止漏掉撤回等修改）
+        """
+        self.keep = keep
+        self.max_walk = max_walk
+        self.max_age = max_age
+        self._histories = {}
+        # 增量读取成功 / 完整读取的次数
+        self.incremental_reads = 0
+        self.full_reads = 0
+
+    def get(self, name):
+        """返回仍然有效的缓存，没有或过期时返回 None"""
+        history = self._histories.get(name)
+        if history is None or not history or time.monotonic() - history.updated_at > self.max_age:
+            return None
+        return history
+
+    def history(self, name) -> DialogHistory:
+        if name not in self._histories:
+            self._histories[name] = DialogHistory(self.keep)
+        return self._histories[name]
+
+    def invalidate(self, name=None):
+        if name is None:
+            self._histories.clear()
+        else:
+            self._histories.pop(name, None)
+
+    def stats(self) -> dict:
+        return {'contacts': len(self._histories), 'incremental_reads': self.incremental_reads,
+                'full_reads': self.full_reads}
+
+
+class ControlCache:
+    """
+    缓存已经定位到的控件，避免每次操作都从桌面根节点重新搜索控件树。
+    取出控件时先比较 RuntimeId 做一次廉价的有效性检查，只有控件失效（例如微信重启、窗口重建）时才重新搜索。
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        # key -> (控件, 定位时的 RuntimeId)
+        self._controls = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, search):
+        """
+        Args:
+            key: 缓存的键
+            search: 缓存未命中时用于搜索控件的函数
+        """
+        if self.enabled and key in self._controls:
+            control, runtime_id = self._controls[key]
+            if self._is_valid(control, runtime_id):
+                self.hits += 1
+                return control
+            del self._controls[key]
+
+        self.misses += 1
+        control = search()
+        if control is None:
+            return None
+        # uiautomation 的控件是惰性搜索的，读取 RuntimeId 会触发真正的搜索
+        runtime_id = control.GetRuntimeId()
+        if self.enabled:
+            self._controls[key] = (control, runtime_id)
+        return control
+
+    @staticmethod
+    def _is_valid(control, runtime_id) -> bool:
+        # 控件被销毁后读取 RuntimeId 会抛出异常（COMError/LookupError）或者返回不同的值
+        try:
+            return bool(runtime_id) and control.GetRuntimeId() == runtime_id
+        except Exception:
+            return False
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._controls.clear()
+        else:
+            self._controls.pop(key, None)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'cached': sorted(self._controls),
+        }
+
+
+class WindowActivator:
+    """
+    把微信窗口切换到前台。优先查找已经存在的顶层窗口并激活，找不到窗口时才启动 WeChat.exe。
+    launcher 与 find_window 可以替换，方便在没有微信的环境中测试。
+    """
+
+    def __init__(self, path, find_window, launcher=subprocess.Popen):
+        """
+        Args:
+            path: 微信的启动路径
+            find_window: 返回微信主窗口控件的函数，找不到时返回 None
+            launcher: 启动微信的函数，参数为启动路径
+        """
+        self.path = path
+        self.find_window = find_window
+        self.launcher = launcher
+        # 激活已有窗口的次数
+        self.activations = 0
+        # 启动进程的次数
+        self.launches = 0
+
+    def activate(self):
+        window = self.find_window()
+        if window is not None:
+            try:
+                window.SetActive(waitTime=0)
+                self.activations += 1
+                return window
+            except Exception:
+                # 窗口在查找之后被关闭，退回到启动进程
+                pass
+
+        # 窗口不存在（未启动或者最小化到托盘）时启动微信，已在运行的微信会显示主窗口
+        self.launcher(self.path)
+        self.launches += 1
+        return None
+
+    def stats(self) -> dict:
+        return {'activations': self.activations, 'launches': self.launches}
+
+
+class ConversationTracker:
+    """
+    记录当前打开的聊天窗口。目标聊天已经打开时可以跳过 get_contact 中的搜索（粘贴、等待、回车），
+    任何其他会切换界面的操作都需要调用 invalidate。
+    """
+
+    def __init__(self):
+        # 当前打开的聊天窗口名称，None 表示未知
+        self.name = None
+        # 每种操作 进入聊天窗口时搜索 / 跳过搜索 的次数
+        self.searched = defaultdict(int)
+        self.skipped = defaultdict(int)
+
+    def opened(self, name):
+        self.name = name
+
+    def invalidate(self):
+        self.name = None
+
+    def record(self, operation, skipped):
+        if skipped:
+            self.skipped[operation] += 1
+        else:
+            self.searched[operation] += 1
+
+    def stats(self) -> dict:
+        operations = sorted(set(self.searched) | set(self.skipped))
+        return {op: {'searched': self.searched[op], 'skipped': self.skipped[op]} for op in operations}
+
+
+class DeliveryTracker:
+    """
+    延迟校验的发送记录。发送后状态为 submitted，之后读取一次该联系人的聊天记录，
+    同时校验这段时间内发给他的全部消息，状态变为 verified 或 failed；读取聊天记录出错时记录放回等待下一次校验，
+    连续 max_attempts 次都无法校验的记录标记为 failed。记录会被执行线程和请求线程同时访问，所有操作都加锁。
+    """
+    SUBMITTED = 'submitted'
+    VERIFIED = 'verified'
+    FAILED = 'failed'
+
+    def __init__(self, keep: int = 5000, max_attempts: int = 3):
+        # 最多保留 keep 条记录，超出后丢弃最早的已校验记录
+        self.keep = keep
+        self.max_attempts = max_attempts
+        self._records = OrderedDict()
+        # 每个联系人等待校验的记录 id，按发送顺序排列
+        self._pending = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def submit(self, name, text) -> str:
+        record = {'id': uuid.uuid4().hex, 'name': name, 'text': text, 'status': self.SUBMITTED,
+                  'submitted_at': time.time(), 'verified_at': None, 'attempts': 0}
+        with self._lock:
+            self._records[record['id']] = record
+            self._pending[name].append(record['id'])
+            self._prune()
+        return record['id']
+
+    def _prune(self):
+        for record_id in list(self._records):
+            if len(self._records) <= self.keep:
+                break
+            if self._records[record_id]['status'] != self.SUBMITTED:
+                del self._records[record_id]
+
+    def pending(self) -> List[str]:
+        """有消息等待校验的联系人"""
+        with self._lock:
+            return [name for name, ids in self._pending.items() if ids]
+
+    def take(self, name) -> List[dict]:
+        """取出该联系人全部等待校验的记录（按发送顺序）"""
+        with self._lock:
+            return [dict(self._records[record_id]) for record_id in self._pending.pop(name, [])]
+
+    def restore(self, name, record_ids):
+        """校验失败（例如读取聊天记录出错）时把取出的记录放回，等待下一次校验；失败次数达到上限的记录标记为 failed"""
+        with self._lock:
+            restored = []
+            for record_id in record_ids:
+                record = self._records.get(record_id)
+                if record is None:
+                    continue
+                record['attempts'] += 1
+                if record['attempts'] >= self.max_attempts:
+                    record['status'] = self.FAILED
+                    record['verified_at'] = time.time()
+                else:
+                    restored.append(record_id)
+            self._pending[name][:0] = restored
+
+    def attempts(self, name) -> int:
+        """该联系人等待校验的记录中最多的校验失败次数，没有等待校验的记录时为 0"""
+        with self._lock:
+            return max((self._records[record_id]['attempts'] for record_id in self._pending.get(name, ())), default=0)
+
+    def resolve(self, record_id, delivered):
+        with self._lock:
+            record = self._records.get(record_id)
+            if record is not None:
+                record['status'] = self.VERIFIED if delivered else self.FAILED
+                record['verified_at'] = time.time()
+
+    def get(self, record_id):
+        with self._lock:
+            record = self._records.get(record_id)
+            return dict(record) if record is not None else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = Counter(record['status'] for record in self._records.values())
+            return {status: counts[status] for status in (self.SUBMITTED, self.VERIFIED, self.FAILED)}
+
+
 class WeChat:
-    def __init__(self, path, locale="zh-CN"):
+    def __init__(self, path, locale="zh-CN", launcher=subprocess.Popen, find_window=None, window_handle=None):
         # 微信打开路径
         self.path = path
 
-        # 用于复制内容到剪切板
-        self.app = QApplication([])
+        # 同时登录多个微信时，用窗口句柄区分各个账号的主窗口；为 None 时按窗口名称查找
+        self.window_handle = window_handle
 
-        # 自动回复的联系人列表
-        self.auto_reply_contacts = []
+        # 用于复制内容到剪切板，同时登录多个账号时共用一个 QApplication
+        self.app = QApplication.instance() or QApplication([])
 
-        # 自动回复的内容
+        # 自动回复规则，见 autoreply.py
+        self.auto_reply = AutoReplyEngine()
+
+        # set_auto_reply 使用的自动回复内容
         self.auto_reply_msg = "[自动回复]您好，我现在正在忙，稍后会主动联系您，感谢理解。"
 
         self.lc = WeChatLocale(locale)
 
+        # 已定位控件的缓存
+        self.controls = ControlCache()
+
+        # 激活微信窗口，只有找不到窗口时才启动进程
+        self.activator = WindowActivator(path, find_window or self._find_window, launcher)
+
+        # 当前打开的聊天窗口
+        self.conversation = ConversationTracker()
+
+        # 每个聊天窗口最近读取过的聊天记录，用于增量读取
+        self.dialog_cache = DialogCache()
+
+        # 一次取回聊天记录控件子树的快照
+        self.snapshots = MessageSnapshot()
+
+        # 条件等待的超时时间（秒），可以根据 self.waits 中记录的实际等待时间调整；
+        # load_page 为点击一次“查看更多消息”后等待更早的消息出现的时间，load_history 为加载历史记录的总时间
+        self.wait_timeouts = {'search': 2.0, 'chat': 1.0, 'paste': 1.0, 'load_page': 3.0, 'load_history': 60.0}
+        self.waits = WaitStats()
+
+        # 最近一次加载更早聊天记录的结果
+        self.last_history_load = None
+
+        # 最近一次扫描通讯录的结果
+        self.last_directory_scan = None
+
+        # 最近一次导出聊天图片时无法复制的源文件，元素为 {'source': 源文件路径, 'error': 错误信息}
+        self.last_picture_failures = []
+
+        # 最近发给每个聊天的文本，用于在新消息中区分自己发送的消息，见 watcher.py
+        self.recent_sent = defaultdict(lambda: deque(maxlen=50))
+
+        # 发送消息后的校验方式：strict 发送后马上读取聊天记录校验；
+        # deferred 只记录发送，之后由 verify_deliveries 对每个联系人读取一次聊天记录批量校验
+        self.verify = 'strict'
+        self.deliveries = DeliveryTracker()
+
+        # 每个操作各个步骤的耗时，tracer.enabled 为 False 时不统计
+        self.tracer = Tracer()
+
     # 打开微信客户端
+    @traced('open_wechat')
     def open_wechat(self):
-        subprocess.Popen(self.path)
+        if self.activator.activate() is None:
+            # 新启动的微信窗口和之前缓存的控件不是同一个
+            self.controls.invalidate()
+
+    # 查找已经打开的微信主窗口，不存在时返回 None
+    def _find_window(self):
+        def search():
+            if self.window_handle is not None:
+                return auto.ControlFromHandle(self.window_handle)
+            window = auto.WindowControl(searchDepth=1, Name=self.lc.weixin)
+            return window if window.Exists(0, 0) else None
+
+        return self.controls.get('window', search)
 
     # 搜寻微信客户端控件
     def get_wechat(self):
-        return auto.WindowControl(Depth=1, Name=self.lc.weixin)
+        if self.window_handle is not None:
+            return self.controls.get('window', lambda: auto.ControlFromHandle(self.window_handle))
+        return self.controls.get('window', lambda: auto.WindowControl(Depth=1, Name=self.lc.weixin))
+
+    # 以下控件都在该账号的主窗口内搜索（深度相对于主窗口），同时登录多个微信时不会找到其他账号窗口中的控件
+
+    # 搜索框
+    def _search_box(self):
+        return self.controls.get('search_box', lambda: self.get_wechat().EditControl(Depth=7, Name=self.lc.search))
+
+    # 发送按钮
+    def _send_button(self):
+        return self.controls.get('send_button', lambda: self.get_wechat().ButtonControl(Depth=14, Name=self.lc.send))
+
+    # 聊天记录列表
+    def _message_list(self):
+        return self.controls.get('message_list', lambda: self.get_wechat().ListControl(Name=self.lc.message))
+
+    def _wait(self, name, predicate) -> bool:
+        """等待 predicate 满足，超时时间见 self.wait_timeouts，并记录实际等待时间"""
+        with self.tracer.span(f'wait_{name}'):
+            ok, elapsed = wait_until(predicate, self.wait_timeouts[name])
+        self.waits.record(name, elapsed, ok)
+        return ok
+
+    # 搜索框下方的搜索结果中是否已经出现了要找的联系人
+    def _search_result_ready(self, name) -> bool:
+        result_list = self.get_wechat().ListControl(Name=self.lc.search_result)
+        if not result_list.Exists(0, 0):
+            return False
+        return any(name in item.Name for item in result_list.GetChildren())
+
+    # 点击“查看更多消息”之后更早的消息是否已经加载出来：anchor（点击前最早的一条消息，为 None 时取列表最后一行）
+    # 上面一行不再是被点击的“查看更多消息”
+    @staticmethod
+    def _history_loaded(list_control, clicked_id, anchor) -> bool:
+        above = anchor.GetPreviousSiblingControl() if anchor is not None else list_control.GetLastChildControl()
+        return above is None or above.GetRuntimeId() != clicked_id
+
+    # 获得焦点的是否是该聊天的输入框（名称与聊天窗口的名称相同）
+    @staticmethod
+    def _input_focused(name) -> bool:
+        focused = auto.GetFocusedControl()
+        return focused is not None and focused.Name == name
+
+    # 粘贴之前等待聊天窗口的输入框获得焦点，超时则点击一次输入框
+    def _focus_input(self, name):
+        if not self._wait('chat', lambda: self._input_focused(name)):
+            click(self._input_box(name))
+
+    # 获得焦点的输入框中是否已经是粘贴后的内容
+    @staticmethod
+    def _input_holds(text) -> bool:
+        value = auto.GetFocusedControl().GetValuePattern().Value
+
+        def normalize(t):
+            return t.replace("\r\n", "\n").replace("\r", "\n").rstrip()
+
+        return normalize(value) == normalize(text)
+
+    # 聊天输入框，名称与聊天窗口的名称相同
+    def _input_box(self, name):
+        # 缓存的输入框可能属于之前打开的另一个聊天，名称不一致时重新搜索
+        input_box = self.controls.get('input_box', lambda: self.get_wechat().EditControl(Name=name))
+        if input_box.Name != name:
+            self.controls.invalidate('input_box')
+            input_box = self.controls.get('input_box', lambda: self.get_wechat().EditControl(Name=name))
+        return input_box
+
+    # 判断指定聊天窗口是否已经打开：读取聊天界面上方的标题按钮（主窗口内 depth 13）
+    def _is_chat_open(self, name) -> bool:
+        if self.conversation.name != name:
+            return False
+
+        def search():
+            title = self.get_wechat().ButtonControl(Depth=13, Name=name)
+            return title if title.Exists(0, 0) else None
+
+        try:
+            title = self.controls.get('chat_title', search)
+            return title is not None and title.Name == name
+        except Exception:
+            self.controls.invalidate('chat_title')
+            return False
+
+    @traced('enter_chat')
+    def _enter_chat(self, name, operation, focus_input: bool = True) -> bool:
+        """
+        进入指定的聊天窗口，如果该聊天已经打开则跳过搜索
+        Args:
+            name: 聊天窗口的名称
+            operation: 调用的操作名称，用于统计
+            focus_input: 是否需要把焦点放到输入框（粘贴内容之前需要）
+
+        Return:
+            是否跳过了搜索
+        """
+        if self._is_chat_open(name):
+            self.open_wechat()
+            if focus_input:
+                click(self._input_box(name))
+            self.conversation.record(operation, skipped=True)
+            return True
+
+        self.get_contact(name)
+        self.conversation.record(operation, skipped=False)
+        return False
 
     # 防止微信长时间挂机导致掉线
+    @traced('prevent_offline')
     def prevent_offline(self):
+        self.conversation.invalidate()
         self.open_wechat()
         self.get_wechat()
 
-        search_box = auto.EditControl(Depth=8, Name=self.lc.search)
+        search_box = self._search_box()
         click(search_box)
 
     # 搜索指定用户
+    @traced('search')
     def get_contact(self, name):
+        self.conversation.invalidate()
         self.open_wechat()
         self.get_wechat()
 
-        search_box = auto.EditControl(Depth=8, Name=self.lc.search)
+        search_box = self._search_box()
         click(search_box)
 
         pyperclip.copy(name)
         auto.SendKeys("{Ctrl}v")
 
         # 等待客户端搜索联系人
-        time.sleep(0.3)
+        self._wait('search', lambda: self._search_result_ready(name))
         search_box.SendKeys("{enter}")
+        self.conversation.opened(name)
 
     # 鼠标移动到发送按钮处点击发送消息
+    @traced('press_enter')
     def press_enter(self):
         # 获取发送按钮
-        send_button = auto.ButtonControl(Depth=15, Name=self.lc.send)
+        send_button = self._send_button()
         click(send_button)
 
+    @traced('at')
     def at(self, name, at_name, search_user: bool = True) -> None:
         """
         在指定群聊中@他人（若@所有人需具备@所有人权限）
@@ -112,7 +796,7 @@ class WeChat:
             search_user: 是否需要搜索群聊
         """
         if search_user:
-            self.get_contact(name)
+            self._enter_chat(name, 'at')
 
         # 如果at_name为空则代表@所有人
         if at_name == "":
@@ -125,6 +809,7 @@ class WeChat:
             auto.SendKeys("{enter}")
             self.press_enter()
 
+    @traced('send_msg')
     def send_msg(self, name, text, search_user: bool = True) -> bool:
         """
         搜索指定用户名的联系人发送信息
@@ -132,23 +817,149 @@ class WeChat:
             name: 指定用户名的名称，输入搜索框后出现的第一个人
             text: 发送的文本信息
             search_user: 是否需要搜索用户
-        """
-        if search_user:
-            self.get_contact(name)
-        pyperclip.copy(text)
 
-        # 等待粘贴
-        time.sleep(0.3)
-        auto.SendKeys("{Ctrl}v")
+        Return:
+            strict 模式下为是否发送成功；deferred 模式下只表示已经发送，校验结果见 self.deliveries
+        """
+        if self.verify == 'deferred':
+            self.submit_msg(name, text, search_user)
+            return True
 
-        self.press_enter()
+        self._paste_and_send(name, text, search_user)
         # 发送消息后马上获取聊天记录，判断是否发送成功
         if self.get_dialogs(name, 1, False)[0][2] == text:
             return True
         else:
             return False
 
+    @traced('submit_msg')
+    def submit_msg(self, name, text, search_user: bool = True) -> str:
+        """
+        发送信息但不马上校验，返回发送记录的 id，之后由 verify_deliveries 批量校验
+        """
+        self._paste_and_send(name, text, search_user)
+        return self.deliveries.submit(name, text)
+
+    # 微信单条文本消息的长度上限（字符数）
+    MAX_TEXT_LENGTH = 2000
+
+    @staticmethod
+    def split_text(text, limit) -> List[str]:
+        """把超过 limit 的文本拆成多段，尽量在换行处拆分"""
+        pieces = []
+        while len(text) > limit:
+            cut = text.rfind("\n", 0, limit + 1)
+            if cut > 0:
+                pieces.append(text[:cut])
+                text = text[cut + 1:]
+            else:
+                pieces.append(text[:limit])
+                text = text[limit:]
+        if text or not pieces:
+            pieces.append(text)
+        return pieces
+
+    @classmethod
+    def pack_texts(cls, texts, limit=None) -> List[Tuple[str, List[int]]]:
+        """
+        把多条文本按顺序用换行连接成尽量少的消息，每条消息不超过 limit 个字符，超过 limit 的文本拆成多条消息
+        Return:
+            [(消息内容, [包含的文本下标, ...]), ...]
+        """
+        limit = limit or cls.MAX_TEXT_LENGTH
+        messages = []
+        for index, text in enumerate(texts):
+            for piece in cls.split_text(text, limit):
+                if messages and messages[-1][1][-1] != index and len(messages[-1][0]) + 1 + len(piece) <= limit:
+                    messages[-1] = (messages[-1][0] + "\n" + piece, messages[-1][1] + [index])
+                else:
+                    messages.append((piece, [index]))
+        return messages
+
+    @traced('send_texts')
+    def send_texts(self, name, texts, search_user: bool = True) -> List[List[str]]:
+        """
+        把发给同一联系人的多条文本合并成尽量少的消息发送（用换行连接，超过长度上限时拆分），不马上校验
+        Args:
+            name: 指定用户名的名称，输入搜索框后出现的第一个人
+            texts: 发送的文本信息列表
+            search_user: 是否需要搜索用户
+
+        Return:
+            与 texts 一一对应，每条文本所在消息的发送记录 id，之后由 verify_deliveries 批量校验
+        """
+        delivery_ids = [[] for _ in texts]
+        for count, (message, indexes) in enumerate(self.pack_texts(texts)):
+            self._paste_and_send(name, message, search_user and count == 0)
+            record_id = self.deliveries.submit(name, message)
+            for index in indexes:
+                delivery_ids[index].append(record_id)
+        return delivery_ids
+
+    def _paste_and_send(self, name, text, search_user):
+        if search_user:
+            self._enter_chat(name, 'send_msg')
+        self._focus_input(name)
+        with self.tracer.span('paste'):
+            pyperclip.copy(text)
+            auto.SendKeys("{Ctrl}v")
+
+            # 等待粘贴完成
+            self._wait('paste', lambda: self._input_holds(text))
+        self.press_enter()
+        self._record_sent(name, text)
+
+    def _record_sent(self, name, text):
+        self.recent_sent[name].append((text, time.time()))
+
+    def _find_sent(self, name, text, within):
+        sent = self.recent_sent.get(name)
+        if not sent:
+            return None
+        expire_before = time.time() - within
+        for record in sent:
+            if record[0] == text and record[1] >= expire_before:
+                return record
+        return None
+
+    def sent_recently(self, name, text, within: float = 600) -> bool:
+        """text 是否为最近 within 秒内发给该聊天的文本，不移除记录，用于判断会话列表中的预览"""
+        return self._find_sent(name, text, within) is not None
+
+    def is_own_message(self, name, text, within: float = 600) -> bool:
+        """text 是否为最近 within 秒内发给该聊天的文本，匹配后移除这条记录，避免把对方发来的相同内容也当作自己发送的"""
+        record = self._find_sent(name, text, within)
+        if record is None:
+            return False
+        self.recent_sent[name].remove(record)
+        return True
+
+    @traced('verify_deliveries')
+    def verify_deliveries(self, name) -> List[dict]:
+        """
+        读取一次聊天记录，校验发给该联系人的全部未校验消息
+        Return:
+            校验后的发送记录
+        """
+        records = self.deliveries.take(name)
+        if not records:
+            return []
+        try:
+            # 多读几条，防止中间插入了时间信息或对方的回复
+            dialogs = self.get_dialogs(name, len(records) * 2)
+        except Exception:
+            self.deliveries.restore(name, [record['id'] for record in records])
+            raise
+        sent = Counter(msg for kind, _, msg in dialogs if kind == '用户发送')
+        for record in records:
+            delivered = sent[record['text']] > 0
+            if delivered:
+                sent[record['text']] -= 1
+            self.deliveries.resolve(record['id'], delivered)
+        return [self.deliveries.get(record['id']) or record for record in records]
+
     # 搜索指定用户名的联系人发送文件
+    @traced('send_file')
     def send_file(self, name: str, path: str, search_user: bool = True) -> None:
         """
         Args:
@@ -157,7 +968,7 @@ class WeChat:
             search_user: 是否需要搜索用户
         """
         if search_user:
-            self.get_contact(name)
+            self._enter_chat(name, 'send_file')
 
         # 将文件复制到剪切板
         setClipboardFiles([path])
@@ -165,126 +976,243 @@ class WeChat:
         auto.SendKeys("{Ctrl}v")
         self.press_enter()
 
-    # 获取所有通讯录中所有联系人
-    def find_all_contacts(self):
+    # 微信一次粘贴最多发送的文件数量
+    MAX_FILES_PER_PASTE = 9
+
+    @traced('send_files')
+    def send_files(self, name: str, paths: List[str], search_user: bool = True) -> List[dict]:
+        """
+        把多个文件一起放到剪切板，一次粘贴、一次回车发送；超过每次粘贴的上限时分批发送
+        Args:
+            name: 指定用户名的名称，输入搜索框后出现的第一个人
+            paths: 发送文件的本地地址列表
+            search_user: 是否需要搜索用户
+
+        Return:
+            results: 与 paths 一一对应，元素为 {'path': 文件地址, 'status': 'sent' 或 'not found', 'chunk': 批次序号}
+        """
+        results = [{'path': path, 'status': 'not found', 'chunk': None} for path in paths]
+        # 不存在的文件不放到剪切板，否则整批文件都无法粘贴
+        existing = [i for i, path in enumerate(paths) if os.path.isfile(path)]
+        if not existing:
+            return results
+
+        if search_user:
+            self._enter_chat(name, 'send_files')
+        for chunk_index, start in enumerate(range(0, len(existing), self.MAX_FILES_PER_PASTE)):
+            chunk = existing[start:start + self.MAX_FILES_PER_PASTE]
+            with self.tracer.span('paste_files'):
+                setClipboardFiles([paths[i] for i in chunk])
+                auto.SendKeys("{Ctrl}v")
+            self.press_enter()
+            for i in chunk:
+                results[i].update(status='sent', chunk=chunk_index)
+        return results
+
+    @traced('send_batch')
+    def send_batch(self, name: str, items: List) -> List[bool]:
+        """
+        向同一个联系人连续发送多条消息：只进入一次聊天窗口，全部发送完之后只读取一次聊天记录进行校验
+        Args:
+            name: 指定用户名的名称，输入搜索框后出现的第一个人
+            items: 要发送的内容列表，元素为 ("text", 文本) 或 ("file", 文件路径)
+
+        Return:
+            results: 与 items 一一对应，表示每条内容是否发送成功
+        """
+        self._enter_chat(name, 'send_batch')
+        # 连续的文件合并成一次粘贴发送
+        file_results = {}
+        for index, (kind, content) in enumerate(items):
+            if kind == "file":
+                if index > 0 and items[index - 1][0] == "file":
+                    continue
+                end = index
+                while end < len(items) and items[end][0] == "file":
+                    end += 1
+                sent = self.send_files(name, [path for _, path in items[index:end]], search_user=False)
+                for offset, result in enumerate(sent):
+                    file_results[index + offset] = result['status'] == 'sent'
+            else:
+                self._focus_input(name)
+                with self.tracer.span('paste'):
+                    pyperclip.copy(content)
+                    auto.SendKeys("{Ctrl}v")
+                    # 等待粘贴完成
+                    self._wait('paste', lambda: self._input_holds(content))
+                self.press_enter()
+                self._record_sent(name, content)
+
+        # 读取一次聊天记录，校验这一批文本消息（多读几条，防止中间插入了时间信息）
+        sent = Counter(msg for kind, _, msg in self.get_dialogs(name, len(items) * 2, False) if kind == '用户发送')
+        results = []
+        for index, (kind, content) in enumerate(items):
+            # 文件消息在聊天记录中显示的内容与路径不同，只要文件存在并且已经粘贴发送就认为成功
+            if kind == "file":
+                results.append(file_results[index])
+            elif sent[content] > 0:
+                sent[content] -= 1
+                results.append(True)
+            else:
+                results.append(False)
+        return results
+
+    # 打开通讯录管理界面，返回通讯录管理窗口
+    @traced('open_contacts_manager')
+    def _open_contacts_manager(self):
+        self.conversation.invalidate()
         self.open_wechat()
-        self.get_wechat()
+        wechat = self.get_wechat()
 
         # 获取通讯录管理界面
-        click(auto.ButtonControl(Name=self.lc.contacts))
-        list_control = auto.ListControl(Name=self.lc.contact)
+        click(wechat.ButtonControl(Name=self.lc.contacts))
+        list_control = wechat.ListControl(Name=self.lc.contact)
         scroll_pattern = list_control.GetScrollPattern()
         scroll_pattern.SetScrollPercent(-1, 0)
         contacts_menu = list_control.ButtonControl(Name=self.lc.manage_contacts)
         click(contacts_menu)
 
         # 切换到通讯录管理界面
-        contacts_window = auto.GetForegroundControl()
-        list_control = contacts_window.ListControl()
-        scroll_pattern = list_control.GetScrollPattern()
+        return auto.GetForegroundControl()
+
+    # 滚动的最小步长，步长减小到这个值以下时不再回退
+    MIN_SCAN_STEP = 0.0005
 
-        # 读取用户
-        contacts = []
-        # 如果不存在滑轮则直接读取
-        if scroll_pattern is None:
-            for contact in contacts_window.ListControl().GetChildren():
-                # 获取用户的昵称以及备注
-                name = contact.TextControl().Name
-                note = contact.ButtonControl(foundIndex=2).Name
-
-                # 有备注的用备注，没有备注的用昵称
-                if note == "":
-                    contacts.append(name)
+    @traced('scan_list')
+    def _scan_list(self, list_control, read_row) -> DirectoryScan:
+        """
+        滚动读取只为可见行创建控件的列表，边读边去重。
+        每一步根据可见行数确定滚动距离，与上一屏保留两行左右的重叠；
+        如果与上一屏没有重叠，说明可能跳过了中间的行，减小步长补读；
+        一步之后列表没有变化说明已经到底。
+        Args:
+            list_control: 列表控件
+            read_row: 从一行中读取条目的函数
+        """
+        start = time.perf_counter()
+        entries = {}
+        rows_read = steps = 0
+
+        def read():
+            nonlocal rows_read
+            screen = [read_row(row) for row in list_control.GetChildren()]
+            rows_read += len(screen)
+            entries.update(dict.fromkeys(screen))
+            return set(screen)
+
+        screen = read()
+        scroll_pattern = list_control.GetScrollPattern()
+        # 如果不存在滑轮则只需要读取一次
+        if scroll_pattern is not None and len(screen) > 1:
+            # 可见部分占整个列表的比例，用来估计第一步的步长
+            view = (getattr(scroll_pattern, 'VerticalViewSize', 0) or 0) / 100
+            calibrated = 0 < view < 1
+            visible = len(screen)
+            # 每一步翻过的行数
+            stride = max(1, visible - 2)
+            step = stride * view / (visible * (1 - view)) if calibrated else 0.01
+            percent = 0.0
+            while percent < 1:
+                target = min(1.0, percent + step)
+                scroll_pattern.SetScrollPercent(-1, target)
+                steps += 1
+                current = read()
+                moved = len(current - screen)
+                if moved == 0:
+                    # 按可见行数确定的步长没有翻动列表，说明已经到底
+                    if calibrated or target >= 1:
+                        break
+                    step *= 4
+                elif moved >= len(current) and step > self.MIN_SCAN_STEP:
+                    # 与上一屏没有重叠，减小步长，补读中间可能跳过的行
+                    step /= 2
+                    continue
                 else:
-                    contacts.append(note)
-        else:
-            for percent in np.arange(0, 1.002, 0.001):
-                scroll_pattern.SetScrollPercent(-1, percent)
-                for contact in contacts_window.ListControl().GetChildren():
-                    # 获取用户的昵称以及备注
-                    name = contact.TextControl().Name
-                    note = contact.ButtonControl(foundIndex=2).Name
-
-                    # 有备注的用备注，没有备注的用昵称
-                    if note == "":
-                        contacts.append(name)
-                    else:
-                        contacts.append(note)
-
-        # 返回去重过后的联系人列表
-        return list(set(contacts))
+                    # 根据这一步实际翻过的行数调整步长
+                    step *= stride / moved
+                    calibrated = True
+                percent, screen = target, current
 
-    # 获取所有群聊
-    def find_all_groups(self):
-        self.open_wechat()
-        self.get_wechat()
+        self.last_directory_scan = DirectoryScan(list(entries), rows_read, steps, time.perf_counter() - start)
+        return self.last_directory_scan
 
-        # 获取通讯录管理界面
-        click(auto.ButtonControl(Name=self.lc.contacts))
-        list_control = auto.ListControl(Name=self.lc.contact)
-        scroll_pattern = list_control.GetScrollPattern()
-        scroll_pattern.SetScrollPercent(-1, 0)
-        contacts_menu = list_control.ButtonControl(Name=self.lc.manage_contacts)
-        click(contacts_menu)
+    # 获取所有通讯录中所有联系人
+    @traced('find_all_contacts')
+    def find_all_contacts(self):
+        contacts_window = self._open_contacts_manager()
 
-        # 切换到通讯录管理界面
-        contacts_window = auto.GetForegroundControl()
+        def read_contact(contact):
+            # 获取用户的昵称以及备注
+            name = contact.TextControl().Name
+            note = contact.ButtonControl(foundIndex=2).Name
+            # 有备注的用备注，没有备注的用昵称
+            return name if note == "" else note
+
+        # 返回去重过后的联系人列表，扫描的行数和耗时记录在 self.last_directory_scan 中
+        return self._scan_list(contacts_window.ListControl(), read_contact).entries
+
+    # 获取所有群聊
+    @traced('find_all_groups')
+    def find_all_groups(self):
+        contacts_window = self._open_contacts_manager()
 
         # 点击最近群聊
         click(contacts_window.ButtonControl(Name="最近群聊"))
 
-        # 获取群聊列表
-        list_control = contacts_window.ListControl()
-        scroll_pattern = list_control.GetScrollPattern()
+        def read_group(group):
+            # 获取群聊的名称 (将所有的顿号替换成了空格，这样才能在搜索框搜索到)
+            return group.TextControl().Name.replace("、", " ")
 
-        # 读取群聊
-        contacts = []
-        # 如果不存在滑轮则直接读取
-        if scroll_pattern is None:
-            for contact in contacts_window.ListControl().GetChildren():
-                # 获取群聊的名称 (将所有的顿号替换成了空格，这样才能在搜索框搜索到)
-                name = contact.TextControl().Name.replace("、", " ")
-                contacts.append(name)
+        # 返回去重过后的群聊
+        return self._scan_list(contacts_window.ListControl(), read_group).entries
 
-        else:
-            for percent in np.arange(0, 1.002, 0.01):
-                scroll_pattern.SetScrollPercent(-1, percent)
-                for contact in contacts_window.ListControl().GetChildren():
-                    # 获取群聊的名称 (将所有的顿号替换成了空格，这样才能在搜索框搜索到)
-                    name = contact.TextControl().Name.replace("、", " ")
-                    contacts.append(name)
+    # 左侧会话列表
+    def _session_list(self):
+        return self.controls.get('session_list', lambda: self.get_wechat().ListControl(Name=self.lc.session))
 
-        # 返回去重过后的群聊
-        return list(set(contacts))
+    @traced('get_sessions')
+    def get_sessions(self) -> List[SessionRecord]:
+        """
+        读取左侧会话列表中当前显示的会话（名称、未读消息数、最后一条消息的预览），
+        整个列表只需要一次缓存请求；收到新消息的聊天会排到列表最前面
+        """
+        self.open_wechat()
+        chat_btn = self.controls.get('chats_button', lambda: self.get_wechat().ButtonControl(Name=self.lc.chats))
+        click(chat_btn)
+        return self.snapshots.sessions(self._session_list())
 
     # 检测微信是否收到新消息
+    @traced('check_new_msg')
     def check_new_msg(self):
+        self.conversation.invalidate()
         self.open_wechat()
-        self.get_wechat()
+        wechat = self.get_wechat()
 
         # 获取左侧聊天按钮
-        chat_btn = auto.ButtonControl(Name=self.lc.chats)
+        chat_btn = wechat.ButtonControl(Name=self.lc.chats)
         double_click(chat_btn)
 
         # 持续点击聊天按钮，直到获取完全部新消息
-        item = auto.ListItemControl(Depth=10)
+        item = wechat.ListItemControl(Depth=9)
         prev_name = item.ButtonControl().Name
 
         while True:
             # 判断该联系人是否有新消息
             pane_control = item.PaneControl()
             if len(pane_control.GetChildren()) == 3:
-                print(f"{item.ButtonControl().Name} 有新消息")
-                # 判断该联系人是否需要自动回复
-                if item.ButtonControl().Name in self.auto_reply_contacts:
-                    print(f"自动回复 {item.ButtonControl().Name}")
-                    self._auto_reply(item, self.auto_reply_msg)
+                session = self.snapshots.session(item)
+                print(f"{session.name} 有新消息")
+                # 按自动回复规则匹配最后一条消息
+                reply = self.auto_reply.reply(session.name, session.preview)
+                if reply is not None:
+                    print(f"自动回复 {session.name}")
+                    self._auto_reply(item, reply)
 
             click(item)
 
             # 跳转到下一个新消息
             double_click(chat_btn)
-            item = auto.ListItemControl(Depth=10)
+            item = wechat.ListItemControl(Depth=9)
 
             # 已经完成遍历，退出循环
             if prev_name == item.ButtonControl().Name:
@@ -294,11 +1222,12 @@ class WeChat:
 
     # 设置自动回复的联系人
     def set_auto_reply(self, contacts):
-        # contacts是一个列表
-        self.auto_reply_contacts = contacts
+        """contacts 中的联系人发来的任何消息都回复 self.auto_reply_msg，会替换 self.auto_reply 中的全部规则"""
+        self.auto_reply.set_rules([Rule(self.auto_reply_msg, contacts)] if contacts else [])
 
     # 自动回复
     def _auto_reply(self, element, text):
+        self.conversation.invalidate()
         click(element)
         pyperclip.copy(text)
         auto.SendKeys("{Ctrl}v")
@@ -307,30 +1236,30 @@ class WeChat:
     # 识别聊天内容的类型
     # 0：用户发送    1：时间信息  2：红包信息  3：”查看更多消息“标志 4：撤回消息
     def _detect_type(self, list_item_control: auto.ListItemControl) -> int:
+        return self._classify(self.snapshots.item(list_item_control))
+
+    @staticmethod
+    def _classify(record: MessageRecord) -> int:
         value = None
         # 判断内容框是否为时间框，如果是时间框则子控件不是PaneControl
-        if not isinstance(list_item_control.GetFirstChildControl(), auto.PaneControl):
+        if record.first_child_type != 'PaneControl':
             value = 1
 
         else:
-            cnt = 0
-            for child in list_item_control.PaneControl().GetChildren():
-                cnt += len(child.GetChildren())
-
             # 判断是否为用户发送的信息
-            if cnt > 0:
+            if record.content_count > 0:
                 value = 0
             # 判断是否为“查看更多消息”
-            elif list_item_control.Name == "查看更多消息":
+            elif record.name == "查看更多消息":
                 value = 3
             # 或者是红包信息
-            elif "红包" in list_item_control.Name or "red packet" in list_item_control.Name.lower():
+            elif "红包" in record.name or "red packet" in record.name.lower():
                 value = 2
             # 或者是撤回消息
-            elif "撤回了一条消息" in list_item_control.Name:
+            elif "撤回了一条消息" in record.name:
                 value = 4
             # 或者是新消息通知
-            elif "以下为新消息" in list_item_control.Name:
+            elif "以下为新消息" in record.name:
                 value = 6
 
         if value is None:
@@ -340,21 +1269,32 @@ class WeChat:
 
     # 获取聊天窗口
     def _get_chat_frame(self, name: str):
-        self.get_contact(name)
-        return auto.ListControl(Name=self.lc.message)
+        self._enter_chat(name, 'get_dialogs', focus_input=False)
+        return self._message_list()
 
-    def save_dialog_pictures(self, name: str, num: int, save_dir: str) -> None:
+    @traced('save_dialog_pictures')
+    def save_dialog_pictures(self, name: str, num: int, save_dir: str) -> List[dict]:
         """
-        保存指定聊天记录中的图片。图片的名字代表图片在聊天记录中的顺序，从1开始代表最新的图片。
+        保存指定聊天记录中的图片，从最新的图片开始往前保存。
+        图片在进程内复制并按内容的 sha256 命名，内容相同的图片只保存一次；
+        save_dir 中的 manifest.json 记录已经保存的图片和处理过的源文件，重复导出到同一个目录时不会再复制。
         Args:
             name: 聊天窗口的名字
-            num: 保存的最大数量（从最新图片开始保存）
+            num: 最多处理的图片数量（从最新图片开始，包括之前已经保存过的图片）
             save_dir: 保存的目录
+
+        Return:
+            本次处理的图片（从新到旧），元素为 {'sha256': 内容的 sha256, 'file': 保存的文件路径, 'new': 是否为本次新保存}；
+            无法复制的图片跳过，记录在 self.last_picture_failures 中
         """
+        os.makedirs(save_dir, exist_ok=True)
+        manifest = PictureManifest(save_dir)
+        self.last_picture_failures = []
 
         # 进入图片聊天记录界面
         self.get_contact(name)
-        click(auto.ButtonControl(Name=self.lc.chat_history, Depth=14))
+        self.conversation.invalidate()
+        click(self.get_wechat().ButtonControl(Name=self.lc.chat_history, Depth=13))
         click(auto.TabItemControl(Name=self.lc.photos_n_videos, Depth=6))
 
         # 图片栏控件
@@ -362,86 +1302,217 @@ class WeChat:
 
         # 如果图片数量 < num，则继续往上翻直到满足条件或无法上翻为止
         move(list_control.GetLastChildControl())
-        pictures = set()
-        cnt = 0
-        while cnt < num:
-            ori_cnt = cnt
+        results = []
+        digests = set()
+        # 已经处理过的图片控件，上翻之后只处理新出现的控件
+        visited = set()
+        while len(results) < num:
+            new_items = 0
             for list_item_control in list_control.GetChildren()[::-1]:
+                runtime_id = tuple(list_item_control.GetRuntimeId())
+                if runtime_id in visited:
+                    continue
+                visited.add(runtime_id)
+                new_items += 1
+
                 # 如果标签不是图片则跳过
                 if len(list_item_control.GetFirstChildControl().GetChildren()) == 3:
                     continue
 
-                if cnt < num:
-                    # 复制图片到剪切板
-                    right_click(list_item_control)
-                    menu = auto.ListControl(Depth=4)
-                    copy = menu.GetFirstChildControl()
-                    # 如果图片已经被清理则跳过
-                    if copy.Name != self.lc.copy:
-                        continue
-                    else:
-                        click(auto.MenuItemControl(Name=self.lc.copy, Depth=5))
-
-                    # 获取图片路径防止重复存储
-                    pic_hash = ImageGrab.grabclipboard()[0]
-
-                    # 获取后缀
-                    suffix = pic_hash.split(".")[-1]
-
-                    # 保存图片
-                    if pic_hash not in pictures:
-                        cnt += 1
-                        pictures.add(pic_hash)
-                        save_path = os.path.join(save_dir, f"{cnt}.{suffix}")
-                        os.system(f"copy \"{pic_hash}\" \"{save_path}\"")
+                # 复制图片到剪切板，获取图片的源文件路径
+                source = self._copy_picture_path(list_item_control)
+                # 如果图片已经被清理则跳过
+                if source is None:
+                    continue
+
+                # 复制之前源文件被清理或无法读取时跳过这张图片，不影响其他图片
+                try:
+                    sha256, new = export_picture(source, manifest)
+                except OSError as e:
+                    self.last_picture_failures.append({'source': source, 'error': str(e)})
+                    continue
+                if sha256 not in digests:
+                    digests.add(sha256)
+                    results.append({'sha256': sha256, 'file': manifest.file_of(sha256), 'new': new})
+                    if len(results) >= num:
+                        break
+
+            # 每翻一页保存一次，中断后重新导出时已经复制过的图片会被跳过
+            manifest.save()
+            # 上翻之后没有出现新的图片，说明已经到顶
+            if new_items == 0:
+                break
             # 上滑
             pyautogui.scroll(300)
-            # 如果无法上滑则退出
-            if ori_cnt == cnt:
+        return results
+
+    def _copy_picture_path(self, list_item_control):
+        """通过右键菜单复制图片，返回图片的源文件路径，图片已经被清理时返回 None"""
+        right_click(list_item_control)
+        menu = auto.ListControl(Depth=4)
+        copy = menu.GetFirstChildControl()
+        if copy is None or copy.Name != self.lc.copy:
+            return None
+        click(auto.MenuItemControl(Name=self.lc.copy, Depth=5))
+        return ImageGrab.grabclipboard()[0]
+
+    # 解析一条聊天内容的快照，v 为 _classify 的结果
+    @staticmethod
+    def _parse_item(record: MessageRecord, v):
+        name = record.sender if v == 0 else ''
+        return VALUE_TO_INFO[v], name, record.name
+
+    def _read_until_anchor(self, list_control, history: DialogHistory):
+        """
+        从最新的一条消息开始往上读取，直到读到 history 中最新的那一行（RuntimeId 相同，内容也相同）
+        Return:
+            (锚点之后的新消息（从旧到新）, 最新一行的 RuntimeId)；
+            往上读了 max_walk 行或读到顶部仍找不到锚点时返回 None
+        """
+        if history.anchor_id is None:
+            return None
+        read = []  # 从新到旧
+        newest_id = None
+        item = list_control.GetLastChildControl()
+        for _ in range(self.dialog_cache.max_walk + 1):
+            if item is None:
+                break
+            runtime_id = item.GetRuntimeId()
+            record = self.snapshots.item(item)
+            v = self._classify(record)
+            if runtime_id == history.anchor_id:
+                # 列表重建后 RuntimeId 可能被其他行复用，内容不一致时按找不到处理
+                if v in TRANSIENT_TYPES or [self._parse_item(record, v)] != history.last(1):
+                    return None
+                return read[::-1], newest_id or runtime_id
+            if v not in TRANSIENT_TYPES:
+                read.append(self._parse_item(record, v))
+                newest_id = newest_id or runtime_id
+            item = item.GetPreviousSiblingControl()
+        return None
+
+    def _newest_row_id(self, list_control, records: List[MessageRecord]):
+        """records（整个列表的快照）中最新一条不是临时行的消息所在行的 RuntimeId"""
+        item = list_control.GetLastChildControl()
+        for record in reversed(records):
+            if item is None:
+                return None
+            if self._classify(record) not in TRANSIENT_TYPES:
+                return item.GetRuntimeId()
+            item = item.GetPreviousSiblingControl()
+        return None
+
+    def _read_incremental(self, name, list_control, min_cached: int = 1):
+        """
+        使用聊天记录缓存增量读取，返回更新后的缓存；缓存不可用（不足 min_cached 条、过期或找不到指纹）时返回 None
+        """
+        history = self.dialog_cache.get(name)
+        if history is None or len(history) < min_cached:
+            return None
+        found = self._read_until_anchor(list_control, history)
+        if found is None:
+            return None
+        history.extend(*found)
+        self.dialog_cache.incremental_reads += 1
+        return history
+
+    @traced('load_history')
+    def _load_history(self, list_control, rows: int, n_rows: int) -> HistoryLoad:
+        """
+        不断点击列表顶部的“查看更多消息”，直到列表中至少有 n_rows 行、没有更早的聊天记录或超过时间上限。
+        每次点击后只从列表顶部往下数到点击前的第一条消息，不重新枚举整个列表。
+        Args:
+            list_control: 聊天记录列表
+            rows: 当前列表中的行数（包括“查看更多消息”）
+            n_rows: 需要的行数
+        """
+        start = time.perf_counter()
+        deadline = start + self.wait_timeouts['load_history']
+        scroll_pattern = list_control.GetScrollPattern()
+        pages = 0
+        exhausted = timed_out = False
+
+        first = list_control.GetFirstChildControl()
+        while rows < n_rows:
+            if time.perf_counter() >= deadline:
+                timed_out = True
+                break
+            # 顶部不是“查看更多消息”，说明已经没有更早的聊天记录
+            if first is None or self._detect_type(first) != 3:
+                exhausted = True
                 break
+            anchor = first.GetNextSiblingControl()
+            if anchor is None:
+                exhausted = True
+                break
+            anchor_id = anchor.GetRuntimeId()
+
+            # 如果滑轮存在，将聊天记录翻到“查看更多消息”
+            if scroll_pattern:
+                scroll_pattern.SetScrollPercent(-1, 0)
+            clicked_id = first.GetRuntimeId()
+            click(first)
+            pages += 1
+            # 新的一页是异步加载的，等它出现之后再判断是否还有更早的消息
+            self._wait('load_page', lambda: self._history_loaded(list_control, clicked_id, anchor))
+
+            # 从顶部往下数到点击前的第一条消息，新加载的行都在它上面
+            first = list_control.GetFirstChildControl()
+            item, steps = first, 0
+            while item is not None and item.GetRuntimeId() != anchor_id:
+                steps += 1
+                item = item.GetNextSiblingControl()
+            # 找不到点击前的消息（列表被重建）或没有加载出新的消息
+            if item is None or steps <= 1:
+                exhausted = item is not None
+                break
+            # 点击前的“查看更多消息”已经被新加载的行替换
+            rows += steps - 1
+
+        elapsed = time.perf_counter() - start
+        self.last_history_load = HistoryLoad(rows, pages, elapsed, exhausted, timed_out)
+        self.waits.record('load_history', elapsed, not timed_out)
+        return self.last_history_load
 
     # 获取指定聊天窗口的聊天记录
-    def get_dialogs(self, name: str, n_msg: int, search_user: bool = True) -> List:
+    @traced('get_dialogs')
+    def get_dialogs(self, name: str, n_msg: int, search_user: bool = True, use_cache: bool = True) -> List:
         """
         Args:
             name: 聊天窗口的姓名
             n_msg: 获取聊天记录的最大数量（从最后一条往上算）
             search_user: 是否需要搜索用户
+            use_cache: 缓存中已有足够的聊天记录时，只读取新增的消息
+            加载更早聊天记录的页数和耗时记录在 self.last_history_load 中
 
         Return:
             dialogs: 聊天记录列表，内部元素为三元组（信息类型，发送人，发送内容）
         """
+        self.last_history_load = None
         if search_user:
             list_control = self._get_chat_frame(name)
         else:
-            list_control = auto.ListControl(Name=self.lc.message)
-        scroll_pattern = list_control.GetScrollPattern()
+            list_control = self._message_list()
+
+        if use_cache:
+            history = self._read_incremental(name, list_control, min_cached=n_msg)
+            if history is not None:
+                return history.last(n_msg)
 
+        # 整个列表的快照只需要一次读取
+        records = self.snapshots.items(list_control)
         # 如果聊天记录数量 < n_msg，则继续往上翻直到满足条件或无法上翻为止
-        while len(list_control.GetChildren()) < n_msg:
-            # 如果滑轮存在，将聊天记录翻到“查看更多消息”
-            if scroll_pattern:
-                scroll_pattern.SetScrollPercent(-1, 0)
-            # 如果无法上翻则退出
-            first_item = list_control.GetFirstChildControl()
-            if self._detect_type(first_item) != 3:
-                break
-            # 否则点击“查看更多消息”
-            else:
-                click(first_item)
+        if len(records) < n_msg and records and self._classify(records[0]) == 3:
+            self._load_history(list_control, len(records), n_msg)
+            records = self.snapshots.items(list_control)
 
         cnt = 0
         dialogs = []
-        value_to_info = {0: '用户发送', 1: '时间信息', 2: '红包信息', 3: '"查看更多消息"标志', 4: '撤回消息',
-                         5: "System Notification", 6: '"以下是新消息"标志'}
-        # 从下往上依次记录聊天内容。
-        for list_item_control in list_control.GetChildren()[::-1]:
-            v = self._detect_type(list_item_control)
-            msg = list_item_control.Name
-            name = list_item_control.ButtonControl().Name if v == 0 else ''
-
+        # 从下往上依次记录聊天内容
+        for record in records[::-1]:
+            v = self._classify(record)
             cnt += 1
-            dialogs.append((value_to_info[v], name, msg))
+            dialogs.append(self._parse_item(record, v))
 
             # 如果达到n_msg则退出
             if cnt == n_msg:
@@ -449,8 +1520,54 @@ class WeChat:
 
         # 将聊天记录列表翻转
         dialogs = dialogs[::-1]
+
+        # 更新缓存，之后的读取只需要读新增的消息
+        self.dialog_cache.history(name).reset([d for d in dialogs if d[0] not in
+                                               [VALUE_TO_INFO[v] for v in TRANSIENT_TYPES]],
+                                              self._newest_row_id(list_control, records))
+        self.dialog_cache.full_reads += 1
         return dialogs
 
+    @traced('get_dialogs_since')
+    def get_dialogs_since(self, name: str, since: int = 0, search_user: bool = True):
+        """
+        增量获取聊天记录：只返回游标 since 之后的新消息
+        Args:
+            name: 聊天窗口的姓名
+            since: 上一次返回的游标，0 表示返回当前已加载的全部聊天记录
+            search_user: 是否需要搜索用户
+
+        Return:
+            (cursor, dialogs, reset)
+            cursor: 最新消息的游标，下次请求时传入
+            dialogs: since 之后的新消息（从旧到新）
+            reset: 缓存被重新建立或部分消息已经被移出缓存，dialogs 可能与之前返回的内容重复或不连续
+        """
+        if search_user:
+            list_control = self._get_chat_frame(name)
+        else:
+            list_control = self._message_list()
+
+        history = self._read_incremental(name, list_control)
+        reset = False
+        if history is None:
+            # 没有可用的缓存，读取当前已加载的全部聊天记录重新建立缓存
+            dialogs = []
+            records = self.snapshots.items(list_control)
+            for record in records:
+                v = self._classify(record)
+                if v not in TRANSIENT_TYPES:
+                    dialogs.append(self._parse_item(record, v))
+            history = self.dialog_cache.history(name)
+            reset = since > 0
+            history.reset(dialogs, self._newest_row_id(list_control, records))
+            self.dialog_cache.full_reads += 1
+
+        if since > 0 and since + 1 < history.first_seq():
+            reset = True
+        return history.cursor, history.since(since), reset
+
+    @traced('get_dialogs_by_time_blocks')
     def get_dialogs_by_time_blocks(self, name: str, n_time_blocks: int, search_user: bool = True) -> List[List]:
         """
         获取指定聊天窗口的聊天记录，并按时间信息分组。
@@ -461,47 +1578,47 @@ class WeChat:
         Return:
             groups: 聊天记录列表，每个元素为一个时间分块内的消息列表
         """
-        n_msg = n_time_blocks * 5
-        prev_dialogs = None
-        groups = []
-        while True:
-            dialogs = self.get_dialogs(name, n_msg, search_user)
-
-            # 如果获取的dialogs和之前一样，说明没有更多消息了，退出循环
-            if prev_dialogs == dialogs:
-                break
-            # 分组逻辑调整：处理顺序改为从最新消息到最早消息
-            groups = []
-            current_group = None
-
-            # 遍历所有消息，按照时间信息分组
-            for msg in dialogs:
-                # 遇见时间信息则新建一个分组
-                if msg[0] == '时间信息':
-                    # 将上一个分组加入到groups中
-                    if current_group is not None:
-                        groups.append(current_group)
-
-                    # 初始化新的分组
-                    current_group = [msg]
-
-                elif current_group is not None:
-                    current_group.append(msg)
-
-            # 将最后一个分组加入到groups中
-            if current_group is not None:
-                groups.append(current_group)
-
-            # 获取n_time_blocks个时间块，取groups的最后n_time_blocks个元素
-            if len(groups) >= n_time_blocks:
-                groups = groups[-n_time_blocks:]
-                break
-            else:
-                prev_dialogs = dialogs
-                n_msg *= 2
-                search_user = False  # 后续不需要再次搜索用户
+        if search_user:
+            list_control = self._get_chat_frame(name)
+        else:
+            list_control = self._message_list()
+        scroll_pattern = list_control.GetScrollPattern()
 
-        return groups
+        # 从最新的消息开始往上读取，每读到一条时间信息就得到一个完整的时间分块；
+        # 读到顶部的“查看更多消息”时加载下一页，从上一页最早的消息继续往上读，已经读过的消息不会重复读取
+        groups = []  # 从新到旧
+        current_group = []  # 从新到旧
+        oldest = None
+        loading = False
+        item = list_control.GetLastChildControl()
+        while item is not None and len(groups) < n_time_blocks:
+            record = self.snapshots.item(item)
+            v = self._classify(record)
+            if v == 3:
+                # 点击后没有加载出新的消息，说明无法继续上翻
+                if loading:
+                    break
+                loading = True
+                # 已加载的聊天记录读完，加载更早的一页
+                if scroll_pattern:
+                    scroll_pattern.SetScrollPercent(-1, 0)
+                clicked_id = item.GetRuntimeId()
+                click(item)
+                self._wait('load_page', lambda: self._history_loaded(list_control, clicked_id, oldest))
+                item = oldest.GetPreviousSiblingControl() if oldest is not None else list_control.GetLastChildControl()
+                continue
+
+            loading = False
+            current_group.append(self._parse_item(record, v))
+            # 遇见时间信息则当前分块已经完整
+            if v == 1:
+                groups.append(current_group[::-1])
+                current_group = []
+            oldest = item
+            item = item.GetPreviousSiblingControl()
+
+        # 第一条时间信息之前的消息不属于任何完整的分块，直接丢弃
+        return groups[::-1]
 
 
 if __name__ == '__main__':
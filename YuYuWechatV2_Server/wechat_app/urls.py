@@ -2,12 +2,31 @@
 
 from django.urls import path
 
-from .views import send_message, ping, check_wechat_status, get_dialogs_view, get_dialogs_by_time_blocks_view
+from .directory import CONTACT, GROUP
+from .views import send_message, send_batch, send_files, job_status, jobs_status, queue_stats, ping, check_wechat_status, get_dialogs_view, \
+    get_dialogs_by_time_blocks_view, directory_list, directory_refresh, delivery_status, deliveries_status, \
+    export_pictures, accounts_status, metrics, watch, watch_events, auto_reply
 
 urlpatterns = [
     path('ping/', ping, name='ping'),
     path('send_message/', send_message, name='send_message'),
+    path('send_batch/', send_batch, name='send_batch'),
+    path('send_files/', send_files, name='send_files'),
+    path('jobs/', jobs_status, name='jobs_status'),
+    path('jobs/<str:job_id>/', job_status, name='job_status'),
+    path('deliveries/', deliveries_status, name='deliveries_status'),
+    path('deliveries/<str:delivery_id>/', delivery_status, name='delivery_status'),
+    path('queue_stats/', queue_stats, name='queue_stats'),
+    path('accounts/', accounts_status, name='accounts_status'),
+    path('metrics/', metrics, name='metrics'),
+    path('watch/', watch, name='watch'),
+    path('watch/events/', watch_events, name='watch_events'),
+    path('auto_reply/', auto_reply, name='auto_reply'),
     path('check_wechat_status/', check_wechat_status, name='check_wechat_status'),
     path('get_dialogs/', get_dialogs_view, name='get_dialogs'),
     path('get_dialogs_by_time_blocks/', get_dialogs_by_time_blocks_view, name='get_dialogs_by_time_blocks'),
+    path('export_pictures/', export_pictures, name='export_pictures'),
+    path('contacts/', directory_list, {'kind': CONTACT}, name='contacts'),
+    path('groups/', directory_list, {'kind': GROUP}, name='groups'),
+    path('directory/refresh/', directory_refresh, name='directory_refresh'),
 ]
\ No newline at end of file
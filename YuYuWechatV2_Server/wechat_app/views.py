@@ -1,45 +1,234 @@
 import json
+import math
+import os
+import re
 import threading
-from queue import Queue, Empty
+from functools import partial
 
-import comtypes
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 
-from .ui_auto_wechat import WeChat
-
-# 初始化 WeChat 类实例
-wechat = WeChat(path="C:/Program Files/Tencent/WeChat/WeChat.exe", locale="zh-CN")
+from .accounts import AccountPool, DEFAULT_ACCOUNT, DEFAULT_PATH
+from .autoreply import Rule
+from .directory import CONTACT, KINDS
+from .idempotency import IdempotencyIndex, IdempotencyConflict
+from .jobs import Job, JobGroup, JobStore, SUCCEEDED, QUEUED
+from .metrics import render_prometheus
+from .pictures import zip_stream
+from .scheduler import INTERACTIVE, BACKGROUND
+
+# 保存任务状态，所有账号共用，已完成的任务最多保留 1000 个、1 小时
+job_store = JobStore(max_finished=1000, ttl=3600)
+
+# 同步请求等待任务完成的最长时间（秒），超时后返回 job id，可以之后再查询结果
+SYNC_TIMEOUT = 300
+
+# 微信账号：每个账号有自己的 WeChat 实例、带优先级通道的队列（interactive > scheduled > background）
+# 和唯一操作该账号微信界面的执行线程；通讯录缓存的扫描结果 24 小时后过期；
+# WECHAT_TRACING 为 False 时不统计界面操作的分步耗时；WECHAT_PACING 为发送限速的参数，为 None 时不限速；
+# WECHAT_COALESCE_WINDOW 为允许合并的文本消息在队列中等待的秒数
+accounts = AccountPool.from_settings(
+    getattr(settings, 'WECHAT_ACCOUNTS', {DEFAULT_ACCOUNT: {'path': DEFAULT_PATH, 'locale': 'zh-CN'}}),
+    job_store, directory_ttl=24 * 3600, tracing=getattr(settings, 'WECHAT_TRACING', True),
+    pacing=getattr(settings, 'WECHAT_PACING', None),
+    coalesce_window=getattr(settings, 'WECHAT_COALESCE_WINDOW', 2.0))
+
+# 默认账号，请求中没有指定 account 时使用
+wechat = accounts.default.wechat
+message_queue = accounts.default.queue
+ui_executor = accounts.default.executor
+directory = accounts.default.directory
+
+# 发送消息后的校验方式：strict 发送后马上读取聊天记录校验；deferred 发送后马上返回，之后在后台对每个联系人
+# 读取一次聊天记录批量校验，需要调用方通过 delivery_id 查询校验结果。请求中可以通过 verify 字段指定
+VERIFY_MODES = ('deferred', 'strict')
+DEFAULT_VERIFY = 'strict'
+
+# 新消息监听扫描会话列表的间隔（秒），为 None 时不自动开启
+WATCH_INTERVAL = getattr(settings, 'WECHAT_WATCH_INTERVAL', None)
+if WATCH_INTERVAL:
+    for _account in accounts.all():
+        _account.watcher.interval = WATCH_INTERVAL
+        _account.watcher.start()
+
+# SSE 连接在没有新消息时发送心跳的间隔（秒）
+SSE_HEARTBEAT = 15
+
+# send_message 的幂等键，最多保存 10000 个、24 小时
+idempotency = IdempotencyIndex(max_keys=10000, ttl=24 * 3600)
+
+# 导出的聊天图片保存在这个目录下，每个账号、每个聊天一个子目录
+PICTURE_DIR = os.path.join(settings.BASE_DIR, 'pictures')
+
+# 延迟校验出错后重新校验的等待时间（秒），每多失败一次加倍，失败次数上限见 DeliveryTracker.max_attempts
+VERIFY_RETRY_DELAY = 5.0
+
+# 每个账号的每个联系人排队中的校验任务，同一联系人连续发送的消息只需要校验一次；任务完成后移除
+verification_jobs = {}
+verification_lock = threading.Lock()
+
+
+# 发送单条消息
+def send_message_task(account, name, text):
+    success = account.wechat.send_msg(name, text)
+    if success:
+        return True, {'status': 'Message sent', 'name': name}
+    else:
+        return False, {'status': 'Failed to send message', 'name': name}
 
-# 创建一个队列
-message_queue = Queue()
 
-# 创建一个锁
-lock = threading.Lock()
+# 发送单条消息但不马上校验，返回发送记录的 id，校验结果通过 /wechat/deliveries/<id>/ 查询
+def submit_message_task(account, name, text):
+    delivery_id = account.wechat.submit_msg(name, text)
+    schedule_verification(account, name)
+    return True, {'status': 'Message submitted', 'name': name, 'delivery_id': delivery_id}
 
 
-# 处理队列中的消息
-def process_queue():
-    while True:
+# 合并发送排队中发给同一联系人的多条文本，texts 与合并的任务一一对应，返回每个任务自己的结果
+def send_texts_task(account, name, verify, texts):
+    delivery_ids = account.wechat.send_texts(name, texts)
+    if verify == 'strict':
+        statuses = {record['id']: record['status'] for record in account.wechat.verify_deliveries(name)}
+    else:
+        schedule_verification(account, name)
+
+    results = []
+    for ids in delivery_ids:
+        if verify == 'strict':
+            success = all(statuses.get(record_id) == 'verified' for record_id in ids)
+            status = 'Message sent' if success else 'Failed to send message'
+        else:
+            success, status = True, 'Message submitted'
+        result = {'status': status, 'name': name, 'delivery_id': ids[0], 'coalesced': len(texts)}
+        if len(ids) > 1:
+            # 超过长度上限的文本拆成了多条消息
+            result['delivery_ids'] = ids
+        results.append((success, result))
+    return results
+
+
+# 校验发给该联系人的全部未校验消息
+def verify_deliveries_task(account, name):
+    try:
+        records = account.wechat.verify_deliveries(name)
+    except Exception:
+        retry_verification(account, name)
+        raise
+    finally:
+        # 执行期间可能已经为之后发送的消息提交了新的校验任务，只移除不在排队中的
+        key = (account.name, name)
+        with verification_lock:
+            job = verification_jobs.get(key)
+            if job is not None and job.status != QUEUED:
+                del verification_jobs[key]
+    verified = sum(1 for record in records if record['status'] == 'verified')
+    return verified == len(records), {'status': 'Deliveries verified', 'name': name, 'verified': verified,
+                                      'failed': len(records) - verified}
+
+
+def schedule_verification(account, name):
+    """该联系人没有排队中的校验任务时提交一个，校验属于后台任务，会在这一批发送完成之后执行"""
+    key = (account.name, name)
+    with verification_lock:
+        job = verification_jobs.get(key)
+        if job is None or job.status != QUEUED:
+            verification_jobs[key] = account.submit('verify_deliveries', partial(verify_deliveries_task, account, name),
+                                                    {'status': 'Error verifying deliveries', 'name': name},
+                                                    BACKGROUND)
+        return verification_jobs[key]
+
+
+def retry_verification(account, name):
+    """校验出错后记录已经放回等待校验，按失败次数退避一段时间再提交校验任务；失败次数达到上限的记录已经标记为 failed"""
+    attempts = account.wechat.deliveries.attempts(name)
+    if attempts:
+        timer = threading.Timer(VERIFY_RETRY_DELAY * 2 ** (attempts - 1), schedule_verification, (account, name))
+        timer.daemon = True
+        timer.start()
+
+
+# 一次粘贴发送多个文件，超过每次粘贴的上限时分批发送
+def send_files_task(account, name, paths):
+    results = account.wechat.send_files(name, paths)
+    sent = sum(1 for r in results if r['status'] == 'sent')
+    return sent == len(results), {'status': 'Files processed', 'name': name, 'sent': sent,
+                                  'failed': len(results) - sent, 'results': results}
+
+
+# 批量发送消息，groups 为按联系人分组后的 [(name, [(index, kind, content), ...]), ...]，返回每条消息的结果
+def send_batch_task(account, groups):
+    results = []
+    for name, items in groups:
         try:
-            name, text, response_queue = message_queue.get()
-            try:
-                comtypes.CoInitialize()
-                with lock:  # 确保微信操作的线程安全
-                    success = wechat.send_msg(name, text)
-                if success:
-                    response_queue.put({'status': 'Message sent', 'name': name})
-                else:
-                    response_queue.put({'status': 'Failed to send message', 'name': name})
-            except Exception as e:
-                response_queue.put({'status': 'Error sending message', 'name': name, 'error': str(e)})
-            message_queue.task_done()
-        except Empty:
-            pass
+            sent = account.wechat.send_batch(name, [(kind, content) for _, kind, content in items])
+            for (index, kind, _), success in zip(items, sent):
+                status = 'Message sent' if success else 'Failed to send message'
+                results.append({'index': index, 'name': name, 'type': kind, 'status': status})
+        except Exception as e:
+            # 该联系人发送失败，继续处理下一个联系人
+            for index, kind, _ in items:
+                results.append({'index': index, 'name': name, 'type': kind, 'status': 'Error sending message',
+                                'error': str(e)})
+    success = all(r['status'] == 'Message sent' for r in results)
+    return success, {'status': 'Batch part processed', 'results': results}
+
+
+# 汇总批量发送拆分出的各个任务的结果
+def summarize_batch(groups, parts):
+    results = sorted((r for part in parts for r in part.get('results', ())), key=lambda r: r['index'])
+    total = sum(len(items) for _, items in groups)
+    sent = sum(1 for r in results if r['status'] == 'Message sent')
+    return sent == total, {'status': 'Batch processed', 'recipients': len(groups), 'sent': sent,
+                           'failed': total - sent, 'results': results}
+
+
+# 扫描通讯录中的联系人或群聊，结果保存到通讯录缓存
+def directory_scan_task(account, kind):
+    wechat = account.wechat
+    names = wechat.find_all_contacts() if kind == CONTACT else wechat.find_all_groups()
+    record = account.directory.apply_scan(kind, names, wechat.last_directory_scan)
+    return True, {'status': 'Directory refreshed', 'kind': kind, 'entries': record.entries,
+                  'added': record.added, 'removed': record.removed, 'elapsed': record.elapsed}
+
+
+def submit_job(account, kind, task, error_info=None, lane=INTERACTIVE, pace=None, coalesce=None):
+    """
+    创建任务并加入该账号执行线程队列的指定通道，发送任务通过 pace 指定 (联系人, 消息条数) 参与限速，
+    允许合并的任务通过 coalesce 指定 (合并键, 任务内容, 合并执行的函数)
+    """
+    return account.submit(kind, task, error_info, lane, pace, coalesce)
+
+
+def get_account(name):
+    """请求中没有指定 account 时使用默认账号，账号不存在时返回 None"""
+    return accounts.default if name is None else accounts.get(name)
+
+
+def unknown_account_response(name):
+    return JsonResponse({'error': f"Unknown account: {name}, must be one of {', '.join(accounts.names())}"},
+                        status=400)
+
 
+def invalid_lane_response(lane):
+    """请求中的 lane 不合法时返回 400 响应，合法时返回 None"""
+    if lane not in message_queue.lanes:
+        return JsonResponse({'error': f"Invalid lane: {lane}, must be one of {', '.join(message_queue.lanes)}"},
+                            status=400)
+    return None
 
-# 启动一个线程来处理队列
-threading.Thread(target=process_queue, daemon=True).start()
+
+def job_response(job, is_async=False):
+    """
+    异步模式直接返回 job id；同步模式等待任务完成后返回结果，超过 SYNC_TIMEOUT 返回 504 和 job id
+    """
+    if is_async:
+        return JsonResponse({'job_id': job.id, 'status': job.status}, status=202)
+
+    if not job.wait(SYNC_TIMEOUT):
+        return JsonResponse({'status': 'Timeout', 'job_id': job.id, 'job_status': job.status}, status=504)
+    return JsonResponse(job.result, status=200 if job.status == SUCCEEDED else 500,
+                        json_dumps_params={'ensure_ascii': False})
 
 
 @csrf_exempt
@@ -50,21 +239,380 @@ def send_message(request):
             name = data['name']
             text = data['text']
 
-            # 用于存储处理结果的队列
-            response_queue = Queue()
+            lane = data.get('lane', INTERACTIVE)
+            error = invalid_lane_response(lane)
+            if error:
+                return error
+
+            account = get_account(data.get('account'))
+            if account is None:
+                return unknown_account_response(data.get('account'))
+
+            verify = data.get('verify', DEFAULT_VERIFY)
+            if verify not in VERIFY_MODES:
+                return JsonResponse({'error': f"Invalid verify: {verify}, must be one of {', '.join(VERIFY_MODES)}"},
+                                    status=400)
+            task = send_message_task if verify == 'strict' else submit_message_task
+
+            # coalesce 为 true 时，短时间内发给同一联系人的文本会与这条消息合并成一次粘贴发送
+            coalesce = None
+            if data.get('coalesce', False):
+                coalesce = (('send_message', name, verify), text, partial(send_texts_task, account, name, verify))
+
+            # 将消息加入队列，async 为 true 时不等待发送结果
+            def submit():
+                return submit_job(account, 'send_message', partial(task, account, name, text),
+                                  {'status': 'Error sending message', 'name': name}, lane, pace=(name, 1),
+                                  coalesce=coalesce)
+
+            # 带幂等键的重复请求直接返回第一次请求的任务，不再操作微信界面
+            key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+            if key:
+                try:
+                    job, replayed = idempotency.submit((account.name, str(key)), (name, text), submit)
+                except IdempotencyConflict as e:
+                    return JsonResponse({'error': str(e)}, status=409)
+            else:
+                job, replayed = submit(), False
 
-            # 将消息加入队列
-            message_queue.put((name, text, response_queue))
+            response = job_response(job, data.get('async', False))
+            if replayed:
+                response['Idempotent-Replayed'] = 'true'
+            return response
+        except (KeyError, json.JSONDecodeError):
+            return JsonResponse({'error': 'Invalid request, missing name or text'}, status=400)
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
 
-            # 等待处理结果
-            result = response_queue.get()
 
-            if result['status'] == 'Message sent':
-                return JsonResponse(result, status=200)
-            else:
-                return JsonResponse(result, status=500)
+def group_by_recipient(items):
+    """
+    将批量发送的内容按联系人分组，联系人按第一次出现的顺序排列，同一联系人的内容保持原有顺序
+    Return:
+        [(name, [(index, kind, content), ...]), ...]
+    """
+    groups = {}
+    for index, item in enumerate(items):
+        kind = 'file' if 'file' in item else 'text'
+        groups.setdefault(item['name'], []).append((index, kind, item[kind]))
+    return list(groups.items())
+
+
+def split_batch(groups, size=None):
+    """
+    把每个联系人的内容按每 size 条拆成一个任务，size 为 None 时每个联系人一个任务
+    Return:
+        [(name, [(index, kind, content), ...]), ...]
+    """
+    return [(name, items[start:start + (size or len(items))])
+            for name, items in groups for start in range(0, len(items), size or len(items))]
+
+
+@csrf_exempt
+def send_batch(request):
+    """
+    批量发送消息，请求体为 {"items": [{"name": ..., "text": ...}, {"name": ..., "file": ...}, ...]}
+    同一联系人的消息会被放在一起发送，每个联系人只搜索一次、校验一次。
+    每个联系人的消息作为单独的任务排队并各自参与限速，超过限速 burst 的部分再拆成多个任务，
+    中间可以插入其他任务；返回的 job 在所有任务完成后汇总结果
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            items = data['items']
         except (KeyError, json.JSONDecodeError):
-            return JsonResponse({'error': 'Invalid request, missing name or text'}, status=400)
+            return JsonResponse({'error': 'Invalid request, missing items'}, status=400)
+
+        if not isinstance(items, list) or not items:
+            return JsonResponse({'error': 'items must be a non-empty list'}, status=400)
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not item.get('name') or ('text' in item) == ('file' in item):
+                return JsonResponse({'error': f'Invalid item {index}: name and exactly one of text or file '
+                                              f'are required'}, status=400)
+
+        lane = data.get('lane', INTERACTIVE)
+        error = invalid_lane_response(lane)
+        if error:
+            return error
+
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+
+        groups = group_by_recipient(items)
+        pacer = account.queue.pacer
+        parts = split_batch(groups, pacer.burst if pacer is not None else None)
+        job = job_store.add(Job('send_batch', None, {'status': 'Error sending message'}, lane, account.name))
+        batch = JobGroup(job, len(parts), job_store, partial(summarize_batch, groups))
+        for name, part in parts:
+            submit_job(account, 'send_batch', partial(batch.run, partial(send_batch_task, account, [(name, part)])),
+                       {'status': 'Error sending message', 'name': name}, lane, pace=(name, len(part)))
+        return job_response(job, data.get('async', False))
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def send_files(request):
+    """
+    向同一个联系人发送多个文件，请求体为 {"name": ..., "paths": [...]}
+    所有文件放到剪切板后一次粘贴发送，返回每个文件的发送结果
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            name = data['name']
+            paths = data['paths']
+        except (KeyError, json.JSONDecodeError):
+            return JsonResponse({'error': 'Invalid request, missing name or paths'}, status=400)
+
+        if not isinstance(paths, list) or not paths or not all(isinstance(p, str) and p for p in paths):
+            return JsonResponse({'error': 'paths must be a non-empty list of file paths'}, status=400)
+
+        lane = data.get('lane', INTERACTIVE)
+        error = invalid_lane_response(lane)
+        if error:
+            return error
+
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+
+        # 每次粘贴算作一条消息
+        pastes = math.ceil(len(paths) / account.wechat.MAX_FILES_PER_PASTE)
+        job = submit_job(account, 'send_files', partial(send_files_task, account, name, paths),
+                         {'status': 'Error sending files', 'name': name}, lane, pace=(name, pastes))
+        return job_response(job, data.get('async', False))
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def job_status(request, job_id):
+    """
+    查询单个任务的状态：queued、running、succeeded 或 failed
+    """
+    if request.method == 'GET':
+        job = job_store.get(job_id)
+        if job is None:
+            return JsonResponse({'error': 'Job not found or expired', 'id': job_id}, status=404)
+        return JsonResponse(job.to_dict(), json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def jobs_status(request):
+    """
+    批量查询任务状态，请求体为 {"ids": [...]}，不存在或已过期的 id 放在 missing 中返回
+    """
+    if request.method == 'POST':
+        try:
+            ids = json.loads(request.body)['ids']
+            if not isinstance(ids, list):
+                raise ValueError
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'Invalid request, ids must be a list'}, status=400)
+
+        jobs, missing = [], []
+        for job_id in ids:
+            job = job_store.get(str(job_id))
+            if job is None:
+                missing.append(job_id)
+            else:
+                jobs.append(job.to_dict())
+        return JsonResponse({'jobs': jobs, 'missing': missing}, json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def delivery_status(request, delivery_id):
+    """
+    查询延迟校验的发送记录：submitted（已发送，等待校验）、verified 或 failed
+    """
+    if request.method == 'GET':
+        _, record = accounts.find_delivery(delivery_id)
+        if record is None:
+            return JsonResponse({'error': 'Delivery not found or expired', 'id': delivery_id}, status=404)
+        return JsonResponse(record, json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def deliveries_status(request):
+    """
+    批量查询发送记录，请求体为 {"ids": [...]}，不存在或已过期的 id 放在 missing 中返回
+    """
+    if request.method == 'POST':
+        try:
+            ids = json.loads(request.body)['ids']
+            if not isinstance(ids, list):
+                raise ValueError
+        except (KeyError, ValueError):
+            return JsonResponse({'error': 'Invalid request, ids must be a list'}, status=400)
+
+        deliveries, missing = [], []
+        for delivery_id in ids:
+            _, record = accounts.find_delivery(str(delivery_id))
+            if record is None:
+                missing.append(delivery_id)
+            else:
+                deliveries.append(record)
+        return JsonResponse({'deliveries': deliveries, 'missing': missing}, json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def queue_stats(request):
+    """
+    各个队列通道的排队数量和等待时间，以及 send_message 幂等键的重复请求命中率，
+    参数 account 指定账号，不指定时为默认账号
+    """
+    if request.method == 'GET':
+        account = get_account(request.GET.get('account'))
+        if account is None:
+            return unknown_account_response(request.GET.get('account'))
+        return JsonResponse({**account.executor.stats(), 'idempotency': idempotency.stats()})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def accounts_status(request):
+    """
+    所有微信账号的队列、任务耗时、条件等待和发送记录统计
+    """
+    if request.method == 'GET':
+        return JsonResponse({'default': accounts.default.name, 'accounts': accounts.stats()},
+                            json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def metrics(request):
+    """
+    Prometheus 文本格式的指标：每个账号每种操作各个步骤的耗时直方图，以及各个队列通道的排队数量
+    """
+    if request.method == 'GET':
+        text = render_prometheus([({'account': account.name}, account.wechat.tracer) for account in accounts.all()],
+                                 [({'account': account.name}, account.queue) for account in accounts.all()])
+        return HttpResponse(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def watch(request):
+    """
+    GET：各账号新消息监听的状态
+    POST：开启或关闭新消息监听，请求体为 {"account": ..., "enabled": true, "interval": 5, "webhooks": [url, ...]}，
+    webhooks 会替换之前注册的地址，新消息以 {"account": ..., "events": [...]} POST 到每个地址
+    """
+    if request.method == 'GET':
+        return JsonResponse({account.name: account.watcher.stats() for account in accounts.all()})
+    elif request.method == 'POST':
+        try:
+            data = json.loads(request.body or '{}')
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+        watcher = account.watcher
+
+        interval = data.get('interval', watcher.interval)
+        if not isinstance(interval, (int, float)) or interval <= 0:
+            return JsonResponse({'error': 'interval must be a positive number'}, status=400)
+        webhooks = data.get('webhooks', watcher.webhooks)
+        if not isinstance(webhooks, list) or not all(
+                isinstance(url, str) and url.startswith(('http://', 'https://')) for url in webhooks):
+            return JsonResponse({'error': 'webhooks must be a list of http(s) URLs'}, status=400)
+
+        watcher.interval = interval
+        watcher.webhooks = webhooks
+        if data.get('enabled', True):
+            watcher.start()
+        else:
+            watcher.stop()
+        return JsonResponse(watcher.stats())
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def auto_reply(request):
+    """
+    GET：自动回复规则及其命中次数、匹配耗时，参数 account 指定账号
+    POST：替换自动回复规则，请求体为 {"account": ..., "rules": [{"name", "contacts", "keywords", "patterns", "reply"}]}，
+    规则按顺序匹配，第一条命中的规则给出回复；新消息由新消息监听（wechat/watch）发现，监听开启后规则才会生效
+    """
+    if request.method == 'GET':
+        account = get_account(request.GET.get('account'))
+        if account is None:
+            return unknown_account_response(request.GET.get('account'))
+        engine = account.wechat.auto_reply
+        return JsonResponse({'rules': [rule.to_dict() for rule in engine.rules], 'stats': engine.stats()},
+                            json_dumps_params={'ensure_ascii': False})
+    elif request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            rules = [Rule.from_dict(rule) for rule in data['rules']]
+        except (KeyError, TypeError, AttributeError, json.JSONDecodeError):
+            return JsonResponse({'error': 'Invalid request, each rule needs a reply'}, status=400)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+        try:
+            account.wechat.auto_reply.set_rules(rules)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        return JsonResponse({'rules': len(rules)})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+def sse_event(event):
+    return f"id: {event['id']}\nevent: message\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+
+@csrf_exempt
+def watch_events(request):
+    """
+    以 Server-Sent Events 推送新消息，参数 account 指定账号。默认只推送连接之后收到的消息；
+    断线重连时浏览器会带上 Last-Event-ID 请求头，也可以通过参数 since 指定，补发之后的事件
+    """
+    if request.method == 'GET':
+        account = get_account(request.GET.get('account'))
+        if account is None:
+            return unknown_account_response(request.GET.get('account'))
+        watcher = account.watcher
+        last_id = request.headers.get('Last-Event-ID') or request.GET.get('since')
+        try:
+            last_id = int(last_id) if last_id is not None else watcher.last_id
+        except ValueError:
+            return JsonResponse({'error': 'Invalid event id'}, status=400)
+
+        def stream(last_id):
+            yield 'retry: 3000\n\n'
+            while True:
+                events = watcher.events_since(last_id, SSE_HEARTBEAT)
+                if not events:
+                    yield ': keep-alive\n\n'
+                    continue
+                for event in events:
+                    yield sse_event(event)
+                last_id = events[-1]['id']
+
+        response = StreamingHttpResponse(stream(last_id), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
     else:
         return JsonResponse({'error': 'Invalid request method'}, status=405)
 
@@ -78,12 +626,20 @@ def ping(request):
 def check_wechat_status(request):
     if request.method == 'POST':
         try:
-            comtypes.CoInitialize()
-            with lock:  # 确保微信操作的线程安全
-                wechat.prevent_offline()
-            return JsonResponse({'status': 'WeChat checked and prevent offline executed'}, status=200)
-        except Exception as e:
-            return JsonResponse({'status': 'Error', 'error': str(e)}, status=500)
+            data = json.loads(request.body or '{}')
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+
+        def task():
+            account.wechat.prevent_offline()
+            return True, {'status': 'WeChat checked and prevent offline executed'}
+
+        # 防掉线属于后台任务
+        job = submit_job(account, 'check_wechat_status', task, {'status': 'Error'}, BACKGROUND)
+        return job_response(job)
     else:
         return JsonResponse({'error': 'Invalid request method'}, status=405)
 
@@ -93,6 +649,7 @@ def check_wechat_status(request):
 def get_dialogs_view(request):
     """
     获取指定联系人或群聊的聊天记录
+    传入 since（上一次返回的 cursor，首次为 0）时不需要 n_msg，只返回游标之后的新消息和新的 cursor
     """
     if request.method == 'POST':
         try:
@@ -100,11 +657,38 @@ def get_dialogs_view(request):
             data = json.loads(request.body)
             name = data.get('name')  # 联系人或群聊的名称
             n_msg = data.get('n_msg')  # 获取的聊天记录条数，必须指定
+            since = data.get('since', request.GET.get('since'))  # 增量获取：上一次返回的游标
 
             # 检查是否提供了 name 和 n_msg 参数
             if not name:
                 return JsonResponse({'error': 'Missing name parameter'}, status=400)
 
+            lane = data.get('lane', BACKGROUND)
+            error = invalid_lane_response(lane)
+            if error:
+                return error
+
+            account = get_account(data.get('account'))
+            if account is None:
+                return unknown_account_response(data.get('account'))
+            wechat = account.wechat
+
+            # 增量模式：只返回游标之后的新消息
+            if since is not None:
+                try:
+                    since = int(since)
+                    if since < 0:
+                        raise ValueError
+                except ValueError:
+                    return JsonResponse({'error': 'since must be a non-negative integer'}, status=400)
+
+                def since_task():
+                    cursor, dialogs, reset = wechat.get_dialogs_since(name, since)
+                    return True, {'status': 'success', 'dialogs': dialogs, 'cursor': cursor, 'reset': reset}
+
+                job = submit_job(account, 'get_dialogs', since_task, {'status': 'error'}, lane)
+                return job_response(job)
+
             if not n_msg:
                 return JsonResponse({'error': 'Missing n_msg parameter'}, status=400)
 
@@ -116,13 +700,16 @@ def get_dialogs_view(request):
             except ValueError:
                 return JsonResponse({'error': 'n_msg must be a positive integer'}, status=400)
 
-            # 使用全局锁来保证线程安全
-            with lock:
-                comtypes.CoInitialize()  # 初始化COM接口，防止线程冲突
-                dialogs = wechat.get_dialogs(name, n_msg)
+            def task():
+                result = {'status': 'success', 'dialogs': wechat.get_dialogs(name, n_msg)}
+                # 加载了更早的聊天记录时返回加载的页数和耗时
+                if wechat.last_history_load is not None:
+                    result['history'] = wechat.last_history_load._asdict()
+                return True, result
 
-            # 返回获取到的聊天记录，并禁用ensure_ascii
-            return JsonResponse({'status': 'success', 'dialogs': dialogs}, status=200, json_dumps_params={'ensure_ascii': False})
+            # 交给微信界面线程执行，返回获取到的聊天记录
+            job = submit_job(account, 'get_dialogs', task, {'status': 'error'}, lane)
+            return job_response(job)
 
         except Exception as e:
             return JsonResponse({'status': 'error', 'error': str(e)}, status=500)
@@ -157,16 +744,165 @@ def get_dialogs_by_time_blocks_view(request):
             except ValueError:
                 return JsonResponse({'error': 'n_time_blocks must be a positive integer'}, status=400)
 
-            # 使用全局锁来保证线程安全
-            with lock:
-                comtypes.CoInitialize()  # 初始化COM接口，防止线程冲突
-                groups = wechat.get_dialogs_by_time_blocks(name, n_time_blocks)
+            lane = data.get('lane', BACKGROUND)
+            error = invalid_lane_response(lane)
+            if error:
+                return error
 
-            # 返回获取到的按时间分组的聊天记录，并禁用ensure_ascii
-            return JsonResponse({'status': 'success', 'dialogs': groups}, status=200,
-                                json_dumps_params={'ensure_ascii': False})
+            account = get_account(data.get('account'))
+            if account is None:
+                return unknown_account_response(data.get('account'))
+
+            def task():
+                dialogs = account.wechat.get_dialogs_by_time_blocks(name, n_time_blocks)
+                return True, {'status': 'success', 'dialogs': dialogs}
+
+            # 交给微信界面线程执行，返回获取到的按时间分组的聊天记录
+            job = submit_job(account, 'get_dialogs_by_time_blocks', task, {'status': 'error'}, lane)
+            return job_response(job)
 
         except Exception as e:
             return JsonResponse({'status': 'error', 'error': str(e)}, status=500)
     else:
         return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+def submit_directory_scan(account, kind):
+    """扫描通讯录属于后台任务"""
+    return submit_job(account, 'scan_directory', partial(directory_scan_task, account, kind),
+                      {'status': 'Error', 'kind': kind}, BACKGROUND)
+
+
+@csrf_exempt
+def directory_list(request, kind):
+    """
+    查询缓存的联系人或群聊，不操作微信界面
+    参数 q：按名称搜索，前缀匹配的排在前面；prefix=1 时只返回前缀匹配的结果；limit：返回的最大数量；
+    account：查询的账号，不指定时为默认账号
+    缓存不存在或已过期时会在后台重新扫描，本次仍返回缓存中的结果，stale 为 true
+    """
+    if request.method == 'GET':
+        account = get_account(request.GET.get('account'))
+        if account is None:
+            return unknown_account_response(request.GET.get('account'))
+
+        query = request.GET.get('q', '')
+        try:
+            limit = int(request.GET['limit']) if 'limit' in request.GET else None
+            if limit is not None and limit <= 0:
+                raise ValueError
+        except ValueError:
+            return JsonResponse({'error': 'limit must be a positive integer'}, status=400)
+
+        directory = account.directory
+        index = directory.index(kind)
+        if not query:
+            results = index.all(limit)
+        elif request.GET.get('prefix') in ('1', 'true'):
+            results = index.prefix(query, limit)
+        else:
+            results = index.search(query, limit)
+
+        stale = directory.is_stale(kind)
+        submit = partial(submit_directory_scan, account)
+        job = directory.refresh(kind, submit) if stale else directory.refreshing(kind)
+        scanned_at = directory.scanned_at(kind)
+        return JsonResponse({
+            'account': account.name,
+            'kind': kind,
+            'total': len(index),
+            'results': results,
+            'scanned_at': scanned_at.isoformat() if scanned_at else None,
+            'stale': stale,
+            'refresh_job': job.id if job is not None else None,
+        }, json_dumps_params={'ensure_ascii': False})
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+@csrf_exempt
+def directory_refresh(request):
+    """
+    立即在后台重新扫描通讯录，请求体为 {"kind": "contact" 或 "group", "account": ...}，不传 kind 时两者都扫描
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body or '{}')
+        except json.JSONDecodeError:
+            return JsonResponse({'error': 'Invalid JSON'}, status=400)
+        kind = data.get('kind')
+        if kind is not None and kind not in KINDS:
+            return JsonResponse({'error': f"Invalid kind: {kind}, must be one of {', '.join(KINDS)}"}, status=400)
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+
+        submit = partial(submit_directory_scan, account)
+        jobs = {k: account.directory.refresh(k, submit).id for k in ([kind] if kind else KINDS)}
+        return JsonResponse({'jobs': jobs}, status=202)
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
+
+
+def picture_dir(account, name):
+    """
+    聊天图片的导出目录 PICTURE_DIR/账号/聊天，去掉名称中不能用于文件名的字符。
+    名称为 .、.. 等解析后不是 PICTURE_DIR 下两级子目录的，返回 None
+    """
+    root = os.path.abspath(PICTURE_DIR)
+    account_dir = os.path.abspath(os.path.join(root, re.sub(r'[\\/:*?"<>|]', '_', account.name)))
+    path = os.path.abspath(os.path.join(account_dir, re.sub(r'[\\/:*?"<>|]', '_', name)))
+    if os.path.dirname(account_dir) != root or os.path.dirname(path) != account_dir:
+        return None
+    return path
+
+
+@csrf_exempt
+def export_pictures(request):
+    """
+    导出聊天记录中最新的 num 张图片，以 zip 的形式流式返回，zip 中 0001 为最新的图片
+    请求体为 {"name": ..., "num": ...}。图片同时保存在服务端，内容相同的图片只保存一次，
+    重复导出同一个聊天时已经保存过的图片不会再复制
+    """
+    if request.method == 'POST':
+        try:
+            data = json.loads(request.body)
+            name = data['name']
+            num = int(data.get('num', 10))
+            if num <= 0:
+                raise ValueError
+        except (KeyError, ValueError, TypeError, json.JSONDecodeError):
+            return JsonResponse({'error': 'Invalid request, name is required and num must be a positive integer'},
+                                status=400)
+
+        lane = data.get('lane', INTERACTIVE)
+        error = invalid_lane_response(lane)
+        if error:
+            return error
+
+        account = get_account(data.get('account'))
+        if account is None:
+            return unknown_account_response(data.get('account'))
+        save_dir = picture_dir(account, name)
+        if save_dir is None:
+            return JsonResponse({'error': f"Invalid name for a picture directory: {name}"}, status=400)
+
+        def task():
+            pictures = account.wechat.save_dialog_pictures(name, num, save_dir)
+            return True, {'status': 'Pictures exported', 'name': name, 'pictures': pictures,
+                          'failed': account.wechat.last_picture_failures}
+
+        job = submit_job(account, 'export_pictures', task, {'status': 'Error exporting pictures', 'name': name}, lane)
+        if not job.wait(SYNC_TIMEOUT) or job.status != SUCCEEDED:
+            return job_response(job)
+
+        pictures = job.result['pictures']
+        files = [(f"{i:04d}_{os.path.basename(p['file'])}", p['file']) for i, p in enumerate(pictures, 1)]
+        response = StreamingHttpResponse(zip_stream(files), content_type='application/zip')
+        response['Content-Disposition'] = 'attachment; filename="pictures.zip"'
+        response['X-Pictures-Exported'] = str(len(pictures))
+        response['X-Pictures-New'] = str(sum(1 for p in pictures if p['new']))
+        response['X-Pictures-Failed'] = str(len(job.result['failed']))
+        return response
+    else:
+        return JsonResponse({'error': 'Invalid request method'}, status=405)
@@ -0,0 +1,211 @@
+"""
+新消息监听。
+
+之前检测新消息有两种方式：check_new_msg 反复双击聊天按钮、逐个点开未读的会话；客户端则每分钟对每条
+MessageCheck 规则调用一次 get_dialogs。两者的界面操作次数都随规则或会话数量增长。
+
+MessageWatcher 每隔 interval 秒向该账号的执行线程提交一个后台任务：用一次缓存请求读取左侧会话列表，
+只对未读数或最后一条消息的预览发生变化的会话增量读取新消息（get_dialogs_since），
+新消息作为事件推送给订阅者：
+- Server-Sent Events：/wechat/watch/events/，断线重连时通过 Last-Event-ID 补发错过的事件
+- webhook：把事件以 JSON POST 到注册的地址，由单独的线程发送，失败时重试
+
+自己发送的消息（见 WeChat.recent_sent）不会作为事件推送。
+每条新消息都会用 WeChat.auto_reply 的规则匹配，命中时提交一个发送回复的任务，事件中的 auto_reply 为回复的内容。
+"""
+import json
+import logging
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from functools import partial
+
+from .scheduler import BACKGROUND, INTERACTIVE
+from .ui_auto_wechat import VALUE_TO_INFO
+
+logger = logging.getLogger(__name__)
+
+USER_MESSAGE = VALUE_TO_INFO[0]
+
+
+def post_json(url, payload, timeout):
+    """把 payload 以 JSON POST 到 url，返回 HTTP 状态码"""
+    request = urllib.request.Request(url, data=json.dumps(payload, ensure_ascii=False).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'}, method='POST')
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+class MessageWatcher:
+    def __init__(self, account, interval=5.0, keep=1000, webhook_timeout=5.0, webhook_retries=3, post=post_json):
+        """
+        Args:
+            account: 监听的微信账号（accounts.Account）
+            interval: 两次扫描会话列表的间隔（秒）
+            keep: 保留最近的事件数量，用于 SSE 断线重连后补发
+            webhook_timeout: 每次调用 webhook 的超时时间（秒）
+            webhook_retries: webhook 调用失败后的重试次数
+            post: 发送 webhook 请求的函数，测试时可以替换
+        """
+        self.account = account
+        self.interval = interval
+        self.webhooks = []
+        self.webhook_timeout = webhook_timeout
+        self.webhook_retries = webhook_retries
+        self.post = post
+        self._events = deque(maxlen=keep)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        # 每个会话上一次扫描时的 (未读数, 预览)，以及已经推送到的聊天记录游标
+        self._sessions = None
+        self._cursors = {}
+        self._job = None
+        self._stop = None
+        self._webhook_queue = queue.Queue()
+        self._webhook_thread = None
+        self.scans = 0
+        self.reads = 0
+        self.webhook_sent = 0
+        self.webhook_failed = 0
+
+    @property
+    def running(self):
+        return self._stop is not None
+
+    def start(self):
+        if self._stop is None:
+            self._stop = threading.Event()
+            threading.Thread(target=self._loop, args=(self._stop,), name=f'wechat-watch-{self.account.name}',
+                             daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+    def _loop(self, stop):
+        while not stop.wait(self.interval):
+            self.submit()
+
+    def submit(self):
+        """上一次扫描还没有执行时不重复提交"""
+        if self._job is None or self._job.done:
+            self._job = self.account.submit('watch_sessions', self.scan, {'status': 'Error scanning sessions'},
+                                            BACKGROUND)
+        return self._job
+
+    def scan(self):
+        """在执行线程中执行：读取会话列表，增量读取发生变化的会话，推送新消息"""
+        wechat = self.account.wechat
+        sessions = wechat.get_sessions()
+        self.scans += 1
+        previous, self._sessions = self._sessions, {s.name: (s.unread, s.preview) for s in sessions}
+        if previous is None:
+            # 第一次扫描只记录会话列表的状态，之前的消息不推送
+            return True, {'status': 'Sessions scanned', 'changed': 0, 'events': 0}
+
+        changed = [s for s in sessions if previous.get(s.name) != (s.unread, s.preview)
+                   and (s.unread > 0 or not wechat.sent_recently(s.name, s.preview))]
+        events = []
+        for session in changed:
+            events += self._read(session)
+            # 打开聊天窗口之后未读数清零
+            self._sessions[session.name] = (0, session.preview)
+        self.publish(events)
+        return True, {'status': 'Sessions scanned', 'changed': len(changed), 'events': len(events)}
+
+    def _read(self, session):
+        wechat = self.account.wechat
+        since = self._cursors.get(session.name, 0)
+        cursor, dialogs, reset = wechat.get_dialogs_since(session.name, since)
+        self.reads += 1
+        self._cursors[session.name] = cursor
+        if since == 0 or reset:
+            # 没有上一次的游标，按未读数取最后几条
+            dialogs = dialogs[-max(session.unread, 1):]
+
+        events = []
+        replied = False
+        for kind, sender, text in dialogs:
+            if kind == USER_MESSAGE and wechat.is_own_message(session.name, text):
+                continue
+            event = {'account': self.account.name, 'name': session.name, 'type': kind, 'sender': sender,
+                     'text': text, 'received_at': time.time()}
+            # 每个会话每次扫描最多自动回复一次
+            reply = wechat.auto_reply.reply(session.name, text) if kind == USER_MESSAGE and not replied else None
+            if reply is not None:
+                event['auto_reply'] = reply
+                replied = True
+                self.account.submit('auto_reply', partial(self._send_reply, session.name, reply),
+                                    {'status': 'Error sending auto reply', 'name': session.name}, INTERACTIVE,
+                                    pace=(session.name, 1))
+            events.append(event)
+        return events
+
+    def _send_reply(self, name, reply):
+        success = self.account.wechat.send_msg(name, reply)
+        return success, {'status': 'Auto reply sent' if success else 'Failed to send auto reply', 'name': name}
+
+    def publish(self, events):
+        """给事件编号并通知 SSE 订阅者，同时交给 webhook 线程发送"""
+        if not events:
+            return
+        with self._cond:
+            for event in events:
+                self._last_id += 1
+                event['id'] = self._last_id
+                self._events.append(event)
+            self._cond.notify_all()
+        webhooks = list(self.webhooks)
+        if webhooks and self._webhook_thread is None:
+            self._webhook_thread = threading.Thread(target=self._deliver_webhooks,
+                                                    name=f'wechat-webhook-{self.account.name}', daemon=True)
+            self._webhook_thread.start()
+        for url in webhooks:
+            self._webhook_queue.put((url, events))
+
+    def events_since(self, last_id, timeout=None):
+        """
+        编号大于 last_id 的事件；没有时最多等待 timeout 秒
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            return [event for event in self._events if event['id'] > last_id]
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def _deliver_webhooks(self):
+        while True:
+            url, events = self._webhook_queue.get()
+            payload = {'account': self.account.name, 'events': events}
+            for attempt in range(self.webhook_retries + 1):
+                try:
+                    status = self.post(url, payload, self.webhook_timeout)
+                    if 200 <= status < 300:
+                        self.webhook_sent += 1
+                        break
+                except Exception as e:
+                    logger.warning(f"Webhook {url} failed: {e}")
+                if attempt < self.webhook_retries:
+                    time.sleep(2 ** attempt)
+            else:
+                self.webhook_failed += 1
+
+    def stats(self) -> dict:
+        return {
+            'running': self.running,
+            'interval': self.interval,
+            'webhooks': list(self.webhooks),
+            'sessions': len(self._sessions or ()),
+            'scans': self.scans,
+            'reads': self.reads,
+            'events': self.last_id,
+            'webhook_sent': self.webhook_sent,
+            'webhook_failed': self.webhook_failed,
+        }
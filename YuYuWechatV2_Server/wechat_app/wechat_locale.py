@@ -19,11 +19,13 @@ class WeChatLocale:
         "settings_and_others":  {"en-US": "Settings and Others", "zh-CN": "设置及其他", "zh-TW": "設定與其他"},
         
         "search":       {"en-US": "Search",         "zh-CN": "搜索",            "zh-TW": "搜尋"},
+        "search_result":    {"en-US": "@str:IDS_FAV_SEARCH_RESULT:3780", "zh-CN": "@str:IDS_FAV_SEARCH_RESULT:3780", "zh-TW": "@str:IDS_FAV_SEARCH_RESULT:3780"},
         "send":         {"en-US": "Send (S)",       "zh-CN": "发送(S)",         "zh-TW": "傳送（S）"},
         "contact":      {"en-US": "contact",        "zh-CN": "联系人",          "zh-TW": "聯絡人"},
         "group_chat":   {"en-US": "Group Chat",     "zh-CN": "群聊",            "zh-TW": "群聊"},
         "manage_contacts":  {"en-US": "Manage Contacts", "zh-CN": "通讯录管理", "zh-TW": "通訊錄管理"},
 
+        "session":      {"en-US": "Chats",          "zh-CN": "会话",            "zh-TW": "會話"},
         "message":      {"en-US": "消息",           "zh-CN": "消息",            "zh-TW": "消息"},
         "chat_history": {"en-US": "Chat History",   "zh-CN": "聊天记录",        "zh-TW": "聊天記錄"},
         "photos_n_videos":  {"en-US": "Photos & Videos", "zh-CN": "图片与视频", "zh-TW": "圖片與影片"},